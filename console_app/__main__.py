@@ -0,0 +1,207 @@
+import time
+
+# от этой точки считается отчет --startup-report, поэтому остальные импорты ниже таймера
+STARTED = time.perf_counter()
+
+import argparse  # noqa: E402
+import atexit  # noqa: E402
+import json  # noqa: E402
+import sys  # noqa: E402
+
+from .backends import ARCHIVE_BACKENDS  # noqa: E402
+from .exceptions import InvalidInputData  # noqa: E402
+from .ids import ID_STRATEGIES  # noqa: E402
+from .snapshot import SNAPSHOT_CODECS  # noqa: E402
+from .main import Library  # noqa: E402
+from .stats import STATS, process_age  # noqa: E402
+
+# bench, client и server (asyncio) импортируются только своими командами
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m console_app", description="Консольная библиотека.")
+    parser.add_argument("--storage", choices=ARCHIVE_BACKENDS, help="хранилище архива")
+    parser.add_argument("--journal", action="store_true", help="режим журналирования json архива")
+    parser.add_argument(
+        "--id-strategy",
+        choices=ID_STRATEGIES,
+        help="схема id нового архива и цель migrate ids (по умолчанию hash), иначе берется схема архива",
+    )
+    parser.add_argument(
+        "--flush-delay", type=float, metavar="SECONDS", help="отложенная запись json архива: через N секунд"
+    )
+    parser.add_argument(
+        "--flush-ops", type=int, metavar="N", help="отложенная запись json архива: каждые N команд"
+    )
+    parser.add_argument("--codec", choices=SNAPSHOT_CODECS, help="формат снапшота json архива")
+    parser.add_argument("--shards", type=int, metavar="N", help="число шардов архива --storage sharded")
+    parser.add_argument(
+        "--shard-workers", type=int, metavar="N", help="обходить шарды в N потоков (all, поиск, выборки)"
+    )
+    parser.add_argument(
+        "--workers", type=int, metavar="N", help="процессов для filter на больших архивах (по умолчанию ядра)"
+    )
+    parser.add_argument(
+        "--fast-start",
+        action="store_true",
+        help="хранить pickle загруженного json архива для быстрого старта (читается, только если он ваш)",
+    )
+    parser.add_argument(
+        "--startup-report", action="store_true", help="вывести в stderr время запуска и загрузки архива"
+    )
+    parser.add_argument("--stats", action="store_true", help="собирать статистику времени и ввода-вывода")
+    parser.add_argument(
+        "--stats-file", metavar="FILE", help="сохранить статистику в json файл при выходе (включает --stats)"
+    )
+    parser.add_argument(
+        "--profile", metavar="DIR", help="профилировать каждую команду cProfile в DIR (включает --stats)"
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    import_parser = commands.add_parser("import", help="загрузить книги из csv или jsonl файла")
+    import_parser.add_argument("file", help="путь к файлу .csv или .jsonl")
+
+    export_parser = commands.add_parser("export", help="выгрузить архив в файл")
+    export_parser.add_argument("file", help="путь к файлу")
+    export_parser.add_argument(
+        "--format", choices=SNAPSHOT_CODECS, default="pretty", help="формат файла (по умолчанию json с отступами)"
+    )
+
+    changes_parser = commands.add_parser(
+        "export-changes", help="выгрузить изменения архива после контрольной точки"
+    )
+    changes_parser.add_argument("file", help="путь к json файлу")
+    changes_parser.add_argument(
+        "--since", type=int, default=0, help="seq из прошлой выгрузки (по умолчанию 0 - весь архив)"
+    )
+    apply_parser = commands.add_parser("apply-changes", help="применить выгрузку export-changes к архиву")
+    apply_parser.add_argument("file", help="путь к json файлу")
+
+    batch_parser = commands.add_parser("batch", help="выполнить команды из файла или stdin")
+    batch_parser.add_argument("file", nargs="?", help="файл с командами, по умолчанию stdin")
+    batch_parser.add_argument(
+        "--flush-every", type=int, help="сохранять архив каждые N команд (по умолчанию в конце)"
+    )
+
+    bench_parser = commands.add_parser("bench", help="замерить скорость команд на синтетических каталогах")
+    bench_parser.add_argument(
+        "--sizes", default="1000,10000,100000", help="размеры каталогов через запятую (по умолчанию 1000,10000,100000)"
+    )
+    bench_parser.add_argument("--ops", type=int, default=100, help="сколько раз выполнить каждую команду")
+    bench_parser.add_argument("--dublicates", type=float, default=0.1, help="доля дубликатов в каталоге")
+    bench_parser.add_argument("--collisions", type=float, default=0.0, help="доля названий-анаграмм")
+    bench_parser.add_argument("--seed", type=int, default=0)
+    bench_parser.add_argument("--output", metavar="FILE", help="сохранить результаты в json файл")
+
+    for name, help in (("serve", "запустить сервер библиотеки"), ("client", "подключиться к серверу")):
+        server_parser = commands.add_parser(name, help=help)
+        server_parser.add_argument("--host", default="127.0.0.1")
+        server_parser.add_argument("--port", type=int, default=8765)
+        server_parser.add_argument("--unix", metavar="PATH", help="unix сокет вместо tcp")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> int:
+    imported = time.perf_counter()
+    args = parse_args(argv)
+    if args.stats or args.stats_file or args.profile or args.startup_report:
+        STATS.enable(args.profile)
+    if args.startup_report:
+        # интерпретатор до начала работы модуля, по /proc, если он есть
+        started_at = process_age()
+
+        def report() -> None:
+            total = time.perf_counter() - STARTED
+            print(STATS.render_startup(started_at, imported - STARTED, total), file=sys.stderr)
+
+        atexit.register(report)
+    if args.stats_file:
+        # интерактивный режим завершается через sys.exit, поэтому сохраняем при выходе
+        atexit.register(STATS.dump, args.stats_file)
+    archive = None
+    if args.command == "client":
+        from .client import RemoteArchive
+
+        archive = RemoteArchive(args.host, args.port, args.unix)
+
+    def make_library() -> Library:
+        return Library(
+            journal=args.journal,
+            id_strategy=args.id_strategy,
+            storage=args.storage,
+            archive=archive,
+            flush_delay=args.flush_delay,
+            flush_every=args.flush_ops,
+            codec=args.codec,
+            shards=args.shards,
+            shard_workers=args.shard_workers,
+            scan_workers=args.workers,
+            fast_start=args.fast_start,
+        )
+
+    try:
+        library = make_library()
+    except (InvalidInputData, ValueError) as exc:
+        # несовместимые параметры хранилища или неизвестное LIBRARY_STORAGE
+        print(exc)
+        return 1
+    if args.command == "bench":
+        from .bench import run_benchmarks
+
+        try:
+            sizes = [int(size) for size in args.sizes.split(",")]
+        except ValueError:
+            print("--sizes: размеры каталогов должны быть целыми числами через запятую.")
+            return 1
+        run_benchmarks(
+            make_library, sizes, args.ops, args.dublicates, args.collisions, args.seed, args.output
+        )
+        return 0
+    if args.command == "serve":
+        import asyncio
+
+        from .server import serve
+
+        try:
+            asyncio.run(serve(library, args.host, args.port, args.unix))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    if args.command == "import":
+        try:
+            counters = library.import_file(args.file)
+        except InvalidInputData as exc:
+            print(exc)
+            return 1
+        return 1 if counters["errors"] else 0
+    if args.command == "export":
+        library.archive.export(args.file, args.format)
+        return 0
+    if args.command == "export-changes":
+        try:
+            diff = library.archive.export_changes(args.since)
+        except InvalidInputData as exc:
+            print(exc)
+            return 1
+        with open(args.file, "w", encoding="utf-8") as f:
+            json.dump(diff, f, ensure_ascii=False)
+        print(f"Выгружено изменений: {len(diff['changes'])}, контрольная точка: {diff['seq']}.")
+        return 0
+    if args.command == "apply-changes":
+        with open(args.file, "r", encoding="utf-8") as f:
+            diff = json.load(f)
+        applied = library.archive.apply_changes(diff["changes"])
+        library.archive.flush()
+        print(f"Применено изменений: {applied}, контрольная точка источника: {diff['seq']}.")
+        return 0
+    if args.command == "batch":
+        if args.file is None:
+            return 1 if library.run_batch(sys.stdin, sys.stdout, args.flush_every) else 0
+        with open(args.file, "r", encoding="utf-8") as f:
+            return 1 if library.run_batch(f, sys.stdout, args.flush_every) else 0
+    library.enter()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
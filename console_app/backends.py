@@ -0,0 +1,26 @@
+import importlib
+
+from .data import BaseArchive
+from .stats import STATS
+
+# хранилище -> "модуль:класс": модуль хранилища (sqlite3, mmap, пулы потоков)
+# импортируется только когда это хранилище выбрано
+ARCHIVE_BACKENDS: dict[str, str] = {
+    "json": "data:Archive",
+    "sqlite": "sqlite_archive:SQLiteArchive",
+    "mmap": "mmap_archive:MmapArchive",
+    "sharded": "sharded_archive:ShardedArchive",
+}
+
+
+def get_archive_backend(name: str) -> type[BaseArchive]:
+    try:
+        module, _, cls = ARCHIVE_BACKENDS[name].partition(":")
+    except KeyError:
+        raise ValueError(
+            f"Неизвестное хранилище: '{name}'. Доступны: {', '.join(ARCHIVE_BACKENDS)}."
+        ) from None
+    backend = getattr(importlib.import_module(f".{module}", __package__), cls)
+    # хранилище могло загрузиться уже после STATS.enable
+    STATS.instrument_backend(ARCHIVE_BACKENDS[name], backend)
+    return backend
@@ -0,0 +1,127 @@
+import json
+from typing import TYPE_CHECKING, Any, Iterable, TextIO
+
+from .commands import COMMANDS, parse_command, parse_page
+from .exceptions import (
+    ArchiveLocked,
+    DataDoesNotExists,
+    InvalidCommand,
+    InvalidInputData,
+    TheSameStatus,
+)
+from .scan import parse_conditions
+from .stats import STATS
+
+if TYPE_CHECKING:
+    from .main import Library
+
+
+class BatchRunner:
+    """
+    Пакетный режим: одна команда на строку, аргументы в той же строке,
+    значения с пробелами берутся в кавычки:
+
+        add "Процесс" "Франц Кафка" 1925
+        change_status t1a1y1925 в наличии
+        search кафка
+
+    Команды и их аргументы те же, что в интерактивном режиме (commands.COMMANDS),
+    только недостающие аргументы не запрашиваются, а считаются ошибкой.
+
+    Все команды выполняются над одним загруженным архивом, архив сохраняется
+    каждые flush_every команд (или один раз в конце, если flush_every не задан).
+    """
+
+    def __init__(self, library: "Library", flush_every: int | None = None) -> None:
+        self.library = library
+        self.flush_every = flush_every
+
+    # обработчики команд: имя обработчика и аргументы команды - в commands.COMMANDS
+
+    def _add(self, title: str, author: str, year: str) -> str:
+        return self.library.add_book(title, author, year)
+
+    def _delete(self, id: str) -> str:
+        return self.library.delete_book(id)
+
+    def _change_status(self, id: str, status: str) -> str:
+        return self.library.change_book_status(id, status)
+
+    def _search(self, filter_attr: str) -> list[dict[str]]:
+        found = self.library.archive.search_similar(filter_attr, self.library.SEARCH_LIMIT)
+        return [{"id": id, **book} for id, book in found]
+
+    def _with_status(self, status: str) -> list[dict[str]]:
+        return [{"id": id, **book} for id, book in self.library.archive.books_with_status(status)]
+
+    def _issued_books(self) -> list[dict[str]]:
+        return self._with_status("выдана")
+
+    def _available_books(self) -> list[dict[str]]:
+        return self._with_status("в наличии")
+
+    def _copies(self, title: str) -> list[dict[str]]:
+        return [
+            {"id": id, **book, "copies": copies, "available": available}
+            for id, book, copies, available in self.library.archive.copy_counts(title)
+        ]
+
+    def _filter(self, *conditions: str) -> list[dict[str]]:
+        conditions = parse_conditions(list(conditions))
+        books = self.library.archive.filter_books(conditions, self.library.scan_workers)
+        return [{"id": id, **book} for id, book in books]
+
+    def _all(self, offset: str = "0", limit: str | None = None) -> list[dict[str]]:
+        offset, limit = parse_page(offset, limit)
+        return [{"id": id, **book} for id, book in self.library.archive.iter_books(offset, limit)]
+
+    def _migrate_ids(self) -> dict[str, int]:
+        return {"changed": self.library.apply_id_scheme()}
+
+    def _import_books(self, path: str) -> dict[str, int]:
+        # ошибки строк файла учитываются в счетчиках, вывод занят ответами json
+        return self.library.import_file(path.strip(), verbose=False)
+
+    def _stats(self) -> dict[str, Any]:
+        return STATS.report()
+
+    def execute(self, line: str) -> Any:
+        name, args = parse_command(line)
+        command = COMMANDS[name]
+        if command.batch is None:
+            raise InvalidCommand(f"Команда '{name}' не поддерживается в пакетном режиме.")
+        values = command.bind(name, args)
+        command.check_count(name, values)
+        return getattr(self, command.batch)(*values)
+
+    def run(self, lines: Iterable[str], out: TextIO) -> int:
+        """Возвращает количество команд, завершившихся ошибкой."""
+        errors = 0
+        lines = enumerate(lines, 1)
+        while True:
+            with self.library.archive.batch():
+                executed = 0
+                for line_num, line in lines:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    response = {"line": line_num, "command": line}
+                    try:
+                        response["result"] = self.execute(line)
+                        response["ok"] = True
+                    except (
+                        InvalidCommand,
+                        InvalidInputData,
+                        TheSameStatus,
+                        DataDoesNotExists,
+                        ArchiveLocked,
+                    ) as exc:
+                        response["error"] = str(exc)
+                        response["ok"] = False
+                        errors += 1
+                    out.write(json.dumps(response, ensure_ascii=False) + "\n")
+                    executed += 1
+                    if self.flush_every and executed >= self.flush_every:
+                        break
+                else:
+                    return errors
@@ -0,0 +1,206 @@
+import io
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+from typing import Any, Callable, Iterable
+
+from .data import BOOK_FIELDS
+from .exceptions import DataDoesNotExists, TheSameStatus
+from .ids import get_id_strategy
+from .main import Library
+
+WORDS = (
+    "война", "мир", "процесс", "замок", "идиот", "бесы", "нос", "шинель",
+    "отцы", "дети", "мастер", "маргарита", "гамлет", "фауст", "book", "cool",
+)
+
+
+def generate_catalogue(
+    size: int,
+    id_strategy: Callable[[dict[str]], str],
+    dublicate_rate: float = 0.1,
+    collision_rate: float = 0.0,
+    seed: int = 0,
+) -> dict[str, dict[str]]:
+    """
+    Синтетический каталог из size записей в формате архива.
+    dublicate_rate - доля копий уже добавленных книг,
+    collision_rate - доля книг с названием-анаграммой уже добавленной книги:
+    при схеме id "charsum" они получают тот же id, что и оригинал.
+    """
+    rnd = random.Random(seed)
+    catalogue: dict[str, dict[str]] = {}
+    books: list[dict[str]] = []
+    last_dublicate: dict[str, int] = {}
+    for num in range(size):
+        chance = rnd.random()
+        if books and chance < dublicate_rate:
+            book = dict(rnd.choice(books))
+        elif books and chance < dublicate_rate + collision_rate:
+            book = dict(rnd.choice(books))
+            book["title"] = book["title"][::-1]
+        else:
+            book = {
+                "title": f"{' '.join(rnd.sample(WORDS, 2))} {num}",
+                "author": f"автор {rnd.randrange(max(size // 20, 1))}",
+                "year": str(rnd.randrange(1800, 2025)),
+                "status": rnd.choice(("в наличии", "выдана")),
+            }
+            books.append(book)
+        id = id_strategy({"t": book["title"], "a": book["author"], "y": book["year"]})
+        if id in catalogue:
+            last_dublicate[id] = last_dublicate.get(id, 0) + 1
+            id = f"{id}d{last_dublicate[id]}"
+        catalogue[id] = book
+    return catalogue
+
+
+def measure(func: Callable[..., Any], calls: Iterable[tuple]) -> dict[str, float]:
+    calls = list(calls)
+    start = time.perf_counter()
+    for args in calls:
+        try:
+            func(*args)
+        except (DataDoesNotExists, TheSameStatus):
+            pass
+    seconds = time.perf_counter() - start
+    return {
+        "ops": len(calls),
+        "seconds": round(seconds, 6),
+        "ops_per_sec": round(len(calls) / seconds, 1) if seconds else None,
+    }
+
+
+def bench_size(
+    make_library: Callable[[], Library],
+    size: int,
+    ops: int,
+    dublicate_rate: float,
+    collision_rate: float,
+    seed: int,
+    workdir: str,
+) -> dict[str, Any]:
+    rnd = random.Random(seed)
+    library = make_library()
+    # схема id каталога записывается в архив, ее же берут add следующих библиотек
+    scheme = library.requested_id_scheme
+    catalogue = generate_catalogue(size, get_id_strategy(scheme), dublicate_rate, collision_rate, seed)
+    filename = os.path.join(workdir, f"bench_{size}_{os.path.basename(library.archive._filename)}")
+    library.archive._filename = filename
+    results: dict[str, Any] = {}
+
+    start = time.perf_counter()
+    library.archive._replace_all(catalogue)
+    results["cold_save"] = {"ops": 1, "seconds": round(time.perf_counter() - start, 6)}
+    library.archive.set_id_scheme(scheme)
+    if hasattr(library.archive, "close"):
+        library.archive.close()
+
+    # пик памяти загрузки меряется отдельно: под tracemalloc загрузка в разы медленнее
+    library = make_library()
+    library.archive._filename = filename
+    tracemalloc.start()
+    library.archive.field_widths()
+    peak_memory_kb = tracemalloc.get_traced_memory()[1] // 1024
+    tracemalloc.stop()
+    if hasattr(library.archive, "close"):
+        library.archive.close()
+
+    library = make_library()
+    library.archive._filename = filename
+    start = time.perf_counter()
+    library.archive.field_widths()
+    seconds = round(time.perf_counter() - start, 6)
+    results["cold_load"] = {"ops": 1, "seconds": seconds, "peak_memory_kb": peak_memory_kb}
+
+    archive = library.archive
+    ids = list(catalogue)
+    originals = [id for id in ids if archive._split_id(id)[1] is None]
+
+    def sample(population: list[str]) -> list[str]:
+        return [rnd.choice(population) for _ in range(ops)]
+
+    results["find_dublicate"] = measure(archive._find_dublicate, ((id,) for id in sample(originals)))
+    results["parse_input"] = measure(
+        library._parse_input,
+        ((catalogue[id]["title"], library.TITLE_PATTERN) for id in sample(originals)),
+    )
+    results["search"] = measure(archive.search, ((catalogue[id]["author"],) for id in sample(originals)))
+    rows = [(id, *(catalogue[id][field] for field in BOOK_FIELDS)) for id in originals[:100]]
+    head = ("ID", "TITLE", "AUTHOR", "YEAR", "STATUS")
+    results["formatted_style"] = measure(library.formatted_style, ((head, rows) for _ in range(ops)))
+    with redirect_stdout(io.StringIO()):
+        results["all"] = measure(library.all, [()])
+    results["add"] = measure(
+        library.add_book,
+        ((f"новая книга {num}", "новый автор", "2000") for num in range(ops)),
+    )
+    results["change_status"] = measure(
+        library.change_book_status, ((id, "выдана") for id in sample(originals))
+    )
+    results["delete"] = measure(
+        library.delete_book, ((id,) for id in rnd.sample(ids, min(ops, len(ids))))
+    )
+    archive.flush()
+    if hasattr(archive, "close"):
+        archive.close()
+    return {
+        "size": size,
+        "dublicates": len(ids) - len(originals),
+        "operations": results,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_benchmarks(
+    make_library: Callable[[], Library],
+    sizes: Iterable[int],
+    ops: int = 100,
+    dublicate_rate: float = 0.1,
+    collision_rate: float = 0.0,
+    seed: int = 0,
+    output: str | None = None,
+) -> dict[str, Any]:
+    """
+    Замеряет команды архива и Library на синтетических каталогах.
+    Архивы создаются во временном каталоге, рабочий архив не трогается.
+    Результаты печатаются таблицей и сохраняются в json файл output.
+    """
+    library = make_library()
+    report = {
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "storage": library.storage,
+        "id_strategy": library.requested_id_scheme,
+        "ops": ops,
+        "dublicate_rate": dublicate_rate,
+        "collision_rate": collision_rate,
+        "seed": seed,
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory(prefix="library_bench_") as workdir:
+        for size in sizes:
+            report["results"].append(
+                bench_size(make_library, size, ops, dublicate_rate, collision_rate, seed, workdir)
+            )
+    head = ("SIZE", "OPERATION", "OPS", "SECONDS", "OPS/SEC")
+    body = [
+        (result["size"], name, op["ops"], op["seconds"], op.get("ops_per_sec") or "-")
+        for result in report["results"]
+        for name, op in result["operations"].items()
+    ]
+    print(library.formatted_style(head, body))
+    if output is not None:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {output}")
+    return report
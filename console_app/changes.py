@@ -0,0 +1,137 @@
+import json
+import os
+from typing import BinaryIO, Mapping
+
+from .stats import STATS
+
+
+class ChangeLog:
+    """
+    Журнал изменений архива для резервных копий и реплик: файл <архив>.changes,
+    по строке json на каждое изменение книги:
+
+        {"seq": 12, "id": "t1a1y1", "book": {"title": ..., "status": "выдана"}}
+        {"seq": 13, "id": "t1a1y1d1", "book": null}
+
+    seq растет на единицу с каждой записью. Записи идут по возрастанию seq,
+    поэтому начало изменений после контрольной точки находится двоичным
+    поиском по файлу и читается только хвост: выгрузка стоит пропорционально
+    числу изменений, а не размеру архива.
+
+    append вызывается только под блокировкой архива. Читатели ее не берут
+    и недописанную запись в конце файла пропускают: ее может дописывать
+    другой процесс прямо сейчас.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        # seq последней записи, размер файла, для которого он прочитан,
+        # и конец последней полной записи в нем
+        self._seq = 0
+        self._size: int | None = None
+        self._end = 0
+
+    def exists(self) -> bool:
+        return os.path.exists(self.filename)
+
+    @property
+    def seq(self) -> int:
+        """seq последнего изменения, 0 - изменений еще нет. Файл могли дописать другие процессы."""
+        try:
+            size = os.path.getsize(self.filename)
+        except FileNotFoundError:
+            self._seq, self._size, self._end = 0, None, 0
+            return 0
+        if size != self._size:
+            self._seq, self._end = self._read_tail(size)
+            self._size = size
+        return self._seq
+
+    def _read_tail(self, size: int) -> tuple[int, int]:
+        """seq последней полной записи и конец этой записи в файле размера size."""
+        with open(self.filename, "rb") as f:
+            chunk = 4096
+            while True:
+                start = max(size - chunk, 0)
+                f.seek(start)
+                lines = f.read(size - start).split(b"\n")
+                # первая строка куска может быть обрезана, последняя - недописана
+                complete = lines[:-1] if start == 0 else lines[1:-1]
+                if complete or start == 0:
+                    break
+                chunk *= 2
+        return (json.loads(complete[-1])["seq"] if complete else 0), size - len(lines[-1])
+
+    def append(self, changes: Mapping[str, Mapping[str, str] | None]) -> int:
+        """Дописывает изменения (id -> книга или None), возвращает seq последнего."""
+        seq = self.seq
+        if not changes:
+            return seq
+        lines = []
+        for id, book in changes.items():
+            seq += 1
+            lines.append(
+                json.dumps({"seq": seq, "id": id, "book": book}, ensure_ascii=False, default=dict) + "\n"
+            )
+        data = "".join(lines).encode()
+        with open(self.filename, "ab") as f:
+            if self._end != self._size:
+                # под блокировкой хвост за последней полной записью - запись,
+                # недописанная при сбое: иначе следующая запись склеится с ней
+                f.truncate(self._end)
+            f.write(data)
+        self._seq, self._size = seq, self._end + len(data)
+        self._end = self._size
+        if STATS.enabled:
+            STATS.incr("io.bytes_written", len(data))
+        return seq
+
+    def read(self, since: int, until: int) -> dict[str, dict[str] | None]:
+        """
+        Изменения с seq в (since, until]: id -> последнее состояние книги,
+        None - книга удалена. Книги идут в порядке их последнего изменения.
+        """
+        changes: dict[str, dict[str] | None] = {}
+        with open(self.filename, "rb") as f:
+            f.seek(self._offset(f, since))
+            read = 0
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # запись, которую другой процесс еще дописывает
+                    break
+                if record["seq"] > until:
+                    break
+                read += len(line)
+                changes.pop(record["id"], None)
+                changes[record["id"]] = record["book"]
+        if STATS.enabled:
+            STATS.incr("io.bytes_read", read)
+        return changes
+
+    @staticmethod
+    def _line_start(f: BinaryIO, pos: int) -> int:
+        """Начало первой записи, которая начинается не раньше pos."""
+        f.seek(max(pos - 1, 0))
+        if pos:
+            f.readline()
+        return f.tell()
+
+    def _offset(self, f: BinaryIO, since: int) -> int:
+        """Смещение первой записи с seq больше since."""
+        lo, hi = 0, os.fstat(f.fileno()).st_size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            self._line_start(f, mid)
+            line = f.readline()
+            try:
+                after = json.loads(line)["seq"] > since
+            except json.JSONDecodeError:
+                # конец файла или недописанная запись
+                after = True
+            if after:
+                hi = mid
+            else:
+                lo = mid + 1
+        return self._line_start(f, lo)
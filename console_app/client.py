@@ -0,0 +1,88 @@
+import json
+import socket
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+from . import exceptions
+from .data import BaseArchive
+
+
+class RemoteArchive(BaseArchive):
+    """
+    Архив на сервере (python -m console_app serve). Library работает с ним
+    как с обычным архивом: ввод парсится и проверяется на стороне клиента,
+    на сервер уходят только вызовы методов архива.
+    """
+
+    def __init__(self, host: str | None = None, port: int | None = None, path: str | None = None) -> None:
+        if path is not None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(path)
+        else:
+            self._socket = socket.create_connection((host, port))
+        self._file = self._socket.makefile("rwb")
+
+    def close(self) -> None:
+        self._file.close()
+        self._socket.close()
+
+    def _call(self, method: str, *args: Any) -> Any:
+        self._file.write(json.dumps({"method": method, "args": args}, ensure_ascii=False).encode() + b"\n")
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("Сервер библиотеки закрыл соединение.")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise getattr(exceptions, response["error"], exceptions.InvalidInputData)(response["message"])
+        return response["result"]
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        # группировка изменений выполняется на сервере
+        yield
+
+    def add(self, data: dict[str]) -> int:
+        return self._call("add", data)
+
+    def delete(self, id: str) -> None:
+        self._call("delete", id)
+
+    def change_status(self, id: str, new_status: str) -> int:
+        return self._call("change_status", id, new_status)
+
+    def all(self) -> dict[str, dict[str]]:
+        return self._call("all")
+
+    def iter_books(self, offset: int = 0, limit: int | None = None) -> Iterator[tuple[str, dict[str]]]:
+        return iter([(id, book) for id, book in self._call("iter_books", offset, limit)])
+
+    def field_widths(self) -> dict[str, int]:
+        return self._call("field_widths")
+
+    def search(self, filter_attr: str) -> list[tuple[str, dict[str]]]:
+        return [(id, book) for id, book in self._call("search", filter_attr)]
+
+    def books_with_status(self, status: str) -> list[tuple[str, dict[str]]]:
+        return [(id, book) for id, book in self._call("books_with_status", status)]
+
+    def copy_counts(self, title: str) -> list[tuple[str, dict[str], int, int]]:
+        return [tuple(counts) for counts in self._call("copy_counts", title)]
+
+    def search_similar(self, query: str, limit: int | None = None) -> list[tuple[str, dict[str]]]:
+        return [(id, book) for id, book in self._call("search_similar", query, limit)]
+
+    def filter_books(
+        self, conditions: dict[str, str], workers: int | None = None
+    ) -> list[tuple[str, dict[str]]]:
+        # число процессов выбирает сервер
+        return [(id, book) for id, book in self._call("filter_books", conditions)]
+
+    def get_id_scheme(self) -> str | None:
+        return self._call("get_id_scheme")
+
+    def set_id_scheme(self, name: str) -> None:
+        self._call("set_id_scheme", name)
+
+    def migrate_ids(self, gen_id: Callable[[dict[str]], str]) -> int:
+        raise exceptions.InvalidInputData("Перевод id выполняется только на сервере.")
@@ -0,0 +1,194 @@
+import re
+import shlex
+from typing import NamedTuple
+
+from .exceptions import InvalidCommand, InvalidInputData
+
+# шаблоны компилируются один раз при импорте, а не на каждый разбор ввода
+TITLE_PATTERN = re.compile(r"(?<!\S)[\w\.]+")
+YEAR_PATTERN = re.compile(r"(?<!\S)[\d]+(?!\S)")
+ID_PATTERN = re.compile(r"(?<!\S)(t[0-9]+a[0-9]+y[0-9]+(d[0-9]+)?)(?!\S)")
+STATUS_PATTERN = re.compile(r"(?<!\S)(в наличии|выдана)(?!\S)")
+
+
+def parse_value(data: str, pattern: re.Pattern) -> str | None:
+    """Значение из ввода по шаблону: группа id/статуса или все найденные слова через пробел."""
+    parsed_data = pattern.findall(data)
+    if not parsed_data:
+        return
+    match = parsed_data[0]
+    if isinstance(match, tuple):
+        return match[0]
+    return " ".join(parsed_data)
+
+
+def split_args(line: str) -> list[str]:
+    """Слова строки, значения с пробелами берутся в кавычки. Без кавычек - обычный split."""
+    if '"' not in line and "'" not in line:
+        return line.split()
+    try:
+        return shlex.split(line)
+    except ValueError as exc:
+        raise InvalidInputData(f"Не удалось разобрать строку: {exc}.") from None
+
+
+class Arg(NamedTuple):
+    prompt: str
+    # шаблон разбора значения, None - значение берется как есть
+    pattern: re.Pattern | None = None
+    # последний аргумент может забрать остаток строки: "text" - одним значением
+    # (слова через пробел), "words" - каждое слово отдельным значением
+    rest: str | None = None
+    # необязательный аргумент не запрашивается, метод берет значение по умолчанию
+    required: bool = True
+
+
+class Command(NamedTuple):
+    """
+    Команда интерактивного и пакетного режима: метод Library, метод BatchRunner
+    (None - команда есть только в интерактивном режиме) и грамматика аргументов.
+    Аргументы можно передать в строке команды, недостающие обязательные
+    запрашиваются через input(). Лишние слова забирает только последний аргумент
+    с rest, поэтому "change status t1a1y1 в наличии" и "search франц кафка"
+    работают без кавычек, а поля add с пробелами нужно брать в кавычки.
+    """
+
+    description: str
+    method: str
+    args: tuple[Arg, ...] = ()
+    batch: str | None = None
+
+    def bind(self, name: str, inline: list[str]) -> list[str]:
+        """Значения аргументов из слов строки команды, без запроса недостающих."""
+        if not self.args:
+            if inline:
+                raise InvalidInputData(f"Команда '{name}' не принимает аргументов.")
+            return []
+        if len(inline) <= len(self.args):
+            return list(inline)
+        last = len(self.args) - 1
+        if self.args[last].rest == "words":
+            return list(inline)
+        if self.args[last].rest == "text":
+            return [*inline[:last], " ".join(inline[last:])]
+        raise InvalidInputData(
+            f"Лишние аргументы команды '{name}': значения с пробелами возьмите в кавычки, "
+            'например add "Война и мир" "Лев Толстой" 1869.'
+        )
+
+    def collect(self, name: str, inline: list[str]) -> list[str]:
+        values = self.bind(name, inline)
+        for arg in self.args[len(values) :]:
+            if not arg.required:
+                break
+            value = input(arg.prompt)
+            values.extend(split_args(value) if arg.rest == "words" else [value])
+        return values
+
+    def check_count(self, name: str, values: list[str]) -> None:
+        """Без запроса недостающих (пакетный режим): все обязательные аргументы переданы."""
+        if len(values) < sum(arg.required for arg in self.args):
+            raise InvalidInputData(f"Неверное количество аргументов для команды '{name}'.")
+
+    def parse(self, values: tuple[str, ...]) -> list[str | None]:
+        """Разбирает значения аргументов по их шаблонам (без проверки на пустоту)."""
+        return [
+            value if arg.pattern is None else parse_value(value, arg.pattern)
+            for arg, value in zip(self.args, values)
+        ]
+
+
+def parse_page(offset: str | int = 0, limit: str | int | None = None) -> tuple[int, int | None]:
+    """offset и limit команды all из строки ввода."""
+    offset, limit = str(offset), (None if limit is None else str(limit))
+    if not offset.isdigit() or not (limit is None or limit.isdigit()):
+        raise InvalidInputData("offset и limit должны быть целыми числами.")
+    return int(offset), (None if limit is None else int(limit))
+
+
+BOOK_ID = Arg("Введите идентификатор книги: ", ID_PATTERN)
+
+COMMANDS: dict[str, Command] = {
+    "add": Command(
+        "Добавляет книгу в библиотеку",
+        "add_book",
+        (
+            Arg("Введите название: ", TITLE_PATTERN),
+            Arg("Введите автора: ", TITLE_PATTERN),
+            Arg("Введите год релиза: ", YEAR_PATTERN),
+        ),
+        "_add",
+    ),
+    "delete": Command("Удаляет книгу из библиотеки", "delete_book", (BOOK_ID,), "_delete"),
+    "search": Command(
+        "Поиск книги по заданному атрибуту",
+        "search",
+        (Arg("Введите название, автора или год книги: ", rest="text"),),
+        "_search",
+    ),
+    "all": Command(
+        "Посмотреть все книги в библиотеке (можно указать offset и limit)",
+        "all",
+        (Arg("Введите offset: ", required=False), Arg("Введите limit: ", required=False)),
+        "_all",
+    ),
+    "change_status": Command(
+        "Изменить статус книги в библиотеке",
+        "change_book_status",
+        # статус "в наличии" - одно значение из двух слов
+        (BOOK_ID, Arg("Введите Новый статус книги: ", STATUS_PATTERN, rest="text")),
+        "_change_status",
+    ),
+    "cmd": Command("Запросить список команд", "cmd"),
+    "leave": Command("Уйти из библиотеки. Остановить работу скрипта", "leave"),
+    "migrate_ids": Command(
+        "Перевести id книг в архиве на текущую схему генерации id", "migrate_ids", (), "_migrate_ids"
+    ),
+    "import_books": Command(
+        "Загрузить книги из csv или jsonl файла",
+        "import_books",
+        (Arg("Введите путь к файлу (csv или jsonl): ", rest="text"),),
+        "_import_books",
+    ),
+    "stats": Command("Статистика времени команд и ввода-вывода (запуск с --stats)", "stats", (), "_stats"),
+    "issued_books": Command("Посмотреть выданные книги", "issued_books", (), "_issued_books"),
+    "available_books": Command("Посмотреть книги в наличии", "available_books", (), "_available_books"),
+    "filter": Command(
+        "Книги по условиям: title=, author=, year=1900-1950, status=, text= (подстрока)",
+        "filter",
+        (Arg("Введите условия (например year=1900-1950 status=выдана): ", rest="words"),),
+        "_filter",
+    ),
+    "copies": Command(
+        "Сколько экземпляров книги в архиве и сколько из них в наличии",
+        "copies",
+        (Arg("Введите название книги: ", rest="text"),),
+        "_copies",
+    ),
+}
+
+
+def _unknown_command(name: str) -> InvalidCommand:
+    return InvalidCommand(
+        f"Неизвестная команда: '{name}'. Используйте команды из меню. Запросить меню команда 'cmd'."
+    )
+
+
+def get_command(name: str) -> Command:
+    try:
+        return COMMANDS[name]
+    except KeyError:
+        raise _unknown_command(name) from None
+
+
+def parse_command(line: str) -> tuple[str, list[str]]:
+    """
+    Имя команды и аргументы из строки ввода. Имя из двух слов
+    ("change status") ищется раньше имени из одного слова.
+    """
+    words = line.split(None, 2)
+    if len(words) >= 2 and (name := f"{words[0]}_{words[1]}".lower()) in COMMANDS:
+        return name, split_args(words[2]) if len(words) == 3 else []
+    if words and (name := words[0].lower()) in COMMANDS:
+        return name, split_args(line.split(None, 1)[1]) if len(words) > 1 else []
+    raise _unknown_command("_".join(line.lower().split()))
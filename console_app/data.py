@@ -1,50 +1,343 @@
+import atexit
+import bisect
+import gc
 import json
+import os
+import pickle
+import threading
+import time
+import weakref
+from collections.abc import Mapping
+from contextlib import contextmanager
+from enum import IntEnum
+from itertools import islice
+from typing import Any, Callable, Collection, ContextManager, Iterable, Iterator
 
-from .exceptions import DataDoesNotExists, TheSameStatus
+from .changes import ChangeLog
+from .exceptions import ArchiveLocked, DataDoesNotExists, InvalidInputData, TheSameStatus
+from .fuzzy import TrigramIndex, rank_books, top_ids
+from .scan import compile_filter, scan_books
+from .snapshot import get_snapshot_codec, read_snapshot, write_snapshot
+from .stats import STATS
 
+try:
+    import fcntl
+except ImportError:  # windows: блокировка между процессами не поддерживается
+    fcntl = None
+
+SEARCH_FIELDS = ("title", "author", "year")
+BOOK_FIELDS = ("title", "author", "year", "status")
 
-class Archive:
-    _filename = "library_storage.json"
+
+class Status(IntEnum):
+    AVAILABLE = 0
+    ISSUED = 1
 
     @property
-    def cache(self):
-        if hasattr(self, "_cache"):
-            return self._cache
+    def label(self) -> str:
+        return STATUS_LABELS[self]
+
+
+STATUS_LABELS = ("в наличии", "выдана")
+STATUSES = {label: Status(num) for num, label in enumerate(STATUS_LABELS)}
+# одинаковые годы разных книг ссылаются на один объект int
+_years: dict[str, int] = {}
+
+
+class Book(Mapping):
+    """
+    Запись книги в памяти json архива. Вместо dict на каждую книгу - слоты,
+    год хранится числом, статус - общим для всех книг членом Status.
+    Снаружи книга читается как прежний dict[str, str] и так же сериализуется.
+    """
+
+    __slots__ = ("title", "author", "year", "status")
+
+    def __init__(self, title: str, author: str, year: int | str, status: Status) -> None:
+        self.title = title
+        self.author = author
+        self.year = year
+        self.status = status
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, str]) -> "Book":
+        if isinstance(data, Book):
+            return data
+        return cls.from_values(data["title"], data["author"], data["year"], data["status"])
+
+    @classmethod
+    def from_values(cls, title: str, author: str, year: str, status: str) -> "Book":
+        """Запись из значений полей в порядке BOOK_FIELDS."""
+        if year in _years:
+            year = _years[year]
+        # год вроде "0999" числом не хранится, иначе он не восстановится как был
+        elif year.isascii() and year.isdigit() and year[0] != "0":
+            year = _years[year] = int(year)
+        return cls(title, author, year, STATUSES[status])
+
+    def to_dict(self) -> dict[str, str]:
+        return {
+            "title": self.title,
+            "author": self.author,
+            "year": str(self.year),
+            "status": STATUS_LABELS[self.status],
+        }
+
+    def __getitem__(self, field: str) -> str:
+        if field == "title":
+            return self.title
+        if field == "author":
+            return self.author
+        if field == "year":
+            return str(self.year)
+        if field == "status":
+            return STATUS_LABELS[self.status]
+        raise KeyError(field)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(BOOK_FIELDS)
+
+    def __len__(self) -> int:
+        return len(BOOK_FIELDS)
+
+    def values(self) -> tuple[str, ...]:
+        return (self.title, self.author, str(self.year), STATUS_LABELS[self.status])
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+
+def _book_to_json(book: Book) -> dict[str, str]:
+    if isinstance(book, Book):
+        return book.to_dict()
+    raise TypeError(f"Object of type {type(book).__name__} is not JSON serializable")
+
+
+class BaseArchive:
+    """
+    Правила работы архива (дубликаты, статусы) не зависят от способа хранения.
+    Хранилище реализует примитивы _get, _set, _remove, _find_dublicate,
+    _gen_actual_id, _begin, _commit, _rollback, _replace_all, _vocabulary,
+    _token_ids, а также all, search, books_with_status и copy_counts.
+    """
+
+    _filename: str
+    # глубина вложенности транзакций
+    _depth = 0
+    # сколько секунд ждать, пока архив занят другим процессом
+    lock_timeout = 10.0
+    # параметры конструктора хранилища, Library передает только их
+    OPTIONS: tuple[str, ...] = ()
+
+    @staticmethod
+    def _split_id(id: str) -> tuple[str, int | None]:
+        """Разбивает id на id оригинала и порядковый номер дубликата."""
+        base_id, sep, num = id.rpartition("d")
+        if sep and num.isdigit():
+            return base_id, int(num)
+        return id, None
+
+    @staticmethod
+    def _search_keys(values: Iterable[str]) -> tuple[set[str], set[str]]:
+        """
+        Принимает значения полей SEARCH_FIELDS, возвращает их точные значения
+        и слова из них для поискового индекса.
+        """
+        values = {value.casefold() for value in values}
+        tokens = {token for value in values for token in value.split()}
+        return values, tokens
+
+    def _get(self, id: str) -> dict[str] | None:
+        raise NotImplementedError
+
+    def _set(self, id: str, book: dict[str]) -> None:
+        raise NotImplementedError
+
+    def _remove(self, id: str) -> None:
+        raise NotImplementedError
+
+    def _find_dublicate(self, id: str) -> str | None:
+        """Возвращает id последнего дубликата книги, если он есть."""
+        raise NotImplementedError
+
+    def _gen_actual_id(self, income_data_id: str) -> str:
+        """Возвращает id для следующего дубликата книги."""
+        raise NotImplementedError
+
+    def _begin(self) -> None:
+        raise NotImplementedError
+
+    def _commit(self) -> None:
+        raise NotImplementedError
+
+    def _rollback(self) -> None:
+        raise NotImplementedError
+
+    @contextmanager
+    def _savepoint(self) -> Iterator[None]:
+        """Откат одной вложенной команды, если хранилище это умеет."""
+        yield
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """
+        Одна команда - одна транзакция: изменения сохраняются по её завершению.
+        Вложенные транзакции (команды внутри batch) сохраняются вместе с внешней.
+        """
+        if self._depth:
+            self._depth += 1
+            try:
+                with self._savepoint():
+                    yield
+            finally:
+                self._depth -= 1
+            return
+        self._begin()
+        self._depth = 1
         try:
-            self._cache = self._load()
-            return self._cache
+            yield
+        except BaseException:
+            self._depth = 0
+            self._rollback()
+            raise
+        self._depth = 0
+        self._commit()
+
+    def batch(self) -> ContextManager[None]:
+        """Все команды внутри блока сохраняются один раз, при выходе из него."""
+        return self._transaction()
+
+    def flush(self) -> None:
+        """Сохраняет отложенные изменения, если хранилище их откладывает."""
+
+    @property
+    def _id_scheme_filename(self) -> str:
+        return f"{self._filename}.ids"
+
+    def get_id_scheme(self) -> str | None:
+        """Схема id книг архива (см. ids.py), None - архив создан до того, как схема стала храниться."""
+        try:
+            with open(self._id_scheme_filename) as f:
+                return f.read().strip()
         except FileNotFoundError:
-            self.refresh({})
-            self._cache = self._load()
-            return self._cache
+            return None
 
-    def clean_cache(self):
-        delattr(self, "_cache")
+    def set_id_scheme(self, name: str) -> None:
+        """Записывает схему id архива: после migrate_ids и перед первой книгой нового архива."""
+        tmp_filename = f"{self._id_scheme_filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, "w") as f:
+            f.write(f"{name}\n")
+        os.replace(tmp_filename, self._id_scheme_filename)
 
-    def refresh(self, storage_data: dict[str, dict[str]]) -> None:
-        self._dump(storage_data)
+    def export(self, path: str, codec: str = "pretty") -> None:
+        """Выгружает весь архив в файл в формате codec (по умолчанию json с отступами)."""
+        with open(path, "wb") as f:
+            write_snapshot(self.all(), f, codec)
 
-    def _load(self) -> dict[str, dict[str]]:
-        with open(self._filename, "r") as f:
-            return json.load(f)
+    def export_changes(self, since: int = 0) -> dict[str, Any]:
+        """
+        Изменения архива после контрольной точки since (seq из прошлой выгрузки,
+        0 - все книги архива): {"since": since, "seq": seq последнего изменения,
+        "changes": {id: книга или None, если книга удалена}}.
+        """
+        # шарды ведут свои журналы со своими seq, общей контрольной точки у них нет
+        raise InvalidInputData(
+            f"Журнал изменений ведет только json архив, а не {type(self).__name__}: "
+            "для резервной копии используйте export."
+        )
 
-    def _dump(self, data: dict[str]) -> None:
-        with open(self._filename, "w") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    def apply_changes(self, changes: Mapping[str, dict[str] | None]) -> int:
+        """
+        Применяет "changes" из export_changes другого архива (резервная копия,
+        реплика) одной транзакцией. Возвращает количество измененных книг.
+        """
 
-    def _find_dublicate(self, id: str) -> list[str]:
-        storage_data = self.cache
-        dublicate = list(filter(lambda key: f"{id}d" in key, storage_data))
-        dublicate.sort()
-        return dublicate
+        def order(item: tuple[str, dict[str] | None]) -> tuple[bool, bool]:
+            # удаляем сначала дубликаты, добавляем сначала оригиналы
+            is_dublicate = self._split_id(item[0])[1] is not None
+            return (True, is_dublicate) if item[1] is not None else (False, not is_dublicate)
 
-    @staticmethod
-    def _gen_actual_id(income_data_id: str, dublicate: str) -> str:
-        if not dublicate:
-            return f"{income_data_id}d1"
-        last_dublicate = dublicate.pop()
-        actual_num = int(last_dublicate.split("d")[-1]) + 1
-        return f"{income_data_id}d{actual_num}"
+        applied = 0
+        with self._transaction():
+            for id, book in sorted(changes.items(), key=order):
+                current = self._get(id)
+                if book is None:
+                    if current is not None:
+                        self._remove(id)
+                        applied += 1
+                elif current is None or dict(current) != book:
+                    self._set(id, book)
+                    applied += 1
+        return applied
+
+    def __enter__(self) -> "BaseArchive":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+
+    def _replace_all(self, storage_data: dict[str, dict[str]]) -> None:
+        raise NotImplementedError
+
+    def all(self) -> dict[str, dict[str]]:
+        raise NotImplementedError
+
+    def iter_books(self, offset: int = 0, limit: int | None = None) -> Iterator[tuple[str, dict[str]]]:
+        """Постранично отдает оригиналы книг, не собирая весь архив в памяти."""
+        raise NotImplementedError
+
+    def field_widths(self) -> dict[str, int]:
+        """Максимальная длина id и каждого поля среди оригиналов книг."""
+        raise NotImplementedError
+
+    def search(self, filter_attr: str) -> list[tuple[str, dict[str]]]:
+        """
+        Поиск оригиналов книг по title, author или year.
+        Сначала идут книги, у которых поле совпадает с запросом целиком,
+        затем книги, в полях которых встречаются все слова запроса.
+        """
+        raise NotImplementedError
+
+    def books_with_status(self, status: str) -> list[tuple[str, dict[str]]]:
+        """Оригиналы книг с заданным статусом, в порядке архива."""
+        raise NotImplementedError
+
+    def copy_counts(self, title: str) -> list[tuple[str, dict[str], int, int]]:
+        """
+        Книги с названием title (без учета регистра), по id:
+        (id оригинала, книга, всего экземпляров, экземпляров в наличии).
+        Экземпляры - оригинал и его дубликаты.
+        """
+        raise NotImplementedError
+
+    def _vocabulary(self) -> TrigramIndex:
+        """Триграммный индекс всех слов из полей SEARCH_FIELDS оригиналов."""
+        raise NotImplementedError
+
+    def _token_ids(self, token: str) -> Collection[str]:
+        """Id оригиналов, в полях которых есть слово token (с быстрой проверкой in)."""
+        raise NotImplementedError
+
+    def search_similar(self, query: str, limit: int | None = None) -> list[tuple[str, dict[str]]]:
+        """
+        Поиск оригиналов по началу слова, подстроке и с опечатками.
+        Книги отсортированы по убыванию сходства с запросом (fuzzy.rank_books),
+        limit - сколько лучших книг вернуть.
+        """
+        words = query.casefold().split()
+        if not words:
+            return []
+        scores = rank_books(self._vocabulary(), words, self._token_ids)
+        return [(id, self._get(id)) for id in top_ids(scores, limit)]
+
+    def filter_books(
+        self, conditions: Mapping[str, str], workers: int | None = None
+    ) -> list[tuple[str, dict[str]]]:
+        """
+        Оригиналы книг, подходящие под все условия (см. scan.compile_filter),
+        в порядке архива. Большой архив проверяется в workers процессах.
+        """
+        return scan_books(list(self.iter_books()), compile_filter(conditions), workers)
 
     def add(self, data: dict[str]) -> int:
         """
@@ -53,18 +346,16 @@ class Archive:
         Если книга есть в архиве, добавляется дубликат с актуальным индексом.
         """
         income_data_id = tuple(data.keys())[0]
-        storage_data = self.cache
         answer = 2
-        if income_data_id in storage_data and storage_data[income_data_id]["status"] == "выдана":
-            storage_data[income_data_id]["status"] = "в наличии"
-            answer = 1
-        if income_data_id in storage_data:
-            dublicate = self._find_dublicate(income_data_id)
-            id = self._gen_actual_id(income_data_id, dublicate)
-            data = {id: data[income_data_id]}
-        storage_data.update(data)
-        self.clean_cache()
-        self.refresh(storage_data)
+        id = income_data_id
+        with self._transaction():
+            book = self._get(income_data_id)
+            if book is not None and book["status"] == "выдана":
+                self._set(income_data_id, {**book, "status": "в наличии"})
+                answer = 1
+            if book is not None:
+                id = self._gen_actual_id(income_data_id)
+            self._set(id, data[income_data_id])
         return answer
 
     def delete(self, id: int) -> None:
@@ -74,22 +365,43 @@ class Archive:
         Если книга есть и id книги ссылается на оригинал - удаляется дублик,
         если он имеется. Если нет - удаляется оригинал.
         """
-        storage_data = self.cache
-        if id not in storage_data:
-            raise DataDoesNotExists(f"Книги с id: {id} в архиве нет.")
-        if "d" not in id:
-            if dublicate := self._find_dublicate(id):
-                id = dublicate[-1]
-        del storage_data[id]
-        self.clean_cache()
-        self.refresh(storage_data)
+        with self._transaction():
+            if self._get(id) is None:
+                raise DataDoesNotExists(f"Книги с id: {id} в архиве нет.")
+            if "d" not in id:
+                if dublicate := self._find_dublicate(id):
+                    id = dublicate
+            self._remove(id)
 
-    def all(self) -> dict[str, dict[str]]:
-        return self.cache
+    def migrate_ids(self, gen_id: Callable[[dict[str]], str]) -> int:
+        """
+        Переводит id всех книг на новую схему генерации id.
+        Оригинал получает новый id, его дубликаты перенумеровываются по порядку.
+        Возвращает количество книг, у которых изменился id.
+        """
+        storage_data = self.all()
 
-    def _check_status(self, id: str, new_status: str) -> None:
-        storage_data = self.cache
-        if storage_data[id]["status"].lower() == new_status.lower():
+        def order(id: str) -> tuple[str, int]:
+            base_id, num = self._split_id(id)
+            return base_id, num or 0
+
+        migrated = {}
+        dublicate_count = {}
+        changed = 0
+        for id in sorted(storage_data, key=order):
+            book = storage_data[id]
+            new_id = gen_id({"t": book["title"], "a": book["author"], "y": book["year"]})
+            if new_id in migrated:
+                dublicate_count[new_id] = dublicate_count.get(new_id, 0) + 1
+                new_id = f"{new_id}d{dublicate_count[new_id]}"
+            migrated[new_id] = book
+            changed += new_id != id
+        if changed:
+            self._replace_all(migrated)
+        return changed
+
+    def _check_status(self, book: dict[str], new_status: str) -> None:
+        if book["status"].lower() == new_status.lower():
             raise TheSameStatus("Книга уже имеет этот статус.")
 
     def change_status(self, id: str, new_status: str) -> int:
@@ -100,22 +412,675 @@ class Archive:
         Если книги нет в архиве - ошибка.
         Если новый статус == старому - метод прерывается.
         """
-        storage_data = self.cache
-        if id not in storage_data:
-            raise DataDoesNotExists(f"Книги с id: {id} в архиве нет.")
-
-        self._check_status(id, new_status)
-        if "d" not in id:
-            if dublicate := self._find_dublicate(id):
-                dublicate_id = dublicate[-1]
-                del storage_data[dublicate_id]
-                answer = 0
+        with self._transaction():
+            book = self._get(id)
+            if book is None:
+                raise DataDoesNotExists(f"Книги с id: {id} в архиве нет.")
+
+            self._check_status(book, new_status)
+            if "d" not in id:
+                if dublicate := self._find_dublicate(id):
+                    self._remove(dublicate)
+                    answer = 0
+                else:
+                    self._set(id, {**book, "status": new_status})
+                    answer = 1
             else:
-                storage_data[id]["status"] = new_status
-                answer = 1
-        else:
-            del storage_data[id]
-            answer = 2
-        self.clean_cache()
-        self.refresh(storage_data)
+                self._remove(id)
+                answer = 2
         return answer
+
+
+class FileLockMixin:
+    """
+    Блокировка файлового архива на запись (fcntl.flock на файле <архив>.lock).
+    Читатели блокировку не берут, поэтому хранилище должно менять файлы так,
+    чтобы читатель не увидел их в промежуточном состоянии.
+    """
+
+    _filename: str
+    _lock_depth = 0
+    lock_timeout: float
+
+    @property
+    def _lock_filename(self) -> str:
+        return f"{self._filename}.lock"
+
+    def _acquire_lock(self) -> None:
+        """Блокировка записи между процессами, повторный вызов в том же процессе не ждет."""
+        self._lock_depth += 1
+        if self._lock_depth > 1 or fcntl is None:
+            return
+        self._lock_file = open(self._lock_filename, "a")
+        deadline = time.monotonic() + self.lock_timeout
+        while True:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    self._lock_file.close()
+                    self._lock_depth -= 1
+                    raise ArchiveLocked(
+                        "Архив занят другим процессом, попробуйте повторить команду позже."
+                    ) from None
+                time.sleep(0.01)
+
+    def _release_lock(self) -> None:
+        self._lock_depth -= 1
+        if self._lock_depth or fcntl is None:
+            return
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        self._acquire_lock()
+        try:
+            yield
+        finally:
+            self._release_lock()
+
+
+# архивы с отложенной записью, которые сохраняются при выходе из интерпретатора;
+# слабые ссылки не держат в памяти архивы, которые больше не используются
+_write_behind_archives: "weakref.WeakSet[Archive]" = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_write_behind() -> None:
+    for archive in list(_write_behind_archives):
+        archive.flush()
+
+
+class Archive(FileLockMixin, BaseArchive):
+    _filename = "library_storage.json"
+    # через сколько секунд сохраняется отложенная запись, если задан только flush_every:
+    # без срока блокировка архива держалась бы до flush_every-й команды
+    default_flush_delay = 1.0
+    OPTIONS = ("journal", "flush_delay", "flush_every", "codec", "fast_start")
+    # после какого размера журнала (в байтах) он сливается в снапшот
+    journal_max_bytes = 4 * 1024 * 1024
+    # версия формата файла быстрого старта, меняется вместе с Book и индексами
+    FAST_START_VERSION = 1
+    FAST_START_INDEXES = (
+        "_dublicates",
+        "_search_values",
+        "_search_tokens",
+        "_statuses",
+        "_issued_dublicates",
+        "_widths",
+    )
+
+    def __init__(
+        self,
+        journal: bool = False,
+        flush_delay: float | None = None,
+        flush_every: int | None = None,
+        codec: str = "json",
+        fast_start: bool = False,
+    ) -> None:
+        """
+        journal - режим журналирования: изменения дописываются в журнал
+        рядом со снапшотом, а не перезаписывают весь json файл.
+        flush_delay, flush_every - отложенная запись: команды меняют только
+        кеш, а на диск изменения уходят одной записью через flush_delay секунд
+        после первой несохраненной команды или после flush_every команд.
+        Без flush_delay срок - default_flush_delay.
+        При сбое теряется не больше этого окна. Пока есть несохраненные
+        изменения, архив остается заблокирован для других процессов.
+        codec - формат, в котором пишется снапшот (см. snapshot.SNAPSHOT_CODECS).
+        Читается снапшот в любом формате, формат определяется по содержимому.
+        fast_start - хранить рядом со снапшотом pickle загруженных книг и индексов
+        (<архив>.fast): следующий запуск читает его вместо разбора снапшота
+        и построения индексов, пока снапшот не изменился.
+        """
+        get_snapshot_codec(codec)
+        self.fast_start = fast_start
+        self.codec = codec
+        self.journal = journal
+        if flush_every is not None and flush_delay is None:
+            flush_delay = self.default_flush_delay
+        self.flush_delay = flush_delay
+        self.flush_every = flush_every
+        self._pending = {}
+        # команды, изменения которых еще не сохранены на диск
+        self._unflushed = 0
+        self._flush_timer = None
+        self._mutex = threading.RLock()
+        self._journal_size = 0
+        self._lock_depth = 0
+        self._snapshot_base = None
+        if self.write_behind:
+            _write_behind_archives.add(self)
+
+    @property
+    def write_behind(self) -> bool:
+        return self.flush_delay is not None or self.flush_every is not None
+
+    @property
+    def _journal_filename(self) -> str:
+        return f"{self._filename}.log"
+
+    @property
+    def cache(self):
+        """
+        Кеш остается валидным между командами: изменения вносятся в него
+        на месте. Архив перечитывается с диска только если файл изменили
+        извне (сверяется inode, mtime и размер снапшота и журнала).
+        """
+        with self._mutex:
+            if hasattr(self, "_cache") and (
+                self._unflushed or self._cache_signature == self._signature()
+            ):
+                # пока есть несохраненные изменения, архив заблокирован нами
+                if STATS.enabled:
+                    STATS.incr("cache.hit")
+                return self._cache
+            if STATS.enabled:
+                STATS.incr("cache.reload" if hasattr(self, "_cache") else "cache.miss")
+            # загрузка создает миллионы объектов без циклов, сборщик только замедляет ее
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                self._cache = self._load()
+            except FileNotFoundError:
+                with self._locked():
+                    if not os.path.exists(self._filename):
+                        self.refresh({})
+                self._cache = self._load()
+            finally:
+                if gc_enabled:
+                    gc.enable()
+            # подпись тех версий файлов, которые прочитал _load: os.stat после загрузки
+            # мог бы приписать старым книгам снапшот, записанный другим процессом во время разбора
+            self._cache_signature = self._loaded_signature
+            return self._cache
+
+    def clean_cache(self):
+        """
+        Следующее обращение к кешу перечитает архив с диска и заново построит индексы.
+        Отложенные изменения сначала сохраняются, иначе они потерялись бы.
+        """
+        with self._mutex:
+            self.flush()
+            self._cache_signature = None
+
+    @staticmethod
+    def _stat_key(stat: os.stat_result) -> tuple[int, int, int]:
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _signature(self) -> tuple:
+        signature = [self._filename]
+        for filename in (self._filename, self._journal_filename):
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                signature.append(None)
+            else:
+                signature.append(self._stat_key(stat))
+        return tuple(signature)
+
+    def refresh(self, storage_data: dict[str, dict[str]]) -> None:
+        self._dump(storage_data)
+        self._truncate_journal()
+
+    def compact(self) -> None:
+        """Сливает журнал в снапшот и очищает журнал."""
+        with self._mutex, self._locked():
+            self.refresh(self.cache)
+            self._cache_signature = self._signature()
+
+    @staticmethod
+    def _base(stat: os.stat_result) -> list[int]:
+        # снапшот заменяется через os.replace, поэтому у каждой версии свой inode
+        return [stat.st_ino, stat.st_mtime_ns]
+
+    def _load(self) -> dict[str, dict[str]]:
+        """
+        Книги снапшота с журналом и построенные по ним индексы. Подпись
+        прочитанных версий снапшота и журнала сохраняется в _loaded_signature.
+        """
+        loaded = self._read_fast_start() if self.fast_start else None
+        if loaded is None:
+            with open(self._filename, "rb") as f:
+                stat = os.fstat(f.fileno())
+                storage_data = read_snapshot(f, BOOK_FIELDS, Book.from_values)
+                if STATS.enabled:
+                    STATS.incr("io.bytes_read", f.tell())
+            self._snapshot_base = self._base(stat)
+            self._build_indexes(storage_data)
+            if self.fast_start:
+                self._write_fast_start(storage_data, stat)
+        else:
+            storage_data, stat = loaded
+        journal = self._replay_journal(storage_data)
+        self._loaded_signature = (self._filename, self._stat_key(stat), journal)
+        return storage_data
+
+    @property
+    def _fast_start_filename(self) -> str:
+        return f"{self._filename}.fast"
+
+    def _fast_start_key(self, stat: os.stat_result) -> tuple:
+        return (self.FAST_START_VERSION, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _read_fast_start(self) -> tuple[dict[str, dict[str]], os.stat_result] | None:
+        """
+        Книги и индексы снапшота из файла быстрого старта, если он построен
+        для текущей версии снапшота, и stat этой версии. Журнал в нем не учтен.
+        """
+        try:
+            stat = os.stat(self._filename)
+            f = open(self._fast_start_filename, "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            if not self._trusted(os.fstat(f.fileno())):
+                return None
+            try:
+                # ключ идет отдельным pickle в начале: устаревший файл дальше не читается
+                if pickle.load(f) != self._fast_start_key(stat):
+                    return None
+                storage_data, *indexes = pickle.load(f)
+            except (pickle.UnpicklingError, EOFError, ValueError):
+                return None
+            if STATS.enabled:
+                STATS.incr("io.bytes_read", f.tell())
+        for name, index in zip(self.FAST_START_INDEXES, indexes):
+            setattr(self, name, index)
+        self._trigrams = None
+        self._snapshot_base = self._base(stat)
+        return storage_data, stat
+
+    @staticmethod
+    def _trusted(stat: os.stat_result) -> bool:
+        """
+        pickle выполняет код при чтении, поэтому файл быстрого старта читается,
+        только если его записал этот же пользователь и другие не могут его менять.
+        """
+        if not hasattr(os, "getuid"):
+            return True
+        return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+    def _write_fast_start(self, storage_data: dict[str, dict[str]], stat: os.stat_result) -> None:
+        tmp_filename = f"{self._fast_start_filename}.{os.getpid()}.tmp"
+        state = (storage_data, *(getattr(self, name) for name in self.FAST_START_INDEXES))
+        # права только у владельца, независимо от umask
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "wb") as f:
+            pickle.dump(self._fast_start_key(stat), f)
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            if STATS.enabled:
+                STATS.incr("io.bytes_written", f.tell())
+        os.replace(tmp_filename, self._fast_start_filename)
+
+    def _replay_journal(self, storage_data: dict[str, dict[str]]) -> tuple[int, int, int] | None:
+        """
+        Накатывает журнал поверх снапшота. Журнал читается всегда,
+        даже если режим journal выключен, чтобы не потерять изменения.
+        Журнал, начатый для другой версии снапшота, пропускается.
+        Возвращает подпись прочитанного журнала, None - журнала нет.
+        """
+        self._journal_size = 0
+        try:
+            f = open(self._journal_filename, "r")
+        except FileNotFoundError:
+            return None
+        with f:
+            # до чтения: записи, дописанные во время чтения, сменят подпись файла
+            signature = self._stat_key(os.fstat(f.fileno()))
+            size = 0
+            for line in f:
+                try:
+                    record = json.loads(line) if line.endswith("\n") else None
+                except json.JSONDecodeError:
+                    record = None
+                if record is None:
+                    # недописанная запись в конце журнала, ее отрезает следующая запись
+                    break
+                size += len(line.encode())
+                if "snapshot" in record:
+                    if record["snapshot"] != self._snapshot_base:
+                        return signature
+                    continue
+                # индексы уже построены по снапшоту, записи журнала обновляют их
+                id = record["id"]
+                old = storage_data.get(id)
+                if old is not None:
+                    self._unindex_book(id, old)
+                if record["book"] is None:
+                    storage_data.pop(id, None)
+                else:
+                    book = storage_data[id] = Book.from_dict(record["book"])
+                    self._index_book(id, book)
+            self._journal_size = size
+            if STATS.enabled:
+                STATS.incr("io.bytes_read", size)
+        return signature
+
+    def _append_journal(self, changes: dict[str, dict[str] | None]) -> None:
+        lines = "".join(
+            json.dumps({"id": id, "book": book}, ensure_ascii=False, default=_book_to_json) + "\n"
+            for id, book in changes.items()
+        )
+        mode = "a"
+        if not self._journal_size:
+            # новый журнал (или журнал от старого снапшота) начинается заново
+            lines = json.dumps({"snapshot": self._snapshot_base}) + "\n" + lines
+            mode = "w"
+        with open(self._journal_filename, mode) as f:
+            # журнал пишется под блокировкой архива, а _journal_size прочитан под ней же:
+            # хвост за ним - запись, недописанная при сбое, иначе новые записи встали бы
+            # после нее и при загрузке не читались
+            if mode == "a" and os.fstat(f.fileno()).st_size != self._journal_size:
+                f.truncate(self._journal_size)
+            f.write(lines)
+        written = len(lines.encode())
+        self._journal_size += written
+        if STATS.enabled:
+            STATS.incr("io.bytes_written", written)
+
+    @property
+    def _changelog(self) -> ChangeLog:
+        filename = f"{self._filename}.changes"
+        if getattr(self, "_changes", None) is None or self._changes.filename != filename:
+            self._changes = ChangeLog(filename)
+        return self._changes
+
+    def _log_changes(self, changes: Mapping[str, dict[str] | None]) -> None:
+        """
+        Дописывает сохраненные изменения в журнал изменений. Журнал заводит
+        первый export_changes, до этого архив его не ведет.
+        """
+        changelog = self._changelog
+        if changelog.exists():
+            changelog.append(changes)
+
+    def _truncate_journal(self) -> None:
+        if os.path.exists(self._journal_filename):
+            os.remove(self._journal_filename)
+        self._journal_size = 0
+
+    def _dump(self, data: dict[str]) -> None:
+        # пишем во временный файл и атомарно подменяем снапшот,
+        # чтобы читатели никогда не видели недописанный файл
+        tmp_filename = f"{self._filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, "wb") as f:
+            write_snapshot(data, f, self.codec)
+            f.flush()
+            os.fsync(f.fileno())
+            if STATS.enabled:
+                STATS.incr("io.bytes_written", f.tell())
+        os.replace(tmp_filename, self._filename)
+        self._snapshot_base = self._base(os.stat(self._filename))
+
+    def _build_indexes(self, storage_data: dict[str, dict[str]]) -> None:
+        # id оригинала -> отсортированные номера его дубликатов
+        self._dublicates = {}
+        # значение поля / слово из поля -> id оригиналов
+        self._search_values = {}
+        self._search_tokens = {}
+        # триграммы слов из _search_tokens, строится при первом search_similar
+        self._trigrams = None
+        # статус -> id оригиналов с этим статусом, dict хранит порядок добавления
+        self._statuses = {label: {} for label in STATUS_LABELS}
+        # id оригинала -> сколько его дубликатов выдано, обычно дубликаты в наличии
+        self._issued_dublicates = {}
+        # максимальная длина полей, при удалении книг не уменьшается
+        self._widths = dict.fromkeys(("id", *BOOK_FIELDS), 0)
+        for id, book in storage_data.items():
+            self._index_book(id, book)
+
+    def _index_book(self, id: str, book: dict[str]) -> None:
+        base_id, num = self._split_id(id)
+        if num is not None:
+            bisect.insort(self._dublicates.setdefault(base_id, []), num)
+            if book.status is Status.ISSUED:
+                self._issued_dublicates[base_id] = self._issued_dublicates.get(base_id, 0) + 1
+            return
+        widths = self._widths
+        widths["id"] = max(widths["id"], len(id))
+        title, author, year, status = book.values()
+        self._statuses[status][id] = None
+        for field, value in zip(BOOK_FIELDS, (title, author, year, status)):
+            widths[field] = max(widths[field], len(value))
+        values, tokens = self._search_keys((title, author, year))
+        for value in values:
+            self._search_values.setdefault(value, set()).add(id)
+        for token in tokens:
+            ids = self._search_tokens.get(token)
+            if ids is None:
+                ids = self._search_tokens[token] = set()
+                if self._trigrams is not None:
+                    self._trigrams.add(token)
+            ids.add(id)
+
+    def _unindex_book(self, id: str, book: dict[str]) -> None:
+        base_id, num = self._split_id(id)
+        if num is not None:
+            nums = self._dublicates[base_id]
+            del nums[bisect.bisect_left(nums, num)]
+            if not nums:
+                del self._dublicates[base_id]
+            if book.status is Status.ISSUED:
+                self._issued_dublicates[base_id] -= 1
+                if not self._issued_dublicates[base_id]:
+                    del self._issued_dublicates[base_id]
+            return
+        del self._statuses[book.status.label][id]
+        values, tokens = self._search_keys((book.title, book.author, str(book.year)))
+        for index, keys in ((self._search_values, values), (self._search_tokens, tokens)):
+            for key in keys:
+                index[key].discard(id)
+                if not index[key]:
+                    del index[key]
+                    if index is self._search_tokens and self._trigrams is not None:
+                        self._trigrams.discard(key)
+
+    def _get(self, id: str) -> dict[str] | None:
+        return self._cache.get(id)
+
+    def _set(self, id: str, book: dict[str]) -> None:
+        book = Book.from_dict(book)
+        if id in self._cache:
+            self._unindex_book(id, self._cache[id])
+        self._index_book(id, book)
+        self._cache[id] = book
+        self._pending[id] = book
+
+    def _remove(self, id: str) -> None:
+        self._unindex_book(id, self._cache.pop(id))
+        self._pending[id] = None
+
+    def _begin(self) -> None:
+        # фоновая запись не должна сохранять кеш посреди команды
+        self._mutex.acquire()
+        try:
+            self._acquire_lock()
+        except BaseException:
+            self._mutex.release()
+            raise
+        try:
+            # другой процесс мог изменить архив, пока мы ждали блокировку
+            self.cache
+        except BaseException:
+            self._release_lock()
+            self._mutex.release()
+            raise
+
+    def _rollback(self) -> None:
+        # изменения в кеше не откатываются, поэтому сохраняем то, что успели внести
+        self._commit()
+
+    def _commit(self) -> None:
+        """
+        Сохраняет накопленные изменения. В режиме journal изменения
+        дописываются в журнал, иначе перезаписывается весь снапшот.
+        """
+        try:
+            if not self._pending:
+                return
+            if not self.write_behind:
+                self._persist()
+                return
+            if not self._unflushed:
+                # блокировка удерживается до сохранения отложенных изменений
+                self._acquire_lock()
+                if self.flush_delay is not None:
+                    self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+            self._unflushed += 1
+            if self.flush_every is not None and self._unflushed >= self.flush_every:
+                self.flush()
+        finally:
+            self._release_lock()
+            self._mutex.release()
+
+    def _persist(self) -> None:
+        if self.journal:
+            self._append_journal(self._pending)
+            if self._journal_size >= self.journal_max_bytes:
+                self.compact()
+        else:
+            self.refresh(self._cache)
+        self._log_changes(self._pending)
+        self._pending.clear()
+        self._cache_signature = self._signature()
+
+    def flush(self) -> None:
+        """Сохраняет отложенные изменения и снимает блокировку архива."""
+        with self._mutex:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._unflushed:
+                return
+            try:
+                self._persist()
+            finally:
+                self._unflushed = 0
+                self._release_lock()
+
+    def _replace_all(self, storage_data: dict[str, dict[str]]) -> None:
+        storage_data = {id: Book.from_dict(book) for id, book in storage_data.items()}
+        self.flush()
+        with self._mutex, self._locked():
+            logged = self._changelog.exists()
+            previous = self.cache if logged else {}
+            self.refresh(storage_data)
+            self._cache = storage_data
+            self._cache_signature = self._signature()
+            self._build_indexes(storage_data)
+            if logged:
+                changes = {id: None for id in previous if id not in storage_data}
+                changes.update((id, book) for id, book in storage_data.items() if previous.get(id) != book)
+                self._log_changes(changes)
+
+    @property
+    def seq(self) -> int:
+        """seq последнего сохраненного изменения архива - контрольная точка для export_changes."""
+        return self._changelog.seq
+
+    def export_changes(self, since: int = 0) -> dict[str, Any]:
+        with self._mutex:
+            # отложенные изменения попадают в журнал изменений только при записи
+            self.flush()
+            changelog = self._changelog
+            if not changelog.exists():
+                # журнал начинается со всех книг архива: выгрузка с since=0 - полная копия
+                with self._locked():
+                    if not changelog.exists():
+                        open(changelog.filename, "ab").close()
+                        changelog.append(self.cache)
+            seq = changelog.seq
+        if since > seq:
+            raise InvalidInputData(
+                f"Контрольная точка {since} новее последнего изменения архива ({seq})."
+            )
+        changes = changelog.read(since, seq) if since < seq else {}
+        return {"since": since, "seq": seq, "changes": changes}
+
+    def _find_dublicate(self, id: str) -> str | None:
+        if nums := self._dublicates.get(id):
+            return f"{id}d{nums[-1]}"
+        return None
+
+    def _gen_actual_id(self, income_data_id: str) -> str:
+        nums = self._dublicates.get(income_data_id)
+        actual_num = nums[-1] + 1 if nums else 1
+        return f"{income_data_id}d{actual_num}"
+
+    def all(self) -> dict[str, dict[str]]:
+        return self.cache
+
+    def iter_books(self, offset: int = 0, limit: int | None = None) -> Iterator[tuple[str, dict[str]]]:
+        storage_data = self.cache
+        # дубликатов обычно мало: проще собрать их id, чем разбирать id каждой книги
+        dublicate_ids = {
+            f"{base_id}d{num}" for base_id, nums in self._dublicates.items() for num in nums
+        }
+        if dublicate_ids:
+            originals = (item for item in storage_data.items() if item[0] not in dublicate_ids)
+        else:
+            originals = iter(storage_data.items())
+        stop = None if limit is None else offset + limit
+        return islice(originals, offset, stop)
+
+    def field_widths(self) -> dict[str, int]:
+        self.cache
+        return dict(self._widths)
+
+    def books_with_status(self, status: str) -> list[tuple[str, dict[str]]]:
+        storage_data = self.cache
+        return [(id, storage_data[id]) for id in self._statuses.get(status, ())]
+
+    def copy_counts(self, title: str) -> list[tuple[str, dict[str], int, int]]:
+        storage_data = self.cache
+        query = title.casefold().strip()
+        # по значению полей находятся и книги, у которых query - автор или год
+        counts = []
+        for id in sorted(self._search_values.get(query, ())):
+            book = storage_data[id]
+            if book.title.casefold() != query:
+                continue
+            dublicates = len(self._dublicates.get(id, ()))
+            available = dublicates - self._issued_dublicates.get(id, 0) + (book.status is Status.AVAILABLE)
+            counts.append((id, book, dublicates + 1, available))
+        return counts
+
+    def filter_books(
+        self, conditions: Mapping[str, str], workers: int | None = None
+    ) -> list[tuple[str, dict[str]]]:
+        # список всех книг строится без цикла на python, дубликаты отбрасываются из результата
+        found = scan_books(list(self.cache.items()), compile_filter(conditions), workers)
+        if not self._dublicates:
+            return found
+        return [item for item in found if self._split_id(item[0])[1] is None]
+
+    def _vocabulary(self) -> TrigramIndex:
+        self.cache
+        if self._trigrams is None:
+            self._trigrams = TrigramIndex(self._search_tokens)
+        return self._trigrams
+
+    def _token_ids(self, token: str) -> Collection[str]:
+        return self._search_tokens.get(token, set())
+
+    def _search_ids(self, filter_attr: str) -> tuple[set[str], set[str]]:
+        """Id книг, у которых поле совпадает с запросом, и id книг со всеми словами запроса."""
+        self.cache
+        query = filter_attr.casefold().strip()
+        exact = self._search_values.get(query, set())
+        token_sets = [self._search_tokens.get(token, set()) for token in query.split()]
+        if token_sets:
+            token_sets.sort(key=len)
+            partial = set.intersection(*token_sets) - exact
+        else:
+            partial = set()
+        return exact, partial
+
+    def search(self, filter_attr: str) -> list[tuple[str, dict[str]]]:
+        storage_data = self.cache
+        return [(id, storage_data[id]) for ids in self._search_ids(filter_attr) for id in sorted(ids)]
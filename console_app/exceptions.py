@@ -29,3 +29,9 @@ class TheSameStatus(Exception):
     """
 
     pass
+
+
+class ArchiveLocked(Exception):
+    """Вызывается когда архив слишком долго занят другим процессом."""
+
+    pass
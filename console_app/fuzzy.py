@@ -0,0 +1,153 @@
+import heapq
+import math
+from collections import Counter
+from operator import itemgetter
+from typing import Callable, Collection, Iterable
+
+# минимальное сходство слов по триграммам, как в pg_trgm
+SIMILARITY_THRESHOLD = 0.3
+# в более коротких словах опечатка делает похожими слишком много слов
+FUZZY_MIN_LENGTH = 4
+
+
+def trigrams(word: str) -> set[str]:
+    """Триграммы слова, дополненного пробелами: два в начале, один в конце."""
+    padded = f"  {word} "
+    return {padded[pos : pos + 3] for pos in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """
+    Триграмма -> слова словаря архива (слова из title, author и year).
+    Индекс строится по словарю, а не по книгам: слов намного меньше,
+    чем книг, и книги по слову уже находит индекс слов архива.
+    """
+
+    def __init__(self, words: Iterable[str] = ()) -> None:
+        self._words: dict[str, set[str]] = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word: str) -> None:
+        for trigram in trigrams(word):
+            self._words.setdefault(trigram, set()).add(word)
+
+    def discard(self, word: str) -> None:
+        for trigram in trigrams(word):
+            words = self._words.get(trigram)
+            if words is not None:
+                words.discard(word)
+                if not words:
+                    del self._words[trigram]
+
+    def match(self, query: str, threshold: float = SIMILARITY_THRESHOLD) -> dict[str, float]:
+        """
+        Слова словаря, похожие на слово запроса, с оценкой от 0 до 1:
+        совпадение - 1, начинается с запроса - от 0.6 до 0.9, содержит
+        запрос - от 0.5 до 0.7, опечатка - 0.6 * сходство по триграммам.
+        Подстроки короче трех символов ищутся только в начале слов,
+        опечатки - только в словах запроса от FUZZY_MIN_LENGTH символов и не в числах.
+        """
+        padded = f"  {query} "
+        # слово с подстрокой содержит все триграммы запроса без пробелов,
+        # для коротких запросов ищем слова, которые с него начинаются
+        inner = trigrams(query) - trigrams(query[:2]) - {padded[-3:]} if len(query) >= 3 else set()
+        required = inner or {padded[len(query) - 1 : len(query) + 2]}
+        scores = {}
+        for word in self._having_all(required):
+            if word == query:
+                scores[word] = 1.0
+            elif word.startswith(query):
+                scores[word] = 0.6 + 0.3 * len(query) / len(word)
+            elif query in word:
+                scores[word] = 0.5 + 0.2 * len(query) / len(word)
+        if len(query) >= FUZZY_MIN_LENGTH and not query.isdigit():
+            for word, similarity in self._similar(query, threshold).items():
+                if word not in scores:
+                    scores[word] = 0.6 * similarity
+        return scores
+
+    def _having_all(self, required: set[str]) -> set[str]:
+        postings = sorted((self._words.get(trigram, set()) for trigram in required), key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def _similar(self, query: str, threshold: float) -> dict[str, float]:
+        """Слова со сходством по триграммам не меньше threshold."""
+        query_trigrams = trigrams(query)
+        min_common = math.ceil(threshold * len(query_trigrams))
+        postings = sorted((self._words.get(trigram, set()) for trigram in query_trigrams), key=len)
+        # слово с min_common общими триграммами есть хотя бы в одном
+        # из len - min_common + 1 самых коротких списков
+        rare = len(postings) - min_common + 1
+        common = Counter()
+        for words in postings[:rare]:
+            common.update(words)
+        similar = {}
+        for word, count in common.items():
+            count += sum(word in words for words in postings[rare:])
+            if count < min_common:
+                continue
+            similarity = count / (len(query_trigrams) + len(trigrams(word)) - count)
+            if similarity >= threshold:
+                similar[word] = similarity
+        return similar
+
+
+def rank_books(
+    vocabulary: TrigramIndex, words: list[str], token_ids: Callable[[str], Collection[str]]
+) -> dict[str, float]:
+    """
+    Оценка книг по запросу из нескольких слов: книга должна подходить
+    под каждое слово запроса, ее оценка - сумма лучших оценок ее слов.
+    """
+    postings = []
+    for word in words:
+        matches = vocabulary.match(word)
+        if not matches:
+            return {}
+        # слова книги с большей оценкой идут первыми: первая оценка книги - лучшая
+        ranked = [
+            (token_ids(token), score)
+            for token, score in sorted(matches.items(), key=itemgetter(1), reverse=True)
+        ]
+        postings.append((sum(len(ids) for ids, _ in ranked), ranked))
+    # начинаем с самого редкого слова, остальные слова проверяем только у найденных книг
+    postings.sort(key=itemgetter(0))
+    scores: dict[str, float] = {}
+    for ids, score in postings[0][1]:
+        if not scores:
+            scores = dict.fromkeys(ids, score)
+            continue
+        for id in ids:
+            scores.setdefault(id, score)
+    for size, ranked in postings[1:]:
+        if size < len(scores) * len(ranked):
+            best: dict[str, float] = {}
+            for ids, score in ranked:
+                for id in ids:
+                    best.setdefault(id, score)
+            scores = {id: score + best[id] for id, score in scores.items() if id in best}
+        else:
+            matched = {}
+            for id, score in scores.items():
+                for ids, word_score in ranked:
+                    if id in ids:
+                        matched[id] = score + word_score
+                        break
+            scores = matched
+        if not scores:
+            return {}
+    return scores
+
+
+def top_ids(scores: dict[str, float], limit: int | None = None) -> list[str]:
+    """Id по убыванию оценки, при равной оценке - по id; не больше limit."""
+    if limit is None or len(scores) <= limit:
+        return sorted(scores, key=lambda id: (-scores[id], id))
+    if limit <= 0:
+        return []
+    # оценка последней попавшей в выдачу книги, сравнения чисел и строк идут без key
+    last = heapq.nlargest(limit, scores.values())[-1]
+    better = sorted((id for id, score in scores.items() if score > last), key=lambda id: (-scores[id], id))
+    tied = heapq.nsmallest(limit - len(better), (id for id, score in scores.items() if score == last))
+    return better + tied
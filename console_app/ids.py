@@ -0,0 +1,48 @@
+from hashlib import blake2b
+from typing import Callable
+
+# сколько байт хеша попадает в id, 8 байт - 64 бита на каждое поле
+HASH_DIGEST_SIZE = 8
+# схема новых архивов; архив без записанной схемы создан до нее и построен на charsum
+DEFAULT_ID_STRATEGY = "hash"
+LEGACY_ID_STRATEGY = "charsum"
+
+
+def charsum_id(mask_data: dict[str]) -> str:
+    """
+    Исходная схема: сумма кодов символов каждого поля.
+    Анаграммы и многие разные строки дают одинаковый id.
+    """
+    id = "t{t}a{a}y{y}"
+    return id.format(
+        t=f'{sum(map(ord, mask_data["t"]))}',
+        a=f'{sum(map(ord, mask_data["a"]))}',
+        y=f'{sum(map(ord, mask_data["y"]))}',
+    )
+
+
+def _field_hash(value: str) -> int:
+    return int.from_bytes(blake2b(value.encode(), digest_size=HASH_DIGEST_SIZE).digest(), "big")
+
+
+def content_hash_id(mask_data: dict[str]) -> str:
+    """
+    Стабильный хеш содержимого. Формат id сохраняется (t..a..y..),
+    год записывается как есть - он и так состоит только из цифр.
+    """
+    return f't{_field_hash(mask_data["t"])}a{_field_hash(mask_data["a"])}y{mask_data["y"]}'
+
+
+ID_STRATEGIES: dict[str, Callable[[dict[str]], str]] = {
+    "charsum": charsum_id,
+    "hash": content_hash_id,
+}
+
+
+def get_id_strategy(name: str) -> Callable[[dict[str]], str]:
+    try:
+        return ID_STRATEGIES[name]
+    except KeyError:
+        raise ValueError(
+            f"Неизвестная схема id: '{name}'. Доступны: {', '.join(ID_STRATEGIES)}."
+        ) from None
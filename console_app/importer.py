@@ -0,0 +1,48 @@
+import csv
+import json
+import os
+from typing import Iterator
+
+from .exceptions import InvalidInputData
+
+IMPORT_FIELDS = ("title", "author", "year")
+
+
+def _read_csv(f) -> Iterator[tuple[int, dict[str]]]:
+    reader = csv.DictReader(f)
+    for record in reader:
+        yield reader.line_num, record
+
+
+def _read_jsonl(f) -> Iterator[tuple[int, dict[str]]]:
+    for line_num, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            record = {}
+        yield line_num, record if isinstance(record, dict) else {}
+
+
+READERS = {".csv": _read_csv, ".jsonl": _read_jsonl, ".ndjson": _read_jsonl}
+
+
+def read_records(path: str) -> Iterator[tuple[int, dict[str]]]:
+    """
+    Построчно читает книги из csv (с заголовком title,author,year)
+    или json lines файла. Возвращает номер строки и поля книги,
+    сам файл целиком в память не загружается.
+    """
+    reader = READERS.get(os.path.splitext(path)[1].lower())
+    if reader is None:
+        raise InvalidInputData(
+            f"Неподдерживаемый формат файла '{path}'. Доступны: {', '.join(READERS)}."
+        )
+    try:
+        f = open(path, "r", encoding="utf-8", newline="")
+    except OSError as exc:
+        raise InvalidInputData(f"Не удалось открыть файл '{path}': {exc.strerror}.") from None
+    with f:
+        for line_num, record in reader(f):
+            yield line_num, {field: f"{record.get(field) or ''}" for field in IMPORT_FIELDS}
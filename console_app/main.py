@@ -1,10 +1,28 @@
-import re
+import os
 import sys
-from typing import Any
-from collections import defaultdict
+from typing import Any, Callable, Iterable, TextIO
+from itertools import chain
 
-from .data import Archive
+from .backends import get_archive_backend
+from .batch import BatchRunner
+from .commands import (
+    COMMANDS,
+    ID_PATTERN,
+    STATUS_PATTERN,
+    TITLE_PATTERN,
+    YEAR_PATTERN,
+    parse_command,
+    parse_page,
+    parse_value,
+)
+from .data import BOOK_FIELDS, BaseArchive
+from .render import TableRenderer
+from .stats import STATS
+from .ids import DEFAULT_ID_STRATEGY, LEGACY_ID_STRATEGY, get_id_strategy
+from .importer import read_records
+from .scan import parse_conditions
 from .exceptions import (
+    ArchiveLocked,
     InvalidCommand,
     InvalidInputData,
     DataDoesNotExists,
@@ -13,82 +31,147 @@ from .exceptions import (
 
 
 class Library:
-    VALID_COMMAND = ("add", "delete", "search", "all", "change_status", "cmd", "leave")
-    COMMAND_DESCRIPTIONS = (
-        "Добавляет книгу в библиотеку",
-        "Удаляет книгу из библиотеки",
-        "Поиск книги по заданному атрибуту",
-        "Посмотреть все книги в библиотеке",
-        "Изменить статус книги в библиотеке",
-        "Уйти из библиотеки. Остановить работу скрипта",
-        "Запросить список команд",
-    )
+    # команды, их аргументы и методы описаны в commands.COMMANDS
+    VALID_COMMAND = tuple(COMMANDS)
+    COMMAND_DESCRIPTIONS = tuple(command.description for command in COMMANDS.values())
+    TITLE_PATTERN = TITLE_PATTERN
+    YEAR_PATTERN = YEAR_PATTERN
+    ID_PATTERN = ID_PATTERN
+    STATUS_PATTERN = STATUS_PATTERN
+    # сколько самых похожих книг показывает поиск
+    SEARCH_LIMIT = 20
+
+    def __init__(
+        self,
+        journal: bool = False,
+        id_strategy: str | None = None,
+        storage: str | None = None,
+        archive: BaseArchive | None = None,
+        flush_delay: float | None = None,
+        flush_every: int | None = None,
+        codec: str | None = None,
+        shards: int | None = None,
+        shard_workers: int | None = None,
+        scan_workers: int | None = None,
+        fast_start: bool = False,
+    ) -> None:
+        """
+        id_strategy - схема генерации id книг: "charsum" (исходная сумма кодов
+        символов) или "hash" (хеш содержимого). Id книг вычисляются по схеме,
+        записанной в архиве, поэтому параметр нужен только новому архиву
+        (по умолчанию "hash") и migrate_ids, который переводит архив на эту схему.
+        storage - хранилище архива: "json", "sqlite", "mmap" или "sharded". По умолчанию
+        берется из переменной окружения LIBRARY_STORAGE, иначе "json".
+        archive - готовый архив (например RemoteArchive), storage тогда не используется.
+        flush_delay, flush_every - отложенная запись json архива (см. Archive).
+        codec - формат снапшота json архива: "json", "pretty", "binary" или "msgpack".
+        shards, shard_workers - число шардов и потоков обхода шардов (см. ShardedArchive).
+        scan_workers - процессов для команды filter, по умолчанию по числу ядер.
+        fast_start - быстрый старт json архива из pickle (см. Archive).
+        """
+        self.journal = journal
+        self.flush_delay = flush_delay
+        self.flush_every = flush_every
+        self.codec = codec
+        self.shards = shards
+        self.shard_workers = shard_workers
+        self.scan_workers = scan_workers
+        self.fast_start = fast_start
+        if id_strategy is not None:
+            get_id_strategy(id_strategy)
+        self.id_strategy_name = id_strategy
+        self._id_scheme: str | None = None
+        self.storage = storage or os.environ.get("LIBRARY_STORAGE") or "json"
+        self.archive_backend = get_archive_backend(self.storage)
+        if archive is not None:
+            self._archive = archive
+            return
+        # иначе неподходящий параметр упадет TypeError при первом обращении к архиву
+        unsupported = [name for name in self._archive_options() if name not in self.archive_backend.OPTIONS]
+        if unsupported:
+            raise InvalidInputData(
+                f"Хранилище '{self.storage}' не поддерживает параметры: {', '.join(unsupported)}."
+            )
+
+    def _archive_options(self) -> dict[str, Any]:
+        """Параметры конструктора хранилища, заданные для этой библиотеки."""
+        options = {"journal": True} if self.journal else {}
+        if self.flush_delay is not None:
+            options["flush_delay"] = self.flush_delay
+        if self.flush_every is not None:
+            options["flush_every"] = self.flush_every
+        if self.codec is not None:
+            options["codec"] = self.codec
+        if self.fast_start:
+            options["fast_start"] = True
+        if self.shards is not None:
+            options["shards"] = self.shards
+        if self.shard_workers is not None:
+            options["workers"] = self.shard_workers
+        return options
 
     @property
     def archive(self):
         if hasattr(self, "_archive"):
             return self._archive
-        self._archive = Archive()
+        self._archive = self.archive_backend(**self._archive_options())
         return self._archive
 
     def formatted_style(self, head: tuple[str], body: list[tuple[Any]]) -> str:
         # с prettytable было бы веселее :)
-        table = []
-        body.insert(0, head)
-        bound_table = defaultdict(int)
-        for data in body:
-            row = []
-            for idx, d in enumerate(data):
-                row.append(f"{d}")
-                bound_table[idx] = max(bound_table[idx], len(d))
-            table.append(row)
-        return self._smooth_table(table, bound_table)
-
-    def _smooth_table(self, table: list, bound_table: defaultdict[int, int]) -> str:
-        smooth_table = []
-        for row in table:
-            col_res = []
-            for idx, col in enumerate(row):
-                bound_col = bound_table[idx]
-                if not idx:
-                    col_res.append(f"| {col + '|':>{bound_col}}")
-                else:
-                    col_res.append(f" {col:>{bound_col}} |")
-            row_net = "".join(["-" * (bound + bound // 10) for bound in bound_table.values()])
-            smooth_table.append(row_net + "\n")
-            smooth_table.append("".join(col_res) + "\n")
-        return "".join(smooth_table)
+        return TableRenderer.fit(head, body).render([head, *body])
 
     def check_command(self, cmd: str) -> bool:
-        cmd = re.sub("\\s", "_", cmd)
-        if cmd in self.VALID_COMMAND:
-            self._current_cmd = cmd
-            return True
-        raise InvalidCommand(
-            f"Неизвестная команда: '{cmd}'. Используйте команды из меню. Запросить меню команда 'cmd'."
-        )
+        """Строка ввода: команда и, необязательно, ее аргументы ("delete t1a1y1")."""
+        self._current_cmd, self._current_args = parse_command(cmd)
+        return True
 
     def command_execute(self):
-        getattr(self, self._current_cmd)()
+        command = COMMANDS[self._current_cmd]
+        args = command.collect(self._current_cmd, self._current_args)
+        result = getattr(self, command.method)(*args)
+        if result is not None:
+            print(result)
 
-    @staticmethod
-    def _parse_input(data, pattern: str):
-        parsed_data = re.findall(pattern, data)
-        if not parsed_data:
-            return
-        match = parsed_data[0]
-        if isinstance(match, tuple):
-            return match[0]
-        return " ".join(parsed_data)
+    _parse_input = staticmethod(parse_value)
 
-    @staticmethod
-    def _gen_id(mask_data: dict[str]) -> int:
-        id = "t{t}a{a}y{y}"
-        return id.format(
-            t=f'{sum(map(ord, mask_data["t"]))}',
-            a=f'{sum(map(ord, mask_data["a"]))}',
-            y=f'{sum(map(ord, mask_data["y"]))}',
-        )
+    @property
+    def requested_id_scheme(self) -> str:
+        """Схема из параметра id_strategy: ее получает новый архив и на нее переводит migrate_ids."""
+        return self.id_strategy_name or DEFAULT_ID_STRATEGY
+
+    @property
+    def id_scheme(self) -> str:
+        """
+        Схема, которой построены id книг архива. Пустой архив без схемы сразу
+        получает requested_id_scheme, чтобы ее знали следующие запуски. Архив
+        с книгами без записанной схемы создан до ее хранения - это charsum.
+        """
+        if self._id_scheme is None:
+            scheme = self.archive.get_id_scheme()
+            if scheme is None:
+                if next(self.archive.iter_books(0, 1), None) is None:
+                    scheme = self.requested_id_scheme
+                    self.archive.set_id_scheme(scheme)
+                else:
+                    scheme = LEGACY_ID_STRATEGY
+            self._id_scheme = scheme
+        return self._id_scheme
+
+    @property
+    def id_strategy(self) -> Callable[[dict[str]], str]:
+        return get_id_strategy(self.id_scheme)
+
+    def _gen_id(self, mask_data: dict[str]) -> str:
+        return self.id_strategy(mask_data)
+
+    def apply_id_scheme(self) -> int:
+        """Переводит архив на requested_id_scheme, возвращает количество книг с новым id."""
+        scheme = self.requested_id_scheme
+        changed = self.archive.migrate_ids(get_id_strategy(scheme))
+        self.archive.set_id_scheme(scheme)
+        self._id_scheme = scheme
+        return changed
 
     @staticmethod
     def validate_input_data(data: list[str]) -> None:
@@ -98,27 +181,66 @@ class Library:
                     "К сожалению неудалось корректно считать указаные вами данные."
                 )
 
-    def add(self):
-        title = self._parse_input(input("Введите название: "), r"(?<!\S)[\w\.]+")
-        author = self._parse_input(input("Введите автора: "), r"(?<!\S)[\w\.]+")
-        year = self._parse_input(input("Введите год релиза: "), r"(?<!\S)[\d]+(?!\S)")
+    def parse_book(self, title: str, author: str, year: str) -> dict[str, dict[str]]:
+        """Парсит и валидирует поля книги, возвращает запись для Archive.add."""
+        title, author, year = COMMANDS["add"].parse((title, author, year))
+        self.validate_input_data([title, author, year])
+        id = self._gen_id({"t": title, "a": author, "y": year})
+        return {id: {"title": title, "author": author, "year": year, "status": "в наличии"}}
+
+    def add_book(self, title: str, author: str, year: str) -> str:
+        data_to_save = self.parse_book(title, author, year)
+        title = next(iter(data_to_save.values()))["title"]
         result_map_msg = {
             1: f"Книга {title} ранее регистрировалась, Изменен статус.",
             2: f"Книга {title} добавлена в архив.",
         }
-        self.validate_input_data([title, author, year])
-        id = self._gen_id({"t": title, "a": author, "y": year})
-        data_to_save = {id: {"title": title, "author": author, "year": year, "status": "в наличии"}}
         res = self.archive.add(data_to_save)
-        print(result_map_msg.get(res))
+        return result_map_msg.get(res)
+
+    def import_file(self, path: str, verbose: bool = True) -> dict[str, int]:
+        """
+        Загружает книги из файла по правилам команды add.
+        Все книги сохраняются в архив один раз, в конце загрузки.
+        verbose - печатать ошибки строк и итог загрузки.
+        """
+        counters = {"added": 0, "status_changed": 0, "errors": 0}
+        with self.archive.batch():
+            for line_num, record in read_records(path):
+                try:
+                    data_to_save = self.parse_book(record["title"], record["author"], record["year"])
+                except InvalidInputData as exc:
+                    counters["errors"] += 1
+                    if verbose:
+                        print(f"Строка {line_num}: {exc}")
+                    continue
+                if self.archive.add(data_to_save) == 1:
+                    counters["status_changed"] += 1
+                else:
+                    counters["added"] += 1
+        if verbose:
+            print(
+                f"Загрузка завершена. Добавлено книг: {counters['added']}, "
+                f"изменен статус: {counters['status_changed']}, ошибок: {counters['errors']}."
+            )
+        return counters
+
+    def run_batch(self, lines: Iterable[str], out: TextIO, flush_every: int | None = None) -> int:
+        """
+        Выполняет команды из файла или stdin без интерактивных запросов,
+        результат каждой команды пишется в out строкой json.
+        """
+        return BatchRunner(self, flush_every).run(lines, out)
+
+    def import_books(self, path: str) -> None:
+        self.import_file(path.strip())
 
-    def delete(self):
-        id = input("Введите идентификатор книги: ")
+    def delete_book(self, id: str) -> str:
         # заменить дублирование групп на именовaные
-        id = self._parse_input(id, r"(?<!\S)(t[0-9]+a[0-9]+y[0-9]+(d[0-9]+)?)(?!\S)")
+        (id,) = COMMANDS["delete"].parse((id,))
         self.validate_input_data([id])
         self.archive.delete(id)
-        print("Книга успешно удалена из архива.")
+        return "Книга успешно удалена из архива."
 
     def cmd(self):
         menu = self.formatted_style(
@@ -127,70 +249,101 @@ class Library:
         )
         print(menu)
 
-    def change_status(self):
-        id, new_status = input("Введите идентификатор книги: "), input(
-            "Введите Новый статус книги: "
-        )
+    def change_book_status(self, id: str, new_status: str) -> str:
         result_map_msg = {
             0: "Изъяли дубликат книги, книга по прежнему доступна в архиве.",
             1: "Статус успешно изменен.",
             2: "Дубликат изъят.",
         }
-        id = self._parse_input(id, r"(?<!\S)(t[0-9]+a[0-9]+y[0-9]+(d[0-9]+)?)(?!\S)")
-        new_status = self._parse_input(new_status.lower(), r"(?<!\S)(в наличии|выдана)(?!\S)")
+        id, new_status = COMMANDS["change_status"].parse((id, new_status.lower()))
         self.validate_input_data([id, new_status])
         res = self.archive.change_status(id, new_status)
-        print(result_map_msg[res])
+        return result_map_msg[res]
 
-    @staticmethod
-    def leave():
+    def migrate_ids(self) -> None:
+        changed = self.apply_id_scheme()
+        print(f"Id изменены у {changed} книг.")
+
+    def stats(self) -> None:
+        if not STATS.enabled:
+            print("Статистика выключена, запустите библиотеку с флагом --stats.")
+            return
+        print(STATS.render())
+
+    def leave(self):
+        if hasattr(self, "_archive"):
+            self._archive.flush()
         print("ВЫ ВЫШЛИ ИЗ БИБЛИОТЕКИ, РАБОТА СКРИПТА ПРИОСТАНОВЛЕНА!!!")
         sys.exit()
 
-    def all(self) -> None:
-        storage_data = [
-            (id, book["title"], book["author"], book["year"], book["status"])
-            for id, book in self.archive.all().items()
-            if "d" not in id
-        ]
+    def all(self, offset: str | int = 0, limit: str | int | None = None) -> None:
+        """
+        Выводит архив построчно, не собирая его в памяти. Ширина колонок
+        берется из заранее посчитанных максимумов архива.
+        """
+        offset, limit = parse_page(offset, limit)
+        head = ("ID", "TITLE", "AUTHOR", "YEAR", "STATUS")
+        widths = self.archive.field_widths()
+        renderer = TableRenderer(
+            max(len(col), widths[field]) for col, field in zip(head, ("id", *BOOK_FIELDS))
+        )
+        # значения книги всегда идут в порядке BOOK_FIELDS
+        rows = ((id, *book.values()) for id, book in self.archive.iter_books(offset, limit))
         print("АРХИВ:\n")
-        print(self.formatted_style(("ID", "TITLE", "AUTHOR", "YEAR", "STATUS"), storage_data))
+        # через print, как и остальной вывод Library
+        for chunk in renderer.chunks(chain([head], rows)):
+            print(chunk, end="")
+        sys.stdout.flush()
 
-    @staticmethod
-    def _match(storage_data: dict[str, dict[str]], filter_attr: str) -> list[tuple[str]]:
-        filtered_data = []
-        encoded_attr = sum(map(ord, filter_attr))
-        for id in storage_data:
-            if "d" in id:
-                continue
-            match = re.findall(fr"(?<=t|a|y){encoded_attr}(?=a|y|d?)", id)
-            if match:
-                book = storage_data[id]
-                filtered_data.append((id, book["title"], book["author"], book["year"]))
-        return filtered_data
-
-    def search(self) -> None:
-        filter_attr = input("Введите название, автора или год книги: ")
-        if result := self._match(self.archive.all(), filter_attr):
+    def search(self, filter_attr: str) -> None:
+        if found := self.archive.search_similar(filter_attr, self.SEARCH_LIMIT):
+            result = [(id, book["title"], book["author"], book["year"]) for id, book in found]
             print("РЕЗУЛЬТАТ ПОИСКА.")
             print(self.formatted_style(("ID", "TITLE", "AUTHOR", "YEAR"), result))
         else:
             print(f"Ничего не найдено для '{filter_attr}'")
 
+    def _print_books(self, books: list[tuple[str, dict[str]]], title: str, empty: str) -> None:
+        if not books:
+            print(empty)
+            return
+        rows = [(id, book["title"], book["author"], book["year"]) for id, book in books]
+        print(title)
+        print(self.formatted_style(("ID", "TITLE", "AUTHOR", "YEAR"), rows))
+
+    def issued_books(self) -> None:
+        books = self.archive.books_with_status("выдана")
+        self._print_books(books, "ВЫДАННЫЕ КНИГИ.", "Выданных книг нет.")
+
+    def available_books(self) -> None:
+        books = self.archive.books_with_status("в наличии")
+        self._print_books(books, "КНИГИ В НАЛИЧИИ.", "Книг в наличии нет.")
+
+    def filter(self, *conditions: str) -> None:
+        books = self.archive.filter_books(parse_conditions(list(conditions)), self.scan_workers)
+        self._print_books(books, "НАЙДЕННЫЕ КНИГИ.", "Ничего не найдено.")
+
+    def copies(self, title: str) -> None:
+        if counts := self.archive.copy_counts(title):
+            rows = [
+                (id, book["title"], book["author"], book["year"], copies, available)
+                for id, book, copies, available in counts
+            ]
+            print(self.formatted_style(("ID", "TITLE", "AUTHOR", "YEAR", "ВСЕГО", "В НАЛИЧИИ"), rows))
+        else:
+            print(f"Книг с названием '{title}' нет.")
+
     def enter(self):
         print("\nДОБРО ПОЖАЛОВАТЬ В БИБЛИОТЕКУ!!!\n")
         self.cmd()
         while True:
             cmd = input("Введите команду: ")
             try:
-                self.check_command(cmd.lower().strip())
-            except InvalidCommand as exc:
+                # разбор строки тоже может упасть на вводе: незакрытая кавычка
+                self.check_command(cmd)
+                self.command_execute()
+            except (InvalidCommand, InvalidInputData, TheSameStatus, DataDoesNotExists, ArchiveLocked) as exc:
                 print(exc)
-            else:
-                try:
-                    self.command_execute()
-                except (InvalidInputData, TheSameStatus, DataDoesNotExists) as exc:
-                    print(exc)
 
 
 if __name__ == "__main__":
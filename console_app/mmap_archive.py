@@ -0,0 +1,416 @@
+import json
+import mmap
+import os
+import struct
+from hashlib import blake2b
+from typing import Collection, Iterator
+
+from .data import BOOK_FIELDS, BaseArchive, FileLockMixin
+from .fuzzy import TrigramIndex
+from .stats import STATS
+
+# заголовок индекса: magic, емкость, живые записи, занятые слоты (с удаленными),
+# максимальная длина id и каждого поля
+INDEX_HEADER = struct.Struct("<8sQQQ5I")
+INDEX_HEADER_SIZE = 64
+INDEX_MAGIC = b"LIBIDX01"
+# слот: хеш id (0 - пустой слот), смещение записи + 1 (0 - запись удалена)
+SLOT = struct.Struct("<QQ")
+RECORD_LENGTH = struct.Struct("<I")
+
+
+def _id_hash(id: str) -> int:
+    return int.from_bytes(blake2b(id.encode(), digest_size=8).digest(), "little") or 1
+
+
+class MmapArchive(FileLockMixin, BaseArchive):
+    """
+    Архив для очень больших каталогов. Записи книг дописываются в файл
+    данных, а файл индекса - хеш-таблица с открытой адресацией из слотов
+    фиксированного размера - хранит смещение актуальной версии каждой книги.
+    Оба файла читаются через mmap, поэтому команда над одной книгой
+    читает только нужные страницы и не зависит от размера каталога.
+
+    Запись книги: u32 длина + json [id, title, author, year, status, номера дубликатов]
+    (номера дубликатов хранятся у оригинала), удаление - [id, null].
+    Полный проход по файлу данных выполняют только all, iter_books, поиск
+    и выборки по статусу и названию (books_with_status, copy_counts).
+    """
+
+    _filename = "library_storage.mmap"
+    # начальное число слотов индекса, индекс растет вдвое при заполнении на 70%
+    index_capacity = 1024
+
+    def __init__(self) -> None:
+        self._index = None
+        self._data = None
+        self._data_file = None
+        self._files_signature = None
+        # слово -> id оригиналов, собирается на время одного search_similar
+        self._tokens = None
+
+    @property
+    def _index_filename(self) -> str:
+        return f"{self._filename}.idx"
+
+    def close(self) -> None:
+        for name in ("_index", "_data", "_data_file"):
+            if getattr(self, name) is not None:
+                getattr(self, name).close()
+                setattr(self, name, None)
+        self._files_signature = None
+
+    def _signature(self) -> tuple:
+        signature = []
+        for filename in (self._filename, self._index_filename):
+            stat = os.stat(filename)
+            signature.append((stat.st_ino, stat.st_size))
+        return tuple(signature)
+
+    def _open(self) -> None:
+        """Открывает файлы архива, если их еще нет - создает пустой архив."""
+        if self._depth and self._index is not None:
+            # внутри транзакции файлы меняем только мы
+            return
+        if not os.path.exists(self._index_filename):
+            with self._locked():
+                if not os.path.exists(self._index_filename):
+                    self._rebuild_index()
+        signature = self._signature()
+        if signature == self._files_signature:
+            return
+        self.close()
+        # без буфера: записанное сразу видно через mmap в той же команде
+        self._data_file = open(self._filename, "ab", buffering=0)
+        self._data_file.seek(0, os.SEEK_END)
+        with open(self._index_filename, "r+b") as f:
+            self._index = mmap.mmap(f.fileno(), 0)
+        self._files_signature = signature
+
+    def _data_view(self, end: int) -> mmap.mmap:
+        """mmap файла данных, переоткрывается, если файл вырос после открытия."""
+        if self._data is None or len(self._data) < end:
+            if self._data is not None:
+                self._data.close()
+            with open(self._filename, "rb") as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._data
+
+    # индекс
+
+    @property
+    def _header(self) -> tuple:
+        return INDEX_HEADER.unpack_from(self._index, 0)
+
+    def _write_header(self, capacity: int, count: int, used: int, widths: tuple[int, ...]) -> None:
+        INDEX_HEADER.pack_into(self._index, 0, INDEX_MAGIC, capacity, count, used, *widths)
+
+    @staticmethod
+    def _new_index(capacity: int, count: int = 0, widths: tuple[int, ...] = (0,) * 5) -> bytearray:
+        index = bytearray(INDEX_HEADER_SIZE + capacity * SLOT.size)
+        INDEX_HEADER.pack_into(index, 0, INDEX_MAGIC, capacity, count, count, *widths)
+        return index
+
+    @staticmethod
+    def _insert_slot(index: bytearray | mmap.mmap, capacity: int, id_hash: int, value: int) -> None:
+        pos = id_hash & (capacity - 1)
+        while SLOT.unpack_from(index, INDEX_HEADER_SIZE + pos * SLOT.size)[0]:
+            pos = (pos + 1) & (capacity - 1)
+        SLOT.pack_into(index, INDEX_HEADER_SIZE + pos * SLOT.size, id_hash, value)
+
+    def _find_slot(self, id: str) -> tuple[int, int | None]:
+        """
+        Возвращает номер слота книги и смещение ее записи.
+        Если книги нет - номер слота, куда ее можно записать, и None.
+        """
+        id_hash = _id_hash(id)
+        capacity = self._header[1]
+        pos = id_hash & (capacity - 1)
+        free = None
+        while True:
+            slot_hash, value = SLOT.unpack_from(self._index, INDEX_HEADER_SIZE + pos * SLOT.size)
+            if not slot_hash:
+                return (pos if free is None else free), None
+            if slot_hash == id_hash and value:
+                if self._read_record(value - 1)[0] == id:
+                    return pos, value - 1
+            elif not value and free is None:
+                free = pos
+            pos = (pos + 1) & (capacity - 1)
+
+    def _grow_index(self, capacity: int) -> None:
+        _, _, count, _, *widths = self._header
+        index = self._new_index(capacity, count, tuple(widths))
+        for pos in range(self._header[1]):
+            slot_hash, value = SLOT.unpack_from(self._index, INDEX_HEADER_SIZE + pos * SLOT.size)
+            if value:
+                self._insert_slot(index, capacity, slot_hash, value)
+        self._replace_index(index)
+
+    def _replace_index(self, index: bytearray) -> None:
+        tmp_filename = f"{self._index_filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(index)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self._index_filename)
+        self.close()
+        self._open()
+
+    def _rebuild_index(self) -> None:
+        """Строит индекс заново по файлу данных (последняя версия книги побеждает)."""
+        if not os.path.exists(self._filename):
+            open(self._filename, "ab").close()
+        offsets = {}
+        widths = [0] * 5
+        for offset, record in self._scan():
+            if record[1] is None:
+                offsets.pop(record[0], None)
+                continue
+            offsets[record[0]] = offset
+            if self._split_id(record[0])[1] is None:
+                widths = [max(width, len(value)) for width, value in zip(widths, record[:5])]
+        self._write_index(offsets, widths)
+
+    def _write_index(self, offsets: dict[str, int], widths: list[int]) -> None:
+        capacity = self.index_capacity
+        while len(offsets) > capacity * 0.7:
+            capacity *= 2
+        index = self._new_index(capacity, len(offsets), tuple(widths))
+        for id, offset in offsets.items():
+            self._insert_slot(index, capacity, _id_hash(id), offset + 1)
+        self._replace_index(index)
+
+    # данные
+
+    def _read_record(self, offset: int) -> list:
+        data = self._data_view(offset + RECORD_LENGTH.size)
+        (length,) = RECORD_LENGTH.unpack_from(data, offset)
+        start = offset + RECORD_LENGTH.size
+        data = self._data_view(start + length)
+        if STATS.enabled:
+            STATS.incr("io.bytes_read", RECORD_LENGTH.size + length)
+        return json.loads(data[start : start + length])
+
+    def _append_record(self, record: list) -> int:
+        payload = json.dumps(record, ensure_ascii=False).encode()
+        offset = self._data_file.tell()
+        self._data_file.write(RECORD_LENGTH.pack(len(payload)) + payload)
+        if STATS.enabled:
+            STATS.incr("io.bytes_written", RECORD_LENGTH.size + len(payload))
+        return offset
+
+    def _scan(self) -> Iterator[tuple[int, list]]:
+        """Все записи файла данных по порядку, включая устаревшие версии."""
+        size = os.path.getsize(self._filename)
+        offset = 0
+        while offset + RECORD_LENGTH.size <= size:
+            data = self._data_view(size)
+            (length,) = RECORD_LENGTH.unpack_from(data, offset)
+            start = offset + RECORD_LENGTH.size
+            if start + length > size:
+                # недописанная запись в конце файла
+                return
+            yield offset, json.loads(data[start : start + length])
+            offset = start + length
+
+    def _live_records(self) -> Iterator[list]:
+        """Актуальные версии книг: запись жива, если индекс ссылается на нее."""
+        self._open()
+        for offset, record in self._scan():
+            if record[1] is not None and self._find_slot(record[0])[1] == offset:
+                yield record
+
+    # примитивы BaseArchive
+
+    def _begin(self) -> None:
+        self._acquire_lock()
+        try:
+            self._open()
+            self._data_file.seek(0, os.SEEK_END)
+        except BaseException:
+            self._release_lock()
+            raise
+
+    def _commit(self) -> None:
+        try:
+            os.fsync(self._data_file.fileno())
+            self._index.flush()
+            self._files_signature = self._signature()
+        finally:
+            self._release_lock()
+
+    def _rollback(self) -> None:
+        # изменения пишутся сразу, сохраняем то, что успели внести
+        self._commit()
+
+    def _get_record(self, id: str) -> list | None:
+        self._open()
+        offset = self._find_slot(id)[1]
+        return None if offset is None else self._read_record(offset)
+
+    def _get(self, id: str) -> dict[str] | None:
+        record = self._get_record(id)
+        return None if record is None else dict(zip(BOOK_FIELDS, record[1:5]))
+
+    def _put(self, id: str, record: list) -> None:
+        capacity, count, used, *widths = self._header[1:]
+        pos, offset = self._find_slot(id)
+        new_offset = self._append_record(record)
+        if offset is None:
+            count += 1
+            if not SLOT.unpack_from(self._index, INDEX_HEADER_SIZE + pos * SLOT.size)[0]:
+                used += 1
+        SLOT.pack_into(self._index, INDEX_HEADER_SIZE + pos * SLOT.size, _id_hash(id), new_offset + 1)
+        if self._split_id(id)[1] is None:
+            widths = [max(width, len(value)) for width, value in zip(widths, record[:5])]
+        self._write_header(capacity, count, used, tuple(widths))
+        if used > capacity * 0.7:
+            self._grow_index(capacity * 2)
+
+    def _set_dublicates(self, base_id: str, change) -> None:
+        original = self._get_record(base_id)
+        original[5] = change(original[5])
+        self._put(base_id, original)
+
+    def _set(self, id: str, book: dict[str]) -> None:
+        base_id, num = self._split_id(id)
+        if num is None:
+            current = self._get_record(id)
+            dublicates = current[5] if current is not None else []
+            self._put(id, [id, *(book[field] for field in BOOK_FIELDS), dublicates])
+            return
+        self._put(id, [id, *(book[field] for field in BOOK_FIELDS), []])
+        self._set_dublicates(base_id, lambda nums: sorted({*nums, num}))
+
+    def _remove(self, id: str) -> None:
+        capacity, count, used, *widths = self._header[1:]
+        pos, offset = self._find_slot(id)
+        self._append_record([id, None])
+        SLOT.pack_into(self._index, INDEX_HEADER_SIZE + pos * SLOT.size, _id_hash(id), 0)
+        self._write_header(capacity, count - 1, used, tuple(widths))
+        base_id, num = self._split_id(id)
+        if num is not None:
+            self._set_dublicates(base_id, lambda nums: [n for n in nums if n != num])
+
+    def _find_dublicate(self, id: str) -> str | None:
+        record = self._get_record(id)
+        if record is not None and record[5]:
+            return f"{id}d{record[5][-1]}"
+        return None
+
+    def _gen_actual_id(self, income_data_id: str) -> str:
+        record = self._get_record(income_data_id)
+        nums = record[5] if record is not None else []
+        return f"{income_data_id}d{nums[-1] + 1 if nums else 1}"
+
+    def _replace_all(self, storage_data: dict[str, dict[str]]) -> None:
+        with self._locked():
+            self.close()
+            tmp_filename = f"{self._filename}.{os.getpid()}.tmp"
+            dublicates = {}
+            for id in storage_data:
+                base_id, num = self._split_id(id)
+                if num is not None:
+                    dublicates.setdefault(base_id, []).append(num)
+            offsets = {}
+            widths = [0] * 5
+            with open(tmp_filename, "wb") as f:
+                for id, book in storage_data.items():
+                    record = [id, *(book[field] for field in BOOK_FIELDS), sorted(dublicates.get(id, []))]
+                    if self._split_id(id)[1] is None:
+                        widths = [max(width, len(value)) for width, value in zip(widths, record[:5])]
+                    payload = json.dumps(record, ensure_ascii=False).encode()
+                    offsets[id] = f.tell()
+                    f.write(RECORD_LENGTH.pack(len(payload)) + payload)
+                f.flush()
+                os.fsync(f.fileno())
+            # без индекса архив при открытии перестроит его по данным,
+            # поэтому старый индекс не переживет замену файла данных
+            if os.path.exists(self._index_filename):
+                os.remove(self._index_filename)
+            os.replace(tmp_filename, self._filename)
+            self._write_index(offsets, widths)
+
+    def compact(self) -> None:
+        """Переписывает файл данных без устаревших версий и удаленных книг."""
+        self._replace_all(self.all())
+
+    def all(self) -> dict[str, dict[str]]:
+        return {record[0]: dict(zip(BOOK_FIELDS, record[1:5])) for record in self._live_records()}
+
+    def iter_books(self, offset: int = 0, limit: int | None = None) -> Iterator[tuple[str, dict[str]]]:
+        skipped = returned = 0
+        for record in self._live_records():
+            if limit is not None and returned >= limit:
+                return
+            if self._split_id(record[0])[1] is not None:
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            returned += 1
+            yield record[0], dict(zip(BOOK_FIELDS, record[1:5]))
+
+    def field_widths(self) -> dict[str, int]:
+        self._open()
+        return dict(zip(("id", *BOOK_FIELDS), self._header[4:]))
+
+    def search(self, filter_attr: str) -> list[tuple[str, dict[str]]]:
+        query = filter_attr.casefold().strip()
+        query_tokens = set(query.split())
+        exact, partial = [], []
+        for record in self._live_records():
+            if self._split_id(record[0])[1] is not None:
+                continue
+            values, tokens = self._search_keys(record[1:4])
+            if query in values:
+                exact.append(record)
+            elif query_tokens and query_tokens <= tokens:
+                partial.append(record)
+        return [
+            (record[0], dict(zip(BOOK_FIELDS, record[1:5])))
+            for found in (exact, partial)
+            for record in sorted(found)
+        ]
+
+    def books_with_status(self, status: str) -> list[tuple[str, dict[str]]]:
+        return [
+            (record[0], dict(zip(BOOK_FIELDS, record[1:5])))
+            for record in self._live_records()
+            if record[4] == status and self._split_id(record[0])[1] is None
+        ]
+
+    def copy_counts(self, title: str) -> list[tuple[str, dict[str], int, int]]:
+        query = title.casefold().strip()
+        found = [
+            record
+            for record in self._live_records()
+            if record[1].casefold() == query and self._split_id(record[0])[1] is None
+        ]
+        counts = []
+        # сортируются только книги с этим названием, а не весь каталог
+        for record in sorted(found):
+            # номера дубликатов хранятся у оригинала, сами дубликаты читаются по индексу
+            copies = [record, *(self._get_record(f"{record[0]}d{num}") for num in record[5])]
+            available = sum(copy[4] == "в наличии" for copy in copies)
+            counts.append((record[0], dict(zip(BOOK_FIELDS, record[1:5])), len(copies), available))
+        return counts
+
+    def search_similar(self, query: str, limit: int | None = None) -> list[tuple[str, dict[str]]]:
+        self._tokens = {}
+        try:
+            return super().search_similar(query, limit)
+        finally:
+            self._tokens = None
+
+    def _vocabulary(self) -> TrigramIndex:
+        for record in self._live_records():
+            if self._split_id(record[0])[1] is None:
+                _, tokens = self._search_keys(record[1:4])
+                for token in tokens:
+                    self._tokens.setdefault(token, set()).add(record[0])
+        return TrigramIndex(self._tokens)
+
+    def _token_ids(self, token: str) -> Collection[str]:
+        return self._tokens.get(token, set())
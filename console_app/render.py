@@ -0,0 +1,50 @@
+import io
+from itertools import islice
+from typing import Any, Iterable, Iterator, TextIO
+
+
+class TableRenderer:
+    """
+    Рисует таблицу в том же виде, что и раньше formatted_style.
+    Разделитель и шаблон строки собираются один раз при создании,
+    строки пишутся в файловый объект порциями по chunk_size.
+    """
+
+    chunk_size = 1000
+
+    def __init__(self, widths: Iterable[int]) -> None:
+        widths = tuple(widths)
+        separator = "".join("-" * (width + width // 10) for width in widths) + "\n"
+        first, *others = widths
+        # первая колонка выравнивается вместе с закрывающей чертой
+        self._template = (
+            separator + f"| {{:>{first}}}" + "".join(f" {{:>{width}}} |" for width in others) + "\n"
+        )
+
+    @classmethod
+    def fit(cls, head: tuple[str], body: Iterable[tuple[Any]]) -> "TableRenderer":
+        """Ширина колонок по самому длинному значению в заголовке и данных."""
+        widths = [len(col) for col in head]
+        for row in body:
+            for idx, col in enumerate(row):
+                widths[idx] = max(widths[idx], len(f"{col}"))
+        return cls(widths)
+
+    def _format(self, row: tuple[Any]) -> str:
+        first, *others = row
+        return self._template.format(f"{first}|", *others)
+
+    def chunks(self, rows: Iterable[tuple[Any]]) -> Iterator[str]:
+        """Таблица порциями по chunk_size строк."""
+        rows = iter(rows)
+        while chunk := list(islice(rows, self.chunk_size)):
+            yield "".join(map(self._format, chunk))
+
+    def write(self, out: TextIO, rows: Iterable[tuple[Any]]) -> None:
+        for chunk in self.chunks(rows):
+            out.write(chunk)
+
+    def render(self, rows: Iterable[tuple[Any]]) -> str:
+        out = io.StringIO()
+        self.write(out, rows)
+        return out.getvalue()
@@ -0,0 +1,124 @@
+import os
+import threading
+from typing import Any, Callable, Mapping, Sequence
+
+from .exceptions import InvalidInputData
+
+# на меньшем числе книг запуск процессов дороже самого прохода
+PARALLEL_MIN_BOOKS = 200_000
+# кусков на процесс: процессы, которым достались быстрые куски, берут следующие
+CHUNKS_PER_WORKER = 4
+
+
+def _year(value: str) -> int:
+    if not value.isdigit():
+        raise InvalidInputData(f"Год должен быть числом: '{value}'.")
+    return int(value)
+
+
+def _year_in(low: int | None, high: int | None) -> Callable[[tuple[str, ...]], bool]:
+    def check(values: tuple[str, ...]) -> bool:
+        year = values[2]
+        if not year.isdigit():
+            return False
+        year = int(year)
+        return (low is None or year >= low) and (high is None or year <= high)
+
+    return check
+
+
+def compile_filter(conditions: Mapping[str, str]) -> Callable[[tuple[str, ...]], bool]:
+    """
+    Собирает проверку книги по условиям. Значения книги - в порядке BOOK_FIELDS.
+    title, author - поле равно значению, text - подстрока title или author
+    (без учета регистра), status - статус, year - год или диапазон "1900-1950"
+    (границу можно не указывать: "-1950", "1900-"). Пустые условия пропускают все книги.
+    """
+    checks = []
+    for name, value in conditions.items():
+        value = str(value).strip()
+        if name in ("title", "author"):
+            pos, key = (0 if name == "title" else 1), value.casefold()
+            checks.append(lambda values, pos=pos, key=key: values[pos].casefold() == key)
+        elif name == "text":
+            key = value.casefold()
+            checks.append(lambda values, key=key: key in values[0].casefold() or key in values[1].casefold())
+        elif name == "status":
+            key = value.lower()
+            checks.append(lambda values, key=key: values[3] == key)
+        elif name == "year":
+            low, sep, high = value.partition("-")
+            low = _year(low) if low else None
+            high = (_year(high) if high else None) if sep else low
+            checks.append(_year_in(low, high))
+        else:
+            raise InvalidInputData(
+                f"Неизвестное условие: '{name}'. Доступны: title, author, year, status, text."
+            )
+    if not checks:
+        return lambda values: True
+    matches = checks[0]
+    for check in checks[1:]:
+        matches = _both(matches, check)
+    return matches
+
+
+def _both(first: Callable[[tuple[str, ...]], bool], second: Callable[[tuple[str, ...]], bool]):
+    # вложенные вызовы дешевле all() по генератору на каждую книгу
+    return lambda values: first(values) and second(values)
+
+
+def parse_conditions(words: list[str]) -> dict[str, str]:
+    """Условия из слов вида name=value: year=1900-1950 status=выдана "author=Франц Кафка"."""
+    conditions = {}
+    for word in words:
+        name, sep, value = word.partition("=")
+        if not sep or not value.strip():
+            raise InvalidInputData(f"Условие '{word}' должно иметь вид name=value.")
+        conditions[name.lower()] = value
+    return conditions
+
+
+# книги и проверка текущего прохода: процессы получают их при fork, без pickle
+_scan: tuple[Sequence[tuple[str, Any]], Callable[[tuple[str, ...]], bool]] | None = None
+
+
+def _scan_chunk(start: int, stop: int) -> list[int]:
+    books, matches = _scan
+    return [pos for pos in range(start, stop) if matches(tuple(books[pos][1].values()))]
+
+
+def scan_books(
+    books: Sequence[tuple[str, Any]],
+    matches: Callable[[tuple[str, ...]], bool],
+    workers: int | None = None,
+) -> list[tuple[str, Any]]:
+    """
+    Книги (id, книга), прошедшие проверку matches, в исходном порядке.
+    Большие выборки делятся на куски и проверяются в пуле процессов
+    (workers, по умолчанию - по числу ядер). Процессы запускаются через fork
+    и читают книги из памяти родителя. Без fork, с одним ядром, на
+    небольшом архиве или если в процессе работают другие потоки проверка
+    идет в текущем процессе: fork копирует блокировки, которые держат
+    другие потоки (сервер, таймер отложенной записи), и процесс пула
+    может зависнуть на них.
+    """
+    global _scan
+    workers = workers or os.cpu_count() or 1
+    if workers < 2 or len(books) < PARALLEL_MIN_BOOKS or threading.active_count() > 1:
+        return [book for book in books if matches(tuple(book[1].values()))]
+    # пул нужен только большим архивам, его модули не грузятся при каждом запуске
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return [book for book in books if matches(tuple(book[1].values()))]
+    size = -(-len(books) // (workers * CHUNKS_PER_WORKER))
+    starts = range(0, len(books), size)
+    _scan = (books, matches)
+    try:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as pool:
+            found = pool.map(_scan_chunk, starts, [min(start + size, len(books)) for start in starts])
+            return [books[pos] for positions in found for pos in positions]
+    finally:
+        _scan = None
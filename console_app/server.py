@@ -0,0 +1,266 @@
+import asyncio
+import inspect
+import json
+import sys
+import threading
+import traceback
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Iterator
+
+from .commands import ID_PATTERN, YEAR_PATTERN
+from .data import BOOK_FIELDS, STATUSES
+from .ids import ID_STRATEGIES
+from .exceptions import (
+    ArchiveLocked,
+    DataDoesNotExists,
+    InvalidCommand,
+    InvalidInputData,
+    TheSameStatus,
+)
+
+if TYPE_CHECKING:
+    from .main import Library
+
+HANDLED_ERRORS = (InvalidCommand, InvalidInputData, TheSameStatus, DataDoesNotExists, ArchiveLocked)
+
+
+def _is_id(value: Any) -> bool:
+    return isinstance(value, str) and ID_PATTERN.fullmatch(value) is not None
+
+
+def _is_book(value: Any) -> bool:
+    return (
+        isinstance(value, dict)
+        and value.keys() == set(BOOK_FIELDS)
+        and all(isinstance(field, str) and field for field in value.values())
+        and YEAR_PATTERN.fullmatch(value["year"]) is not None
+        and value["status"] in STATUSES
+    )
+
+
+def check_write_args(method: str, args: list[Any]) -> str | None:
+    """
+    Проверяет аргументы изменения до постановки в очередь писателя:
+    сервер не доверяет клиенту. Возвращает текст ошибки, None - аргументы верны.
+    """
+    if method == "add":
+        if len(args) == 1 and isinstance(args[0], dict) and len(args[0]) == 1:
+            (id, book), = args[0].items()
+            if _is_id(id) and _is_book(book):
+                return None
+        return "add ожидает {id: книга} с полями title, author, year и status."
+    if method == "delete":
+        if len(args) == 1 and _is_id(args[0]):
+            return None
+        return "delete ожидает id книги."
+    if method == "set_id_scheme":
+        if len(args) == 1 and args[0] in ID_STRATEGIES:
+            return None
+        return f"set_id_scheme ожидает схему id: {', '.join(ID_STRATEGIES)}."
+    if len(args) == 2 and _is_id(args[0]) and args[1] in STATUSES:
+        return None
+    return f"change_status ожидает id книги и статус: {', '.join(STATUSES)}."
+
+
+class ReadWriteLock:
+    """Чтения идут параллельно друг с другом, запись ждет их и не пускает новые."""
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+
+    @contextmanager
+    def reading(self) -> Iterator[None]:
+        with self._condition:
+            while self._writing:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def writing(self) -> Iterator[None]:
+        # писатель у сервера один, поэтому новые чтения останавливаются сразу
+        with self._condition:
+            self._writing = True
+            while self._readers:
+                self._condition.wait()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class ArchiveServer:
+    """
+    Сервер держит один архив в памяти для всех клиентов.
+    Протокол - строки json: {"method": "add", "args": [...]} -> {"ok": true, "result": ...}.
+
+    Архив читается и пишется в потоках, цикл событий только принимает
+    запросы и отвечает. Чтения выполняются параллельно друг с другом,
+    изменения проверяются и ставятся в очередь единственной задачи-писателя.
+    Писатель забирает из очереди все накопившиеся изменения (до max_batch),
+    выполняет их одной транзакцией и сохраняет архив один раз (group commit),
+    после чего отвечает клиентам. Ошибка одного изменения получает только его
+    клиент. На время транзакции чтения ждут.
+    """
+
+    READ_METHODS = (
+        "search",
+        "search_similar",
+        "books_with_status",
+        "copy_counts",
+        "filter_books",
+        "iter_books",
+        "field_widths",
+        "all",
+        "get_id_scheme",
+    )
+    WRITE_METHODS = ("add", "delete", "change_status", "set_id_scheme")
+    # очередь ожидающих подключений, рассчитана на сотни одновременных клиентов
+    backlog = 1024
+
+    def __init__(self, library: "Library", max_batch: int = 1000) -> None:
+        self.library = library
+        self.max_batch = max_batch
+        self._server: asyncio.AbstractServer | None = None
+        self._writer_task: asyncio.Task | None = None
+        self._lock = ReadWriteLock()
+
+    async def start(
+        self, host: str | None = None, port: int | None = None, path: str | None = None
+    ) -> asyncio.AbstractServer:
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._write_loop())
+        # архив загружается один раз, до подключения клиентов
+        self.library.archive.field_widths()
+        if path is not None:
+            self._server = await asyncio.start_unix_server(
+                self._handle_client, path=path, backlog=self.backlog
+            )
+        else:
+            self._server = await asyncio.start_server(
+                self._handle_client, host, port, backlog=self.backlog
+            )
+        return self._server
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+
+    def call(self, method: str, args: list[Any]) -> dict[str, Any]:
+        """
+        Вызов метода архива. Ошибки ввода и правил архива становятся ответом
+        клиенту, остальные исключения - ошибки сервера - пробрасываются.
+        """
+        func = getattr(self.library.archive, method)
+        try:
+            inspect.signature(func).bind(*args)
+        except TypeError:
+            return {
+                "ok": False,
+                "error": "InvalidInputData",
+                "message": f"Некорректные аргументы для метода '{method}'.",
+            }
+        try:
+            result = func(*args)
+            if method == "iter_books":
+                result = list(result)
+        except HANDLED_ERRORS as exc:
+            return {"ok": False, "error": type(exc).__name__, "message": str(exc)}
+        return {"ok": True, "result": result}
+
+    @staticmethod
+    def _server_error(exc: Exception) -> dict[str, Any]:
+        traceback.print_exception(exc, file=sys.stderr)
+        return {"ok": False, "error": "ServerError", "message": f"Ошибка сервера: {exc!r}."}
+
+    def _read(self, method: str, args: list[Any]) -> dict[str, Any]:
+        with self._lock.reading():
+            return self.call(method, args)
+
+    def _write(self, batch: list[tuple[str, list[Any]]]) -> list[dict[str, Any]]:
+        with self._lock.writing():
+            try:
+                with self.library.archive.batch():
+                    return [self._call_in_batch(method, args) for method, args in batch]
+            except HANDLED_ERRORS as exc:
+                return [{"ok": False, "error": type(exc).__name__, "message": str(exc)}] * len(batch)
+
+    def _call_in_batch(self, method: str, args: list[Any]) -> dict[str, Any]:
+        # остальные изменения пакета сохраняются, ошибку получает только этот клиент:
+        # add не идемпотентен, повтор всего пакета создал бы дубликаты
+        try:
+            return self.call(method, args)
+        except Exception as exc:
+            return self._server_error(exc)
+
+    async def _write_loop(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                # сохранение с fsync не должно останавливать цикл событий
+                requests = [(method, args) for method, args, _ in batch]
+                responses = await asyncio.to_thread(self._write, requests)
+            except Exception as exc:
+                # писатель продолжает работу, клиенты пакета получают ошибку
+                responses = [self._server_error(exc)] * len(batch)
+            for (_, _, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+
+    async def dispatch(self, request: dict[str, Any]) -> dict[str, Any]:
+        method, args = request.get("method"), request.get("args", [])
+        if not isinstance(args, list):
+            return {"ok": False, "error": "InvalidInputData", "message": "args должен быть списком."}
+        if method in self.READ_METHODS:
+            try:
+                return await asyncio.to_thread(self._read, method, args)
+            except Exception as exc:
+                return self._server_error(exc)
+        if method in self.WRITE_METHODS:
+            if message := check_write_args(method, args):
+                return {"ok": False, "error": "InvalidInputData", "message": message}
+            future = asyncio.get_running_loop().create_future()
+            await self._queue.put((method, args, future))
+            return await future
+        return {"ok": False, "error": "InvalidCommand", "message": f"Неизвестный метод: '{method}'."}
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError:
+                    response = {"ok": False, "error": "InvalidInputData", "message": "Некорректный json."}
+                else:
+                    response = await self.dispatch(request)
+                writer.write(json.dumps(response, ensure_ascii=False, default=dict).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(library: "Library", host: str | None, port: int | None, path: str | None) -> None:
+    server = ArchiveServer(library)
+    listener = await server.start(host, port, path)
+    print(f"Сервер библиотеки запущен: {path or f'{host}:{port}'}")
+    try:
+        await listener.serve_forever()
+    finally:
+        await server.stop()
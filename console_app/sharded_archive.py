@@ -0,0 +1,165 @@
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import chain, islice
+from typing import Any, Callable, Iterable, Iterator
+
+from .data import Archive, BaseArchive
+from .fuzzy import rank_books, top_ids
+
+
+class ShardedArchive(BaseArchive):
+    """
+    json архив, разбитый на shards файлов <архив>.<номер>of<shards>. Книга
+    попадает в шард по crc32 id оригинала, поэтому дубликаты всегда лежат
+    в шарде оригинала и правила дубликатов работают внутри одного шарда.
+
+    Каждый шард - обычный Archive со своим кешем, блокировкой и журналом:
+    команда над книгой загружает, блокирует и перезаписывает только ее шард.
+    Транзакция (команда или batch) открывает транзакции шардов по мере
+    обращения к ним. all, поиск и выборки обходят все шарды, с workers > 1 -
+    в пуле потоков.
+    """
+
+    _filename = "library_storage.json"
+    # шардов по умолчанию; при смене числа шардов книги нужно перенести (export и import)
+    shard_count = 8
+    OPTIONS = ("shards", "workers", *Archive.OPTIONS)
+
+    def __init__(self, shards: int | None = None, workers: int | None = None, **options: Any) -> None:
+        """options - параметры Archive шардов: journal, flush_delay, flush_every, codec."""
+        self.shards = shards or self.shard_count
+        self.workers = workers
+        self._options = options
+        self._shard_list: list[Archive] = []
+        self._shards_filename = None
+        # шарды, чьи транзакции открыты в текущей транзакции архива
+        self._stack: ExitStack | None = None
+        self._entered: set[int] = set()
+
+    @property
+    def shard_archives(self) -> list[Archive]:
+        if self._shards_filename != self._filename:
+            self._shard_list = []
+            for num in range(self.shards):
+                shard = Archive(**self._options)
+                shard._filename = f"{self._filename}.{num}of{self.shards}"
+                shard.lock_timeout = self.lock_timeout
+                self._shard_list.append(shard)
+            self._shards_filename = self._filename
+        return self._shard_list
+
+    def _shard_num(self, id: str) -> int:
+        return zlib.crc32(self._split_id(id)[0].encode()) % self.shards
+
+    def _map(self, func: Callable[[Archive], Any]) -> list[Any]:
+        """func над каждым шардом, в порядке шардов."""
+        if self.workers is None or self.workers < 2:
+            return [func(shard) for shard in self.shard_archives]
+        with ThreadPoolExecutor(min(self.workers, self.shards)) as pool:
+            return list(pool.map(func, self.shard_archives))
+
+    def _shard(self, id: str) -> Archive:
+        """
+        Шард книги. В транзакции архива транзакция шарда открывается при первом
+        обращении к нему. Вне транзакции (чтение _get, _find_dublicate) шард
+        только загружается или перечитывается, если его изменили.
+        """
+        num = self._shard_num(id)
+        shard = self.shard_archives[num]
+        if self._stack is None:
+            shard.cache
+            return shard
+        if num not in self._entered:
+            self._stack.enter_context(shard._transaction())
+            self._entered.add(num)
+        return shard
+
+    def _begin(self) -> None:
+        self._stack = ExitStack()
+        self._entered = set()
+
+    def _commit(self) -> None:
+        stack, self._stack = self._stack, None
+        stack.close()
+
+    def _rollback(self) -> None:
+        stack, self._stack = self._stack, None
+        # каждый шард откатывает (сохраняет) свою транзакцию
+        stack.__exit__(*sys.exc_info())
+
+    def _get(self, id: str) -> dict[str] | None:
+        return self._shard(id)._get(id)
+
+    def _set(self, id: str, book: dict[str]) -> None:
+        self._shard(id)._set(id, book)
+
+    def _remove(self, id: str) -> None:
+        self._shard(id)._remove(id)
+
+    def _find_dublicate(self, id: str) -> str | None:
+        return self._shard(id)._find_dublicate(id)
+
+    def _gen_actual_id(self, income_data_id: str) -> str:
+        return self._shard(income_data_id)._gen_actual_id(income_data_id)
+
+    def _replace_all(self, storage_data: dict[str, dict[str]]) -> None:
+        parts = [{} for _ in range(self.shards)]
+        for id, book in storage_data.items():
+            parts[self._shard_num(id)][id] = book
+        for shard, part in zip(self.shard_archives, parts):
+            shard._replace_all(part)
+
+    def flush(self) -> None:
+        for shard in self.shard_archives:
+            shard.flush()
+
+    def compact(self) -> None:
+        for shard in self.shard_archives:
+            shard.compact()
+
+    def all(self) -> dict[str, dict[str]]:
+        storage_data = {}
+        for shard_data in self._map(Archive.all):
+            storage_data.update(shard_data)
+        return storage_data
+
+    def iter_books(self, offset: int = 0, limit: int | None = None) -> Iterator[tuple[str, dict[str]]]:
+        # шарды загружаются сразу (параллельно с workers), книги отдаются по мере обхода
+        self._map(Archive.field_widths)
+        books = chain.from_iterable(shard.iter_books() for shard in self.shard_archives)
+        stop = None if limit is None else offset + limit
+        return islice(books, offset, stop)
+
+    def field_widths(self) -> dict[str, int]:
+        widths = self._map(Archive.field_widths)
+        return {field: max(shard[field] for shard in widths) for field in widths[0]}
+
+    def _books(self, ids: Iterable[str]) -> list[tuple[str, dict[str]]]:
+        shards = self.shard_archives
+        return [(id, shards[self._shard_num(id)].cache[id]) for id in ids]
+
+    def search(self, filter_attr: str) -> list[tuple[str, dict[str]]]:
+        found = self._map(lambda shard: shard._search_ids(filter_attr))
+        exact = set().union(*(ids for ids, _ in found))
+        partial = set().union(*(ids for _, ids in found))
+        return self._books(chain(sorted(exact), sorted(partial)))
+
+    def search_similar(self, query: str, limit: int | None = None) -> list[tuple[str, dict[str]]]:
+        # книга подходит под запрос по словам своего шарда, поэтому оценки
+        # шардов не пересекаются и объединяются без пересчета
+        words = query.casefold().split()
+        if not words:
+            return []
+        scores = {}
+        for shard_scores in self._map(lambda shard: rank_books(shard._vocabulary(), words, shard._token_ids)):
+            scores.update(shard_scores)
+        return self._books(top_ids(scores, limit))
+
+    def books_with_status(self, status: str) -> list[tuple[str, dict[str]]]:
+        return list(chain.from_iterable(self._map(lambda shard: shard.books_with_status(status))))
+
+    def copy_counts(self, title: str) -> list[tuple[str, dict[str], int, int]]:
+        counts = chain.from_iterable(self._map(lambda shard: shard.copy_counts(title)))
+        return sorted(counts, key=lambda count: count[0])
@@ -0,0 +1,187 @@
+import gc
+import json
+import sys
+from array import array
+from itertools import accumulate
+from operator import itemgetter
+from typing import Any, BinaryIO, Callable, Mapping
+
+try:
+    import orjson
+except ImportError:  # без orjson работает стандартный json
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # без msgpack вместо него используется свой бинарный формат
+    msgpack = None
+
+StorageData = Mapping[str, Mapping[str, str]]
+# собирает запись книги из значений полей в порядке fields
+RecordFactory = Callable[..., Any]
+
+
+def _dict_record(fields: tuple[str, ...]) -> RecordFactory:
+    return lambda *values: dict(zip(fields, values))
+
+
+class SnapshotCodec:
+    """
+    Формат файла снапшота. Бинарные форматы начинаются с magic,
+    по нему формат определяется при загрузке.
+    """
+
+    magic = b""
+
+    def dump(self, storage_data: StorageData, f: BinaryIO) -> None:
+        raise NotImplementedError
+
+    def load(self, f: BinaryIO, fields: tuple[str, ...], record: RecordFactory) -> dict[str, Any]:
+        raise NotImplementedError
+
+    @staticmethod
+    def _records(
+        storage_data: dict[str, Mapping[str, str]], fields: tuple[str, ...], record: RecordFactory
+    ) -> dict[str, Any]:
+        values = itemgetter(*fields)
+        for id, book in storage_data.items():
+            storage_data[id] = record(*values(book))
+        return storage_data
+
+
+class JSONCodec(SnapshotCodec):
+    """Компактный json без отступов, через orjson, если он установлен."""
+
+    def dump(self, storage_data: StorageData, f: BinaryIO) -> None:
+        if orjson is not None:
+            f.write(orjson.dumps(storage_data, default=dict))
+            return
+        f.write(
+            json.dumps(storage_data, ensure_ascii=False, separators=(",", ":"), default=dict).encode()
+        )
+
+    def load(self, f: BinaryIO, fields: tuple[str, ...], record: RecordFactory) -> dict[str, Any]:
+        if orjson is not None:
+            return self._records(orjson.loads(f.read()), fields, record)
+        return self._records(json.loads(f.read()), fields, record)
+
+
+class PrettyJSONCodec(JSONCodec):
+    """Json с отступами, как раньше, - для экспорта и чтения глазами."""
+
+    def dump(self, storage_data: StorageData, f: BinaryIO) -> None:
+        f.write(json.dumps(storage_data, ensure_ascii=False, indent=2, default=dict).encode())
+
+
+class MsgpackCodec(SnapshotCodec):
+    magic = b"LIBMSGP\x01"
+
+    def dump(self, storage_data: StorageData, f: BinaryIO) -> None:
+        f.write(self.magic)
+        f.write(msgpack.packb(storage_data, default=dict))
+
+    def load(self, f: BinaryIO, fields: tuple[str, ...], record: RecordFactory) -> dict[str, Any]:
+        if msgpack is None:
+            raise ValueError("Снапшот записан в формате msgpack, но msgpack не установлен.")
+        f.read(len(self.magic))
+        return self._records(msgpack.unpackb(f.read()), fields, record)
+
+
+class BinaryCodec(SnapshotCodec):
+    """
+    Свой формат на стандартной библиотеке:
+
+        magic | u32 длина заголовка | заголовок json {"fields", "count"}
+        | длины всех строк (u32, little-endian) | все строки подряд в utf-8
+
+    Строки идут по колонкам: все id, затем значения каждого поля из заголовка.
+    Длины считаются в символах, поэтому весь текст декодируется одним вызовом
+    и режется срезами, а записи собираются из колонок без промежуточных dict.
+    """
+
+    magic = b"LIBSNAP\x01"
+
+    def dump(self, storage_data: StorageData, f: BinaryIO) -> None:
+        fields = next((tuple(book) for book in storage_data.values()), ())
+        strings = list(storage_data)
+        for field in fields:
+            strings.extend(book[field] for book in storage_data.values())
+        lengths = array("I", map(len, strings))
+        if sys.byteorder == "big":
+            lengths.byteswap()
+        header = json.dumps({"fields": fields, "count": len(storage_data)}).encode()
+        f.write(self.magic)
+        f.write(len(header).to_bytes(4, "little"))
+        f.write(header)
+        f.write(lengths.tobytes())
+        f.write("".join(strings).encode())
+
+    def load(self, f: BinaryIO, fields: tuple[str, ...], record: RecordFactory) -> dict[str, Any]:
+        f.read(len(self.magic))
+        header = json.loads(f.read(int.from_bytes(f.read(4), "little")))
+        count = header["count"]
+        if not count:
+            return {}
+        lengths = array("I")
+        lengths.frombytes(f.read(4 * count * (len(header["fields"]) + 1)))
+        if sys.byteorder == "big":
+            lengths.byteswap()
+        text = f.read().decode()
+        offsets = list(accumulate(lengths, initial=0))
+        strings = [text[start:stop] for start, stop in zip(offsets, offsets[1:])]
+        columns = {
+            field: strings[count * pos : count * (pos + 1)]
+            for pos, field in enumerate(["id", *header["fields"]])
+        }
+        return dict(zip(columns["id"], map(record, *(columns[field] for field in fields))))
+
+
+SNAPSHOT_CODECS: dict[str, SnapshotCodec] = {
+    "json": JSONCodec(),
+    "pretty": PrettyJSONCodec(),
+    "binary": BinaryCodec(),
+    "msgpack": MsgpackCodec(),
+}
+
+
+def get_snapshot_codec(name: str) -> SnapshotCodec:
+    if name == "msgpack" and msgpack is None:
+        return SNAPSHOT_CODECS["binary"]
+    try:
+        return SNAPSHOT_CODECS[name]
+    except KeyError:
+        raise ValueError(
+            f"Неизвестный формат снапшота: '{name}'. Доступны: {', '.join(SNAPSHOT_CODECS)}."
+        ) from None
+
+
+def detect_snapshot_codec(head: bytes) -> SnapshotCodec:
+    """Формат по первым байтам файла: бинарные форматы по magic, иначе json."""
+    for codec in SNAPSHOT_CODECS.values():
+        if codec.magic and head.startswith(codec.magic):
+            return codec
+    return SNAPSHOT_CODECS["json"]
+
+
+def read_snapshot(
+    f: BinaryIO, fields: tuple[str, ...], record: RecordFactory | None = None
+) -> dict[str, Any]:
+    """
+    Читает снапшот в любом формате. record получает значения fields
+    и возвращает запись книги, по умолчанию dict.
+    """
+    head = f.read(max(len(codec.magic) for codec in SNAPSHOT_CODECS.values()))
+    f.seek(0)
+    codec = detect_snapshot_codec(head)
+    # миллионы новых записей раз за разом запускают сборщик циклов впустую
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return codec.load(f, fields, record or _dict_record(fields))
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def write_snapshot(storage_data: StorageData, f: BinaryIO, codec: str = "json") -> None:
+    get_snapshot_codec(codec).dump(storage_data, f)
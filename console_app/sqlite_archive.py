@@ -0,0 +1,268 @@
+import sqlite3
+from contextlib import contextmanager
+from typing import Collection, Iterator
+
+from .data import BOOK_FIELDS, SEARCH_FIELDS, BaseArchive
+from .exceptions import ArchiveLocked
+from .fuzzy import TrigramIndex
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id TEXT PRIMARY KEY,
+    base_id TEXT NOT NULL,
+    dublicate INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    year TEXT NOT NULL,
+    status TEXT NOT NULL,
+    title_key TEXT NOT NULL,
+    author_key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS books_base_id ON books (base_id, dublicate);
+CREATE INDEX IF NOT EXISTS books_title ON books (title_key);
+CREATE INDEX IF NOT EXISTS books_author ON books (author_key);
+CREATE INDEX IF NOT EXISTS books_year ON books (year);
+CREATE INDEX IF NOT EXISTS books_status ON books (status);
+CREATE TABLE IF NOT EXISTS search_tokens (
+    token TEXT NOT NULL,
+    id TEXT NOT NULL,
+    PRIMARY KEY (token, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS search_tokens_id ON search_tokens (id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+# столбцы books, которые меняет повторная запись книги с тем же id
+BOOK_COLUMNS = ("base_id", "dublicate", *BOOK_FIELDS, "title_key", "author_key")
+
+
+class SQLiteArchive(BaseArchive):
+    """
+    Архив в базе sqlite. Книги не держатся в памяти целиком,
+    дубликаты и поиск обслуживаются индексами базы.
+    """
+
+    _filename = "library_storage.sqlite3"
+    # триграммы словаря и data_version базы, для которой они построены
+    _trigrams: TrigramIndex | None = None
+    _trigrams_version: int | None = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if hasattr(self, "_connection"):
+            return self._connection
+        # транзакции открываются явно в _transaction; сервер обращается
+        # к архиву из потоков, sqlite3.threadsafety разрешает общее соединение
+        self._connection = sqlite3.connect(
+            self._filename, isolation_level=None, timeout=self.lock_timeout, check_same_thread=False
+        )
+        # в режиме WAL читатели не ждут писателя
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def close(self) -> None:
+        if hasattr(self, "_connection"):
+            self._connection.close()
+            delattr(self, "_connection")
+
+    def _begin(self) -> None:
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as exc:
+            raise ArchiveLocked(
+                "Архив занят другим процессом, попробуйте повторить команду позже."
+            ) from exc
+
+    def _commit(self) -> None:
+        self.connection.execute("COMMIT")
+
+    def _rollback(self) -> None:
+        self.connection.execute("ROLLBACK")
+        # триграммы уже обновлены изменениями, которые откатились
+        self._trigrams = None
+
+    @contextmanager
+    def _savepoint(self) -> Iterator[None]:
+        self.connection.execute("SAVEPOINT command")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK TO command")
+            self._trigrams = None
+            raise
+        finally:
+            self.connection.execute("RELEASE command")
+
+    def get_id_scheme(self) -> str | None:
+        # схема хранится в самой базе и копируется вместе с ней
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'id_scheme'").fetchone()
+        return row and row[0]
+
+    def set_id_scheme(self, name: str) -> None:
+        self.connection.execute(
+            "INSERT INTO meta VALUES ('id_scheme', ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (name,),
+        )
+
+    def _get(self, id: str) -> dict[str] | None:
+        row = self.connection.execute(
+            "SELECT title, author, year, status FROM books WHERE id = ?", (id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(BOOK_FIELDS, row))
+
+    def _set(self, id: str, book: dict[str]) -> None:
+        base_id, num = self._split_id(id)
+        connection = self.connection
+        # upsert, а не INSERT OR REPLACE: замена удаляет строку и дает ей новый rowid,
+        # и книга со сменой статуса уходила бы в конец all и iter_books
+        connection.execute(
+            "INSERT INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+            + ", ".join(f"{column} = excluded.{column}" for column in BOOK_COLUMNS),
+            (
+                id,
+                base_id,
+                num or 0,
+                *(book[field] for field in BOOK_FIELDS),
+                book["title"].casefold(),
+                book["author"].casefold(),
+            ),
+        )
+        if num is None:
+            _, tokens = self._search_keys(book[field] for field in SEARCH_FIELDS)
+            self._drop_tokens(id, keep=tokens)
+            connection.executemany(
+                "INSERT INTO search_tokens VALUES (?, ?)", ((token, id) for token in tokens)
+            )
+            if self._trigrams is not None:
+                for token in tokens:
+                    self._trigrams.add(token)
+
+    def _remove(self, id: str) -> None:
+        self.connection.execute("DELETE FROM books WHERE id = ?", (id,))
+        if self._split_id(id)[1] is None:
+            self._drop_tokens(id)
+
+    def _drop_tokens(self, id: str, keep: Collection[str] = ()) -> None:
+        """
+        Удаляет слова книги из search_tokens. Слово, которого больше нет ни у одной
+        книги (и нет в keep), удаляется и из построенных триграмм словаря.
+        """
+        connection = self.connection
+        dropped = []
+        if self._trigrams is not None:
+            cursor = connection.execute("SELECT token FROM search_tokens WHERE id = ?", (id,))
+            dropped = [token for (token,) in cursor if token not in keep]
+        connection.execute("DELETE FROM search_tokens WHERE id = ?", (id,))
+        for token in dropped:
+            used = connection.execute("SELECT 1 FROM search_tokens WHERE token = ? LIMIT 1", (token,))
+            if used.fetchone() is None:
+                self._trigrams.discard(token)
+
+    def _last_dublicate_num(self, id: str) -> int:
+        (num,) = self.connection.execute(
+            "SELECT MAX(dublicate) FROM books WHERE base_id = ?", (id,)
+        ).fetchone()
+        return num or 0
+
+    def _find_dublicate(self, id: str) -> str | None:
+        if num := self._last_dublicate_num(id):
+            return f"{id}d{num}"
+        return None
+
+    def _gen_actual_id(self, income_data_id: str) -> str:
+        return f"{income_data_id}d{self._last_dublicate_num(income_data_id) + 1}"
+
+    def _replace_all(self, storage_data: dict[str, dict[str]]) -> None:
+        with self._transaction():
+            self.connection.execute("DELETE FROM books")
+            self.connection.execute("DELETE FROM search_tokens")
+            # словарь меняется целиком, триграммы строятся заново при поиске
+            self._trigrams = None
+            for id, book in storage_data.items():
+                self._set(id, book)
+
+    def _rows(self, sql: str, params: tuple = ()) -> list[tuple[str, dict[str]]]:
+        return [
+            (id, dict(zip(BOOK_FIELDS, book)))
+            for id, *book in self.connection.execute(sql, params)
+        ]
+
+    def all(self) -> dict[str, dict[str]]:
+        return dict(self._rows("SELECT id, title, author, year, status FROM books ORDER BY rowid"))
+
+    def iter_books(self, offset: int = 0, limit: int | None = None) -> Iterator[tuple[str, dict[str]]]:
+        cursor = self.connection.execute(
+            "SELECT id, title, author, year, status FROM books WHERE dublicate = 0 "
+            "ORDER BY rowid LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset),
+        )
+        for id, *book in cursor:
+            yield id, dict(zip(BOOK_FIELDS, book))
+
+    def field_widths(self) -> dict[str, int]:
+        row = self.connection.execute(
+            "SELECT MAX(LENGTH(id)), MAX(LENGTH(title)), MAX(LENGTH(author)), "
+            "MAX(LENGTH(year)), MAX(LENGTH(status)) FROM books WHERE dublicate = 0"
+        ).fetchone()
+        return {field: width or 0 for field, width in zip(("id", *BOOK_FIELDS), row)}
+
+    def search(self, filter_attr: str) -> list[tuple[str, dict[str]]]:
+        query = filter_attr.casefold().strip()
+        exact = self._rows(
+            "SELECT id, title, author, year, status FROM books "
+            "WHERE dublicate = 0 AND (title_key = ? OR author_key = ? OR year = ?) ORDER BY id",
+            (query, query, query),
+        )
+        tokens = set(query.split())
+        if not tokens:
+            return exact
+        partial = self._rows(
+            "SELECT id, title, author, year, status FROM books JOIN ("
+            "  SELECT id FROM search_tokens"
+            f"  WHERE token IN ({', '.join('?' * len(tokens))})"
+            "  GROUP BY id HAVING COUNT(*) = ?"
+            ") USING (id) ORDER BY id",
+            (*tokens, len(tokens)),
+        )
+        exact_ids = {id for id, _ in exact}
+        return exact + [(id, book) for id, book in partial if id not in exact_ids]
+
+    def books_with_status(self, status: str) -> list[tuple[str, dict[str]]]:
+        return self._rows(
+            "SELECT id, title, author, year, status FROM books "
+            "WHERE dublicate = 0 AND status = ? ORDER BY rowid",
+            (status,),
+        )
+
+    def copy_counts(self, title: str) -> list[tuple[str, dict[str], int, int]]:
+        # экземпляры книги - все строки с ее base_id, включая сам оригинал
+        cursor = self.connection.execute(
+            "SELECT book.id, book.title, book.author, book.year, book.status, "
+            "COUNT(*), SUM(copy.status = ?) "
+            "FROM books AS book JOIN books AS copy ON copy.base_id = book.id "
+            "WHERE book.dublicate = 0 AND book.title_key = ? GROUP BY book.id ORDER BY book.id",
+            ("в наличии", title.casefold().strip()),
+        )
+        return [
+            (id, dict(zip(BOOK_FIELDS, book)), copies, available)
+            for id, *book, copies, available in cursor
+        ]
+
+    def _vocabulary(self) -> TrigramIndex:
+        # data_version меняется, когда базу изменил другой процесс,
+        # свои изменения обновляют триграммы в _set и _remove
+        (version,) = self.connection.execute("PRAGMA data_version").fetchone()
+        if self._trigrams is None or self._trigrams_version != version:
+            tokens = self.connection.execute("SELECT DISTINCT token FROM search_tokens")
+            self._trigrams = TrigramIndex(token for (token,) in tokens)
+            self._trigrams_version = version
+        return self._trigrams
+
+    def _token_ids(self, token: str) -> Collection[str]:
+        cursor = self.connection.execute("SELECT id FROM search_tokens WHERE token = ?", (token,))
+        return {id for (id,) in cursor}
@@ -0,0 +1,260 @@
+import functools
+import json
+import os
+import sys
+import time
+from typing import Any, Callable
+
+from .render import TableRenderer
+
+
+class Stats:
+    """
+    Статистика производительности, выключена по умолчанию.
+
+    Замеры времени ставятся обертками на методы классов только при enable(),
+    поэтому без статистики методы вызываются как обычно. Счетчики (байты,
+    попадания в кеш) увеличиваются там, где происходит ввод-вывод, под
+    проверкой STATS.enabled - один раз на чтение или запись файла.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.profile_dir: str | None = None
+        # методы под замером: (класс, имя метода), disable возвращает исходные
+        self._wrapped: list[tuple[type, str]] = []
+        self.reset()
+
+    def reset(self) -> None:
+        # имя -> [вызовов, суммарное время, максимальное время]
+        self.timings: dict[str, list] = {}
+        self.counters: dict[str, int] = {}
+        self._profiled = 0
+
+    def incr(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name: str, seconds: float) -> None:
+        timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+    def report(self) -> dict[str, Any]:
+        return {
+            "timings": {
+                name: {
+                    "calls": calls,
+                    "total_ms": round(total * 1000, 3),
+                    "avg_ms": round(total * 1000 / calls, 3),
+                    "max_ms": round(longest * 1000, 3),
+                }
+                for name, (calls, total, longest) in sorted(self.timings.items())
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def render(self) -> str:
+        report = self.report()
+        rows = [
+            (name, timing["calls"], timing["total_ms"], timing["avg_ms"], timing["max_ms"])
+            for name, timing in report["timings"].items()
+        ]
+        rows += [(name, value, "-", "-", "-") for name, value in report["counters"].items()]
+        head = ("МЕТРИКА", "ВЫЗОВОВ", "ВСЕГО МС", "СРЕДНЕЕ МС", "МАКС МС")
+        return TableRenderer.fit(head, rows).render([head, *rows])
+
+    def _total(self, prefix: str) -> float:
+        return sum((timing[1] for name, timing in self.timings.items() if name.startswith(prefix)), 0.0)
+
+    def render_startup(self, interpreter: float | None, imports: float, total: float) -> str:
+        """
+        Отчет о запуске: интерпретатор (до начала работы модуля), импорт модулей,
+        загрузка архива и выполнение команд. Время в миллисекундах.
+        """
+        def ms(seconds: float) -> float:
+            return round(seconds * 1000, 1)
+
+        rows = [
+            ("запуск интерпретатора", "-" if interpreter is None else ms(interpreter)),
+            ("импорт модулей", ms(imports)),
+            ("загрузка архива", ms(self._total("Archive._load"))),
+            ("  быстрый старт: чтение", ms(self._total("Archive._read_fast_start"))),
+            ("  быстрый старт: запись", ms(self._total("Archive._write_fast_start"))),
+            ("  индексы", ms(self._total("Archive._build_indexes"))),
+            ("команды", ms(self._total("command."))),
+            ("всего без запуска интерпретатора", ms(total)),
+        ]
+        head = ("ЭТАП", "МС")
+        return TableRenderer.fit(head, rows).render([head, *rows])
+
+    def dump(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+
+    def timed(self, name: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add_time(name, time.perf_counter() - start)
+
+        return wrapper
+
+    def command(self, func: Callable[..., Any], command_name: Callable[..., str]) -> Callable[..., Any]:
+        """
+        Обертка точки входа команды: время пишется в "command.<имя>",
+        а с profile_dir каждый вызов еще и профилируется cProfile
+        в свой файл NNNN-<имя>.prof.
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            name = command_name(*args)
+            profile = None
+            if self.profile_dir is not None:
+                import cProfile
+
+                profile = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                if profile is None:
+                    return func(*args)
+                return profile.runcall(func, *args)
+            finally:
+                self.add_time(f"command.{name}", time.perf_counter() - start)
+                if profile is not None:
+                    self._profiled += 1
+                    profile.dump_stats(os.path.join(self.profile_dir, f"{self._profiled:04d}-{name}.prof"))
+
+        return wrapper
+
+    def enable(self, profile_dir: str | None = None) -> None:
+        """Включает замеры. profile_dir - каталог для cProfile каждой команды."""
+        if self.enabled:
+            return
+        self.enabled = True
+        self.profile_dir = profile_dir
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+        for cls, methods in _instrumented().items():
+            self._wrap(cls, methods)
+        # хранилища импортируются лениво (backends.py), замеряются только уже загруженные:
+        # импорт здесь тянул бы sqlite3 и mmap в каждый запуск и в отчет о запуске
+        for path, methods in BACKEND_METHODS.items():
+            module, _, name = path.partition(":")
+            if (loaded := sys.modules.get(f"{__package__}.{module}")) is not None:
+                self._wrap(getattr(loaded, name), methods)
+        for cls, method, command_name in _entrypoints():
+            setattr(cls, method, self.command(cls.__dict__[method], command_name))
+
+    def _wrap(self, cls: type, methods: tuple[str, ...]) -> None:
+        for method in methods:
+            setattr(cls, method, self.timed(f"{cls.__name__}.{method}", cls.__dict__[method]))
+            self._wrapped.append((cls, method))
+
+    def instrument_backend(self, path: str, cls: type) -> None:
+        """Замеры хранилища path ("модуль:класс"), загруженного get_archive_backend после enable."""
+        methods = BACKEND_METHODS.get(path)
+        if self.enabled and methods and (cls, methods[0]) not in self._wrapped:
+            self._wrap(cls, methods)
+
+    def disable(self) -> None:
+        if not self.enabled:
+            return
+        for cls, method in reversed(self._wrapped):
+            setattr(cls, method, cls.__dict__[method].__wrapped__)
+        self._wrapped.clear()
+        for cls, method, _ in _entrypoints():
+            setattr(cls, method, cls.__dict__[method].__wrapped__)
+        self.enabled = False
+        self.profile_dir = None
+
+
+def process_age() -> float | None:
+    """Сколько секунд работает процесс, по /proc (только linux, точность 10 мс)."""
+    try:
+        with open("/proc/self/stat") as f:
+            # после имени процесса в скобках starttime - 20-е поле
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def _instrumented() -> dict[type, tuple[str, ...]]:
+    """Методы, время которых замеряется: ввод-вывод архивов, дубликаты, поиск, вывод таблиц."""
+    from .data import Archive, BaseArchive, FileLockMixin
+    from .main import Library
+
+    return {
+        Archive: (
+            "_load",
+            "_dump",
+            "_replay_journal",
+            "_append_journal",
+            "_build_indexes",
+            "_find_dublicate",
+            "_gen_actual_id",
+            "_vocabulary",
+            "search",
+            "compact",
+            "export_changes",
+            "_read_fast_start",
+            "_write_fast_start",
+        ),
+        BaseArchive: ("search_similar",),
+        FileLockMixin: ("_acquire_lock",),
+        TableRenderer: ("write",),
+        Library: ("formatted_style",),
+    }
+
+
+# методы хранилищ из backends.ARCHIVE_BACKENDS ("модуль:класс"), модули которых
+# импортируются только при выборе хранилища
+BACKEND_METHODS: dict[str, tuple[str, ...]] = {
+    "sqlite_archive:SQLiteArchive": (
+        "_begin",
+        "_commit",
+        "_find_dublicate",
+        "_gen_actual_id",
+        "_vocabulary",
+        "search",
+    ),
+    "mmap_archive:MmapArchive": (
+        "_open",
+        "_commit",
+        "_find_slot",
+        "_read_record",
+        "_append_record",
+        "_vocabulary",
+        "search",
+    ),
+}
+
+
+def _entrypoints() -> tuple[tuple[type, str, Callable[..., str]], ...]:
+    """Точки входа команд: интерактивный режим и пакетный режим."""
+    from .batch import BatchRunner
+    from .commands import parse_command
+    from .exceptions import InvalidCommand, InvalidInputData
+    from .main import Library
+
+    def batch_command_name(runner: BatchRunner, line: str) -> str:
+        # те же имена, что в интерактивном режиме: "change status ..." - change_status
+        try:
+            return parse_command(line)[0]
+        except (InvalidCommand, InvalidInputData):
+            return "-"
+
+    return (
+        (Library, "command_execute", lambda library: library._current_cmd),
+        (BatchRunner, "execute", batch_command_name),
+    )
+
+
+STATS = Stats()
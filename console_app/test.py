@@ -1,10 +1,30 @@
+import io
 import os
+import json
+import sys
+import asyncio
+import threading
+import weakref
 
-from typing import Iterable
+from typing import Any, Iterable
 import unittest
+import unittest.mock
 
 from .main import Library
-from .exceptions import DataDoesNotExists, TheSameStatus
+from .backends import get_archive_backend
+from .bench import generate_catalogue, run_benchmarks
+from .client import RemoteArchive
+from .data import Archive, BaseArchive, Book, Status
+from .fuzzy import TrigramIndex
+from .render import TableRenderer
+from .server import ArchiveServer
+from .snapshot import SNAPSHOT_CODECS, read_snapshot
+from .stats import STATS
+from .mmap_archive import MmapArchive
+from .sharded_archive import ShardedArchive
+from .sqlite_archive import SQLiteArchive
+from .ids import charsum_id, content_hash_id
+from .exceptions import ArchiveLocked, DataDoesNotExists, InvalidInputData, TheSameStatus
 
 
 class mock_input:
@@ -19,11 +39,73 @@ class mock_input:
         return value
 
 
+def remove_archive_files(filename: str) -> None:
+    for suffix in ("", ".log", ".lock", ".changes", ".fast", ".ids"):
+        path = f"{filename}{suffix}"
+        if os.path.exists(path):
+            os.remove(path)
+
+
+BOOK = {
+    "title": "cool book",
+    "author": "cool author",
+    "year": "1995",
+    "status": "в наличии",
+}
+
+
+class ArchiveTestCase(unittest.TestCase):
+    """
+    Тест над архивом в файле test_library.json: self.archive и книга self.book.
+    Файлы архивов из make_archive удаляются после теста.
+    """
+
+    archive_class: type[BaseArchive] = Archive
+    archive_options: dict[str, Any] = {}
+
+    def setUp(self):
+        self.book = dict(BOOK)
+        self.archive = self.make_archive(**self.archive_options)
+
+    def make_archive(self, filename: str = "test_library.json", **options) -> BaseArchive:
+        archive = self.archive_class(**options)
+        archive._filename = filename
+        self.addCleanup(remove_archive_files, filename)
+        return archive
+
+
+def check_status_views(test: unittest.TestCase, archive) -> None:
+    """Выборки по статусу и счетчики экземпляров после add, change_status и delete."""
+    book = {"title": "Процесс", "author": "Франц Кафка", "year": "1925", "status": "в наличии"}
+    archive.add({"t1a1y1": dict(book)})
+    archive.add({"t1a1y1": dict(book)})
+    archive.add({"t2a2y2": dict(book, author="Другой автор")})
+    archive.change_status("t2a2y2", "выдана")
+
+    def counts(title: str) -> list[tuple[str, int, int]]:
+        return [(id, copies, available) for id, _, copies, available in archive.copy_counts(title)]
+
+    def ids(status: str) -> list[str]:
+        return [id for id, _ in archive.books_with_status(status)]
+
+    test.assertIn("t2a2y2", ids("выдана"))
+    test.assertNotIn("t2a2y2", ids("в наличии"))
+    test.assertIn("t1a1y1", ids("в наличии"))
+    test.assertNotIn("t1a1y1d1", ids("в наличии"))
+    test.assertEqual(counts("процесс"), [("t1a1y1", 2, 2), ("t2a2y2", 1, 0)])
+    # выдача книги с дубликатом забирает дубликат
+    archive.change_status("t1a1y1", "выдана")
+    test.assertEqual(counts("Процесс"), [("t1a1y1", 1, 1), ("t2a2y2", 1, 0)])
+    archive.delete("t2a2y2")
+    test.assertNotIn("t2a2y2", ids("выдана"))
+    test.assertEqual(counts("Франц Кафка"), [])
+
+
 class catch_print:
     def __init__(self):
         self.catch_data = []
 
-    def __call__(self, string: str) -> None:
+    def __call__(self, string: str, **kwargs) -> None:
         self.catch_data.clear()
         self.catch_data.append(string)
 
@@ -40,8 +122,7 @@ class TestLibraryIOCommand(unittest.TestCase):
         self.library.archive._filename = "test_library.json"
 
     def tearDown(self) -> None:
-        if os.path.exists(self.library.archive._filename):
-            os.remove(self.library.archive._filename)
+        remove_archive_files(self.library.archive._filename)
 
     def test_valid_input_command(self):
         expected_output = (
@@ -138,6 +219,55 @@ class TestLibraryIOCommand(unittest.TestCase):
                         f"Неожиданый ответ скрипта на данные '{data[1:]}' для команды {data[0]}",
                     )
 
+    def test_inline_arguments(self):
+        id = self.library._gen_id({"t": "Процесс", "a": "Франц Кафка", "y": "1925"})
+        lines = ['add Процесс "Франц Кафка" 1925', f"change status {id} в наличии", f"DELETE {id}"]
+        inp = mock_input(lines)
+        __builtins__.input = inp
+        with self.assertRaises(StopIteration):
+            self.library.enter()
+        # аргументы взяты из строки команды, дополнительных запросов не было
+        self.assertEqual(inp.outputs, ["Введите команду: "] * (len(lines) + 1))
+        self.assertEqual(self.mock_print.catch_data, ["Книга успешно удалена из архива."])
+        with self.assertRaises(DataDoesNotExists):
+            self.library.archive.delete(id)
+
+    def test_all_prints_rows(self):
+        self.library.archive.add({"t1a1y1": dict(BOOK)})
+        self.library.archive.add({"t2a2y2": dict(BOOK, title="Процесс")})
+        with unittest.mock.patch("builtins.print") as mock_print:
+            self.library.all(1, 1)
+        output = "".join(call.args[0] for call in mock_print.call_args_list)
+        self.assertIn("| t2a2y2|", output)
+        self.assertIn("Процесс", output)
+        self.assertNotIn("t1a1y1", output)
+
+    def test_unbalanced_quote(self):
+        __builtins__.input = mock_input(['add "Процесс', "cmd"])
+        with self.assertRaises(StopIteration):
+            self.library.enter()
+        # ошибка разбора выводится, меню продолжает принимать команды
+        self.assertEqual(__builtins__.input.outputs, ["Введите команду: "] * 3)
+        self.assertEqual(self.library.archive.all(), {})
+
+    def test_backend_options_are_checked(self):
+        unsupported = (
+            {"storage": "sqlite", "journal": True},
+            {"storage": "mmap", "codec": "binary"},
+            {"shards": 4},
+        )
+        for options in unsupported:
+            with self.subTest(options=options):
+                self.assertRaises(InvalidInputData, Library, **options)
+        self.assertEqual(Library(storage="sharded", shards=4, journal=True).archive.shards, 4)
+
+    def test_extra_words_need_quotes(self):
+        __builtins__.input = mock_input(["add Война и мир Толстой 1869"])
+        with self.assertRaises(StopIteration):
+            self.library.enter()
+        self.assertIn("возьмите в кавычки", str(self.mock_print.catch_data[-1]))
+        self.assertEqual(self.library.archive.all(), {})
+
 
 class TesArchiveLogic(unittest.TestCase):
     def setUp(self):
@@ -148,7 +278,7 @@ class TesArchiveLogic(unittest.TestCase):
         self.archive.add(self.book_registred_early())
 
     def tearDown(self) -> None:
-        os.remove(self.archive._filename)
+        remove_archive_files(self.archive._filename)
 
     def book_fixture(self):
         new_book = {
@@ -205,7 +335,7 @@ class TesArchiveLogic(unittest.TestCase):
                 expect_id, expect_body = expect_data
                 self.archive.add(add_data)
                 self.assertIsNotNone(cache.get(expect_id))
-                self.assertDictEqual(cache[expect_id], expect_body)
+                self.assertDictEqual(dict(cache[expect_id]), expect_body)
 
     def test_all_book_logic(self):
         expected_book_id = ("t888a1120y216", "t1268a1500y289")
@@ -214,6 +344,14 @@ class TesArchiveLogic(unittest.TestCase):
                 cache = self.archive.all()
                 self.assertIn(expect_id, cache)
 
+    def test_iter_books_pages(self):
+        self.archive.add(self.book_fixture())
+        self.assertEqual(
+            [id for id, _ in self.archive.iter_books()], ["t888a1120y216", "t1268a1500y289"]
+        )
+        self.assertEqual([id for id, _ in self.archive.iter_books(1, 1)], ["t1268a1500y289"])
+        self.assertEqual(self.archive.field_widths()["title"], len("next new book"))
+
     def test_change_status_book_logic(self):
         self.archive.add(self.book_fixture())
         test_data = [
@@ -266,13 +404,952 @@ class TesArchiveLogic(unittest.TestCase):
                     self.assertIsInstance(exc, exc_type)
 
     def test_search_book_logic(self):
-        storage_data = self.archive.all()
         filter_attr = ["cool book", "cool author", "1995"]
         for attr in filter_attr:
             with self.subTest(attr=attr):
-                res = self.library._match(storage_data, attr)
+                res = self.archive.search(attr)
                 self.assertEqual(len(res), 1, "При фильтрации должно вернуться 1 результат")
-                self.assertIn(attr, res[0])
+                self.assertIn(attr, res[0][1].values())
+
+    def test_search_by_token_and_collision(self):
+        # "cool book" и "loco book" имели одинаковую сумму кодов символов
+        self.archive.add(
+            {"t888a1120y217": {"title": "loco book", "author": "x", "year": "1996", "status": "в наличии"}}
+        )
+        self.assertEqual([id for id, _ in self.archive.search("cool book")], ["t888a1120y216"])
+        self.assertEqual(len(self.archive.search("LOCO Book")), 1)
+        self.archive.delete("t888a1120y217")
+        self.assertEqual(self.archive.search("loco"), [])
+
+    def test_status_views(self):
+        check_status_views(self, self.archive)
+
+    def test_search_similar(self):
+        for id, title, author in (
+            ("t1a1y1925", "Процесс", "Франц Кафка"),
+            ("t2a1y1926", "Замок", "Франц Кафка"),
+            ("t3a2y1915", "Превращение", "Кафкиана"),
+        ):
+            self.archive.add({id: {"title": title, "author": author, "year": "1925", "status": "в наличии"}})
+
+        def ids(query: str) -> list[str]:
+            return [id for id, _ in self.archive.search_similar(query)]
+
+        # слово целиком выше начала слова, начало слова выше подстроки и опечатки
+        self.assertEqual(ids("кафка"), ["t1a1y1925", "t2a1y1926", "t3a2y1915"])
+        self.assertEqual(ids("кафк")[:2], ["t1a1y1925", "t2a1y1926"])
+        self.assertEqual(ids("враще"), ["t3a2y1915"])
+        self.assertEqual(ids("кафкп замок"), ["t2a1y1926"])
+        self.assertEqual(self.archive.search_similar("кафка", limit=1)[0][1]["title"], "Процесс")
+        self.assertEqual(ids("loco"), [])
+        # триграммы словаря обновляются вместе с архивом
+        self.archive.delete("t3a2y1915")
+        self.assertEqual(ids("превращение"), [])
+        self.archive.add({"t4a3y1": {"title": "Приглашение", "author": "x", "year": "1", "status": "в наличии"}})
+        self.assertEqual(ids("приглашенте"), ["t4a3y1"])
+
+    def test_filter_books(self):
+        for num in range(1, 41):
+            book = {"title": f"book {num}", "author": f"author {num % 4}", "year": str(1900 + num)}
+            self.archive.add({f"t{num}a1y1": {**book, "status": "выдана" if num % 3 else "в наличии"}})
+
+        def ids(workers: int | None = None, **conditions: str) -> list[str]:
+            return [id for id, _ in self.archive.filter_books(conditions, workers)]
+
+        self.assertEqual(ids(year="1910-1912", status="выдана"), ["t10a1y1", "t11a1y1"])
+        self.assertEqual(ids(author="AUTHOR 2", year="-1906"), ["t2a1y1", "t6a1y1"])
+        self.assertEqual(ids(text="ok 3", year="1935-"), [f"t{num}a1y1" for num in range(35, 40)])
+        self.assertRaises(InvalidInputData, ids, year="19x0")
+        self.assertRaises(InvalidInputData, ids, genre="роман")
+        # проход кусками в пуле процессов дает тот же порядок, что и обычный
+        serial = ids(status="выдана", text="book")
+        with unittest.mock.patch("console_app.scan.PARALLEL_MIN_BOOKS", 10):
+            self.assertEqual(ids(2, status="выдана", text="book"), serial)
+            # из многопоточного процесса (сервер, отложенная запись) fork не делается
+            stop = threading.Event()
+            thread = threading.Thread(target=stop.wait)
+            thread.start()
+            try:
+                with unittest.mock.patch("concurrent.futures.ProcessPoolExecutor", side_effect=AssertionError):
+                    self.assertEqual(ids(2, status="выдана", text="book"), serial)
+            finally:
+                stop.set()
+                thread.join()
+
+
+class TestArchiveJournal(ArchiveTestCase):
+    archive_options = {"journal": True}
+
+    def test_mutation_appends_to_journal(self):
+        self.archive.add({"t1a1y1": self.book})
+        self.archive.change_status("t1a1y1", "выдана")
+        with open(self.archive._filename) as f:
+            self.assertEqual(json.load(f), {})
+        with open(self.archive._journal_filename) as f:
+            # заголовок со ссылкой на снапшот и две записи
+            self.assertEqual(len(f.readlines()), 3)
+
+    def test_journal_replay_and_compact(self):
+        self.archive.add({"t1a1y1": self.book})
+        self.archive.add({"t1a1y1": dict(self.book)})
+        self.archive.delete("t1a1y1d1")
+        reloaded = Archive()
+        reloaded._filename = self.archive._filename
+        self.assertEqual(list(reloaded.all()), ["t1a1y1"])
+        self.archive.compact()
+        self.assertFalse(os.path.exists(self.archive._journal_filename))
+        with open(self.archive._filename) as f:
+            self.assertEqual(list(json.load(f)), ["t1a1y1"])
+
+    def test_stale_journal_is_ignored(self):
+        self.archive.add({"t1a1y1": self.book})
+        # снапшот перезаписан другим процессом без учета журнала
+        other = Archive()
+        other._filename = self.archive._filename
+        other._dump({})
+        reloaded = Archive()
+        reloaded._filename = self.archive._filename
+        self.assertEqual(reloaded.all(), {})
+
+    def test_torn_record_is_cut_before_append(self):
+        self.archive.add({"t1a1y1": self.book})
+        with open(self.archive._journal_filename, "a") as f:
+            f.write('{"id": "t2a2y2", "bo')
+        reopened = self.make_archive(journal=True)
+        reopened.add({"t2a2y2": dict(self.book, title="next")})
+        self.assertEqual(list(self.make_archive(journal=True).all()), ["t1a1y1", "t2a2y2"])
+
+    def test_fast_start(self):
+        self.archive.add({"t1a1y1": self.book})
+        self.archive.compact()
+
+        def reopen():
+            archive = Archive(journal=True, fast_start=True)
+            archive._filename = self.archive._filename
+            return archive
+
+        # первая загрузка пишет файл быстрого старта, следующие читают его и журнал
+        reopen().add({"t1a1y1": dict(self.book)})
+        self.assertTrue(os.path.exists(reopen()._fast_start_filename))
+        fast = reopen()
+        self.assertIsNotNone(fast._read_fast_start())
+        plain = Archive(journal=True)
+        plain._filename = self.archive._filename
+        self.assertEqual(fast.all(), plain.all())
+        self.assertEqual(list(fast.all()), ["t1a1y1", "t1a1y1d1"])
+        self.assertEqual(fast.search("cool book"), plain.search("cool book"))
+        # файл, который могут менять другие пользователи, не читается
+        os.chmod(fast._fast_start_filename, 0o666)
+        self.assertIsNone(reopen()._read_fast_start())
+        os.chmod(fast._fast_start_filename, 0o600)
+        # после перезаписи снапшота файл быстрого старта устарел
+        fast.compact()
+        self.assertIsNone(reopen()._read_fast_start())
+
+
+class TestArchiveLocking(ArchiveTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.make_archive()
+        self.other.lock_timeout = 0.05
+
+    def test_writer_waits_for_lock(self):
+        with self.archive.batch():
+            self.archive.add({"t1a1y1": dict(self.book)})
+            self.assertRaises(ArchiveLocked, self.other.add, {"t2a2y2": dict(self.book)})
+        self.other.add({"t2a2y2": dict(self.book)})
+        self.assertEqual(sorted(self.archive.all()), ["t1a1y1", "t2a2y2"])
+
+    def test_no_lost_updates(self):
+        self.archive.all()
+        self.other.all()
+        self.archive.add({"t1a1y1": dict(self.book)})
+        self.other.add({"t2a2y2": dict(self.book)})
+        self.archive.add({"t3a3y3": dict(self.book)})
+        self.assertEqual(sorted(self.other.all()), ["t1a1y1", "t2a2y2", "t3a3y3"])
+        self.assertFalse([f for f in os.listdir() if f.endswith(".tmp")])
+
+    def test_write_during_load_is_not_lost(self):
+        self.archive.add({"t1a1y1": dict(self.book)})
+        self.other.lock_timeout = 1
+
+        writes = [{"t2a2y2": dict(self.book)}]
+
+        def read_and_write(*args):
+            # другой процесс подменяет снапшот, пока этот архив его разбирает
+            storage_data = read_snapshot(*args)
+            if writes:
+                self.other.add(writes.pop())
+            return storage_data
+
+        reader = Archive()
+        reader._filename = self.archive._filename
+        with unittest.mock.patch("console_app.data.read_snapshot", read_and_write):
+            reader.all()
+        reader.add({"t3a3y3": dict(self.book)})
+        self.assertEqual(sorted(self.other.all()), ["t1a1y1", "t2a2y2", "t3a3y3"])
+
+
+class TestArchiveCache(ArchiveTestCase):
+
+    def test_cache_survives_mutations(self):
+        cache = self.archive.cache
+        self.archive.add({"t1a1y1": self.book})
+        self.archive.change_status("t1a1y1", "выдана")
+        self.assertIs(self.archive.cache, cache)
+        self.assertEqual(cache["t1a1y1"]["status"], "выдана")
+
+    def test_clean_cache_reloads_with_indexes(self):
+        archive = self.make_archive(flush_delay=60)
+        archive.add({"t1a1y1": self.book})
+        # отложенное изменение сохраняется, а не теряется вместе с кешем
+        archive.clean_cache()
+        with unittest.mock.patch.object(archive, "_load", wraps=archive._load) as load:
+            archive.add({"t1a1y1": dict(self.book)})
+        load.assert_called_once()
+        archive.flush()
+        self.assertEqual(list(archive.all()), ["t1a1y1", "t1a1y1d1"])
+        self.assertEqual(len(archive.search("cool book")), 1)
+
+    def test_cache_reloads_after_external_change(self):
+        self.archive.add({"t1a1y1": self.book})
+        other = Archive()
+        other._filename = self.archive._filename
+        other.add({"t2a2y2": dict(self.book)})
+        self.assertIn("t2a2y2", self.archive.all())
+
+
+class TestArchiveChanges(ArchiveTestCase):
+    def setUp(self):
+        super().setUp()
+        self.replica = self.make_archive("test_replica.json", journal=True)
+
+    def test_export_without_changelog(self):
+        for archive in (ShardedArchive(shards=2), SQLiteArchive(), MmapArchive()):
+            with self.subTest(archive=type(archive).__name__):
+                self.assertRaises(InvalidInputData, archive.export_changes)
+
+    def test_export_and_apply_changes(self):
+        self.archive.add({"t1a1y1": dict(self.book)})
+        self.archive.add({"t1a1y1": dict(self.book)})
+        full = self.archive.export_changes()
+        self.assertEqual(list(full["changes"]), ["t1a1y1", "t1a1y1d1"])
+        self.assertEqual(self.replica.apply_changes(full["changes"]), 2)
+        self.archive.add({"t2a2y2": dict(self.book)})
+        self.archive.change_status("t1a1y1", "выдана")
+        other = Archive()
+        other._filename = self.archive._filename
+        other.change_status("t2a2y2", "выдана")
+        diff = self.archive.export_changes(full["seq"])
+        # добавленная и затем выданная книга приходит один раз, в последнем состоянии
+        self.assertEqual(diff["changes"], {"t1a1y1d1": None, "t2a2y2": {**self.book, "status": "выдана"}})
+        self.replica.apply_changes(diff["changes"])
+        self.assertEqual(self.replica.all(), self.archive.all())
+        self.assertEqual(self.replica.apply_changes(diff["changes"]), 0)
+        self.assertEqual(self.archive.export_changes(diff["seq"])["changes"], {})
+        self.assertRaises(InvalidInputData, self.archive.export_changes, diff["seq"] + 1)
+
+    def test_readers_keep_incomplete_tail(self):
+        self.archive.export_changes()
+        self.archive.add({"t1a1y1": dict(self.book)})
+        filename = f"{self.archive._filename}.changes"
+        # запись, которую другой процесс еще дописывает
+        with open(filename, "a") as f:
+            f.write('{"seq": 2, "id"')
+        size = os.path.getsize(filename)
+        reader = self.make_archive()
+        self.assertEqual(reader.seq, 1)
+        self.assertEqual(list(reader.export_changes(0)["changes"]), ["t1a1y1"])
+        self.assertEqual(os.path.getsize(filename), size)
+
+    def test_changes_after_any_checkpoint(self):
+        self.archive.export_changes()
+        for num in range(1, 41):
+            self.archive.add({f"t{num}a1y1": dict(self.book)})
+        # недописанная при сбое запись отбрасывается
+        with open(f"{self.archive._filename}.changes", "a") as f:
+            f.write('{"seq": 41, "id"')
+        self.archive.add({"t41a1y1": dict(self.book)})
+        self.assertEqual(self.archive.seq, 41)
+        for since in (0, 1, 17, 40):
+            with self.subTest(since=since):
+                changes = self.archive.export_changes(since)["changes"]
+                self.assertEqual(list(changes), [f"t{num}a1y1" for num in range(since + 1, 42)])
+
+
+class TestBookRecord(unittest.TestCase):
+    def tearDown(self) -> None:
+        remove_archive_files("test_library.json")
+
+    def test_compact_fields(self):
+        book = Book.from_dict({"title": "cool book", "author": "x", "year": "1995", "status": "выдана"})
+        self.assertEqual((book.year, book.status), (1995, Status.ISSUED))
+        self.assertEqual(book["year"], "1995")
+        self.assertEqual(book, {"title": "cool book", "author": "x", "year": "1995", "status": "выдана"})
+        self.assertFalse(hasattr(book, "__dict__"))
+
+    def test_json_round_trip(self):
+        storage_data = {
+            "t1a1y1": {"title": "a", "author": "b", "year": "0999", "status": "в наличии"},
+            "t1a1y1d1": {"title": "a", "author": "b", "year": "0999", "status": "выдана"},
+            "t2a2y2": {"title": "c d", "author": "e", "year": "1925", "status": "выдана"},
+        }
+        with open("test_library.json", "w") as f:
+            json.dump(storage_data, f, ensure_ascii=False)
+        archive = Archive()
+        archive._filename = "test_library.json"
+        archive.add({"t3a3y3": {"title": "f", "author": "g", "year": "2000", "status": "в наличии"}})
+        with open("test_library.json") as f:
+            stored = json.load(f)
+        self.assertEqual(stored, {**storage_data, "t3a3y3": archive.all()["t3a3y3"].to_dict()})
+
+
+class TestSnapshotCodec(unittest.TestCase):
+    def setUp(self):
+        self.books = {
+            "t1a1y1": {"title": "Процесс", "author": "Франц Кафка", "year": "1925", "status": "в наличии"},
+            "t1a1y1d1": {"title": "Процесс", "author": "Франц Кафка", "year": "0999", "status": "выдана"},
+        }
+
+    def tearDown(self) -> None:
+        remove_archive_files("test_library.json")
+        remove_archive_files("test_export.json")
+
+    def test_round_trip_with_detection(self):
+        for codec in SNAPSHOT_CODECS:
+            with self.subTest(codec=codec):
+                archive = Archive(codec=codec)
+                archive._filename = "test_library.json"
+                archive._dump(self.books)
+                # формат определяется по содержимому файла
+                reloaded = Archive()
+                reloaded._filename = "test_library.json"
+                self.assertEqual({id: dict(book) for id, book in reloaded.all().items()}, self.books)
+
+    def test_compact_snapshot_and_pretty_export(self):
+        archive = Archive()
+        archive._filename = "test_library.json"
+        archive._dump(self.books)
+        with open("test_library.json") as f:
+            self.assertNotIn("\n", f.read())
+        archive.export("test_export.json")
+        with open("test_export.json") as f:
+            self.assertEqual(f.read(), json.dumps(self.books, ensure_ascii=False, indent=2))
+
+
+class TestArchiveWriteBehind(ArchiveTestCase):
+    def stored(self) -> dict[str]:
+        with open("test_library.json") as f:
+            return json.load(f)
+
+    def test_flush_every(self):
+        archive = self.make_archive(flush_every=3)
+        archive.add({"t1a1y1": dict(self.book)})
+        archive.add({"t2a2y2": dict(self.book)})
+        self.assertEqual(self.stored(), {})
+        archive.delete("t1a1y1")
+        self.assertEqual(list(self.stored()), ["t2a2y2"])
+
+    def test_write_behind_is_time_bound(self):
+        archive = self.make_archive(flush_every=1000)
+        self.assertEqual(archive.flush_delay, Archive.default_flush_delay)
+        archive.flush_delay = 0.05
+        archive.add({"t1a1y1": dict(self.book)})
+        archive._flush_timer.join()
+        self.assertEqual(list(self.stored()), ["t1a1y1"])
+        # хук выхода не держит архив в памяти
+        ref = weakref.ref(archive)
+        del archive
+        self.assertIsNone(ref())
+
+    def test_flush_delay(self):
+        archive = self.make_archive(flush_delay=0.05)
+        archive.add({"t1a1y1": dict(self.book)})
+        self.assertEqual(self.stored(), {})
+        archive._flush_timer.join()
+        self.assertEqual(list(self.stored()), ["t1a1y1"])
+
+    def test_archive_locked_until_flush(self):
+        other = self.make_archive()
+        other.lock_timeout = 0.05
+        with self.make_archive(flush_delay=60) as archive:
+            archive.add({"t1a1y1": dict(self.book)})
+            self.assertRaises(ArchiveLocked, other.add, {"t2a2y2": dict(self.book)})
+        other.add({"t2a2y2": dict(self.book)})
+        self.assertEqual(sorted(self.stored()), ["t1a1y1", "t2a2y2"])
+
+    def test_leave_flushes(self):
+        library = Library(flush_delay=60)
+        library.archive._filename = "test_library.json"
+        library.add_book("cool book", "cool author", "1995")
+        self.assertEqual(self.stored(), {})
+        default_print = print
+        __builtins__.print = catch_print()
+        try:
+            self.assertRaises(SystemExit, library.leave)
+        finally:
+            __builtins__.print = default_print
+        self.assertEqual(len(self.stored()), 1)
+
+
+class TestArchiveDublicateIndex(ArchiveTestCase):
+
+    def test_dublicates_numbered_after_ten_copies(self):
+        for _ in range(12):
+            self.archive.add({"t1a1y1": dict(self.book)})
+        self.assertEqual(self.archive._find_dublicate("t1a1y1"), "t1a1y1d11")
+        self.archive.delete("t1a1y1")
+        self.assertNotIn("t1a1y1d11", self.archive.all())
+        self.assertIn("t1a1y1d10", self.archive.all())
+
+    def test_similar_id_is_not_dublicate(self):
+        self.archive.add({"t11a1y1": dict(self.book)})
+        self.archive.add({"t11a1y1": dict(self.book)})
+        self.archive.add({"t1a1y1": dict(self.book)})
+        self.assertIsNone(self.archive._find_dublicate("t1a1y1"))
+        self.archive.delete("t1a1y1")
+        self.assertIn("t11a1y1d1", self.archive.all())
+
+
+class TestIdStrategy(ArchiveTestCase):
+
+    def test_hash_id_has_no_anagram_collision(self):
+        first = {"t": "cool book", "a": "author", "y": "1995"}
+        second = {"t": "loco book", "a": "author", "y": "1995"}
+        self.assertEqual(charsum_id(first), charsum_id(second))
+        self.assertNotEqual(content_hash_id(first), content_hash_id(second))
+        self.assertNotIn("d", content_hash_id(first))
+
+    def test_legacy_archive_keeps_charsum(self):
+        book = {"title": "cool book", "author": "author", "year": "1995", "status": "в наличии"}
+        self.archive.refresh({charsum_id({"t": "cool book", "a": "author", "y": "1995"}): book})
+        library = Library(archive=self.archive, id_strategy="hash")
+        library.add_book("cool book", "author", "1995")
+        # архив без записанной схемы построен на charsum: повторная книга стала дубликатом
+        self.assertEqual(len(self.archive.all()), 2)
+        self.assertEqual(len(self.archive.search("cool book")), 1)
+        self.assertIsNone(self.archive.get_id_scheme())
+
+    def test_scheme_is_stored_in_archive(self):
+        library = Library(archive=self.archive)
+        library.add_book("cool book", "author", "1995")
+        library.add_book("loco book", "author", "1995")
+        # новый архив получил hash, анаграммы - разные книги
+        self.assertEqual(self.archive.get_id_scheme(), "hash")
+        self.assertEqual(len(self.archive.search("1995")), 2)
+        Library(archive=self.archive, id_strategy="charsum").add_book("cool book", "author", "1995")
+        self.assertEqual(len(self.archive.all()), 3)
+        self.assertEqual(len(self.archive.search("1995")), 2)
+
+    def test_migrate_stores_scheme(self):
+        book = {"title": "cool book", "author": "author", "year": "1995", "status": "в наличии"}
+        self.archive.refresh({charsum_id({"t": "cool book", "a": "author", "y": "1995"}): book})
+        with unittest.mock.patch("builtins.print"):
+            Library(archive=self.archive).migrate_ids()
+        self.assertEqual(self.archive.get_id_scheme(), "hash")
+        # следующий запуск без параметра берет схему архива
+        Library(archive=self.archive).add_book("cool book", "author", "1995")
+        id = content_hash_id({"t": "cool book", "a": "author", "y": "1995"})
+        self.assertEqual(list(self.archive.all()), [id, f"{id}d1"])
+
+    def test_migrate_ids(self):
+        book = {"title": "cool book", "author": "author", "year": "1995", "status": "выдана"}
+        anagram = {"title": "loco book", "author": "author", "year": "1995", "status": "в наличии"}
+        self.archive.refresh({"t888a655y216": book, "t888a655y216d1": anagram})
+        self.assertEqual(self.archive.migrate_ids(content_hash_id), 2)
+        storage_data = self.archive.all()
+        self.assertEqual(storage_data[content_hash_id({"t": "cool book", "a": "author", "y": "1995"})], book)
+        anagram_id = content_hash_id({"t": "loco book", "a": "author", "y": "1995"})
+        self.assertEqual(storage_data[anagram_id], anagram)
+        self.assertEqual(self.archive.migrate_ids(content_hash_id), 0)
+
+
+class TestSQLiteArchive(unittest.TestCase):
+    def setUp(self):
+        self.library = Library(storage="sqlite")
+        self.archive = self.library.archive
+        self.archive._filename = "test_library.sqlite3"
+        self.book = dict(BOOK)
+
+    def tearDown(self) -> None:
+        self.archive.close()
+        if os.path.exists(self.archive._filename):
+            os.remove(self.archive._filename)
+
+    def test_trigrams_follow_mutations(self):
+        self.archive.add({"t1a1y1": dict(self.book)})
+        vocabulary = self.archive._vocabulary()
+        self.archive.add({"t2a2y2": dict(self.book, title="процесс")})
+        self.archive.delete("t1a1y1")
+        # индекс обновлен на месте, а не построен заново
+        self.assertIs(self.archive._vocabulary(), vocabulary)
+        self.assertEqual(vocabulary._words, TrigramIndex(["процесс", "cool", "author", "1995"])._words)
+        self.assertEqual([id for id, _ in self.archive.search_similar("прцесс")], ["t2a2y2"])
+
+    def test_id_scheme_in_database(self):
+        self.assertIsNone(self.archive.get_id_scheme())
+        self.library.add_book("cool book", "cool author", "1995")
+        self.assertEqual(self.archive.get_id_scheme(), "hash")
+        self.assertFalse(os.path.exists(self.archive._id_scheme_filename))
+
+    def test_status_change_keeps_order(self):
+        for num in range(1, 4):
+            self.archive.add({f"t{num}a{num}y{num}": dict(self.book)})
+        self.archive.change_status("t1a1y1", "выдана")
+        self.archive.add({"t2a2y2": dict(self.book)})
+        self.archive.change_status("t2a2y2d1", "выдана")
+        self.archive.change_status("t2a2y2", "выдана")
+        # как в json архиве: смена статуса не переносит книгу в конец выдачи
+        self.assertEqual(list(self.archive.all()), ["t1a1y1", "t2a2y2", "t3a3y3"])
+        self.assertEqual([id for id, _ in self.archive.iter_books(0, 2)], ["t1a1y1", "t2a2y2"])
+
+    def test_backend_from_env(self):
+        os.environ["LIBRARY_STORAGE"] = "sqlite"
+        try:
+            self.assertIsInstance(Library().archive, SQLiteArchive)
+        finally:
+            del os.environ["LIBRARY_STORAGE"]
+        self.assertIsInstance(Library().archive, Archive)
+
+    def test_status_views(self):
+        check_status_views(self, self.archive)
+
+    def test_dublicate_and_status_logic(self):
+        self.assertEqual(self.archive.add({"t1a1y1": dict(self.book)}), 2)
+        self.archive.add({"t1a1y1": dict(self.book)})
+        self.assertEqual(self.archive.change_status("t1a1y1", "выдана"), 0)
+        self.assertEqual(self.archive.change_status("t1a1y1", "выдана"), 1)
+        self.assertRaises(TheSameStatus, self.archive.change_status, "t1a1y1", "выдана")
+        self.assertEqual(self.archive.add({"t1a1y1": dict(self.book)}), 1)
+        self.assertEqual(list(self.archive.all()), ["t1a1y1", "t1a1y1d1"])
+        self.archive.delete("t1a1y1")
+        self.archive.delete("t1a1y1")
+        self.assertRaises(DataDoesNotExists, self.archive.delete, "t1a1y1")
+
+    def test_search_and_persistence(self):
+        self.archive.add({"t1a1y1": dict(self.book)})
+        self.archive.add({"t2a2y2": dict(self.book, title="loco book", author="x")})
+        self.archive.close()
+        self.assertEqual([id for id, _ in self.archive.search("Cool Book")], ["t1a1y1"])
+        self.assertEqual([id for id, _ in self.archive.search("book")], ["t1a1y1", "t2a2y2"])
+        self.assertEqual([id for id, _ in self.archive.search_similar("locp bo")], ["t2a2y2"])
+
+
+class TestMmapArchive(unittest.TestCase):
+    def setUp(self):
+        self.archive = Library(storage="mmap").archive
+        self.archive._filename = "test_library.mmap"
+        self.archive.index_capacity = 8
+        self.book = dict(BOOK)
+        self.reopened = []
+
+    def tearDown(self) -> None:
+        for archive in (self.archive, *self.reopened):
+            archive.close()
+        remove_archive_files(self.archive._filename)
+        remove_archive_files(self.archive._index_filename)
+
+    def reopen(self) -> MmapArchive:
+        archive = MmapArchive()
+        archive._filename = self.archive._filename
+        self.reopened.append(archive)
+        return archive
+
+    def test_status_views(self):
+        check_status_views(self, self.archive)
+
+    def test_dublicate_and_status_logic(self):
+        self.assertEqual(self.archive.add({"t1a1y1": dict(self.book)}), 2)
+        self.archive.add({"t1a1y1": dict(self.book)})
+        self.assertEqual(self.archive.change_status("t1a1y1", "выдана"), 0)
+        self.assertEqual(self.archive.change_status("t1a1y1", "выдана"), 1)
+        self.assertEqual(self.archive.add({"t1a1y1": dict(self.book)}), 1)
+        self.assertEqual(self.reopen()._find_dublicate("t1a1y1"), "t1a1y1d1")
+        self.archive.delete("t1a1y1")
+        self.archive.delete("t1a1y1")
+        self.assertRaises(DataDoesNotExists, self.archive.delete, "t1a1y1")
+
+    def test_index_growth_and_rebuild(self):
+        for num in range(50):
+            self.archive.add({f"t{num}a1y1": dict(self.book, title=f"book {num}")})
+        self.archive.delete("t7a1y1")
+        self.assertGreater(self.archive._header[1], 8)
+        self.assertEqual(self.reopen()._get("t42a1y1")["title"], "book 42")
+        self.archive.close()
+        os.remove(self.archive._index_filename)
+        archive = self.reopen()
+        self.assertIsNone(archive._get("t7a1y1"))
+        self.assertEqual(len(archive.all()), 49)
+        self.assertEqual([id for id, _ in archive.search("book 42")], ["t42a1y1"])
+        self.assertEqual([id for id, _ in archive.search_similar("boook 4", limit=2)], ["t4a1y1", "t40a1y1"])
+        self.assertEqual([id for id, _ in archive.iter_books(1, 2)], ["t1a1y1", "t2a1y1"])
+
+    def test_compact(self):
+        self.archive.add({"t1a1y1": dict(self.book)})
+        self.archive.add({"t1a1y1": dict(self.book)})
+        self.archive.change_status("t1a1y1", "выдана")
+        self.archive.change_status("t1a1y1", "выдана")
+        size = os.path.getsize(self.archive._filename)
+        self.archive.compact()
+        self.assertLess(os.path.getsize(self.archive._filename), size)
+        self.assertEqual(self.reopen().all(), {"t1a1y1": dict(self.book, status="выдана")})
+
+
+class TestShardedArchive(ArchiveTestCase):
+    archive_class = ShardedArchive
+    archive_options = {"shards": 4, "workers": 2}
+
+    def tearDown(self) -> None:
+        for shard in self.archive.shard_archives:
+            remove_archive_files(shard._filename)
+
+    def test_status_views(self):
+        check_status_views(self, self.archive)
+
+    def test_mutation_touches_one_shard(self):
+        self.archive.add({"t1a1y1": dict(self.book)})
+        self.archive.add({"t1a1y1": dict(self.book)})
+        shard = self.archive.shard_archives[self.archive._shard_num("t1a1y1")]
+        # дубликат лежит в шарде оригинала, остальные шарды не загружались и не созданы
+        self.assertEqual(list(shard.all()), ["t1a1y1", "t1a1y1d1"])
+        self.assertEqual(
+            [os.path.exists(other._filename) for other in self.archive.shard_archives],
+            [other is shard for other in self.archive.shard_archives],
+        )
+        self.assertEqual(self.archive.change_status("t1a1y1", "выдана"), 0)
+
+    def test_reads_outside_transaction(self):
+        self.archive.add({"t1a1y1": dict(self.book)})
+        self.archive.add({"t1a1y1": dict(self.book)})
+        reopened = ShardedArchive(shards=4)
+        reopened._filename = self.archive._filename
+        self.assertEqual(reopened._find_dublicate("t1a1y1"), "t1a1y1d1")
+        self.assertEqual(reopened._get("t1a1y1")["title"], "cool book")
+        self.assertIsNone(reopened._get("t2a2y2"))
+
+    def test_fan_out_matches_single_archive(self):
+        single = Archive()
+        single._filename = "test_single.json"
+        self.addCleanup(remove_archive_files, single._filename)
+        with self.archive.batch():
+            for num in range(30):
+                book = dict(self.book, title=f"book {num}", author=f"author {num % 3}")
+                self.archive.add({f"t{num}a1y1": dict(book)})
+                single.add({f"t{num}a1y1": dict(book)})
+        self.archive.delete("t7a1y1")
+        single.delete("t7a1y1")
+        reopened = ShardedArchive(shards=4)
+        reopened._filename = self.archive._filename
+        self.assertEqual(reopened.all(), single.all())
+        for query in ("author 1", "book 12", "boook 2"):
+            with self.subTest(query=query):
+                self.assertEqual(reopened.search(query), single.search(query))
+                self.assertEqual(reopened.search_similar(query, 5), single.search_similar(query, 5))
+        self.assertEqual(len(list(reopened.iter_books(5, 100))), 24)
+        self.assertEqual(reopened.field_widths(), single.field_widths())
+
+
+class TestTableRenderer(unittest.TestCase):
+    def test_formatted_style(self):
+        body = [("x1", "y"), ("longer id", "zz")]
+        expected = (
+            "------------\n|        A| BBB |\n"
+            "------------\n|       x1|   y |\n"
+            "------------\n| longer id|  zz |\n"
+        )
+        self.assertEqual(Library().formatted_style(("A", "BBB"), body), expected)
+        self.assertEqual(len(body), 2, "formatted_style не должен изменять переданные данные")
+
+    def test_write_in_chunks(self):
+        renderer = TableRenderer((3, 1))
+        renderer.chunk_size = 2
+        out = io.StringIO()
+        renderer.write(out, ((f"{i}", "x") for i in range(5)))
+        self.assertEqual(out.getvalue(), renderer.render([(f"{i}", "x") for i in range(5)]))
+        self.assertEqual(out.getvalue().count("|  4| x |"), 1)
+
+
+class TestImport(unittest.TestCase):
+    def setUp(self):
+        self.library = Library()
+        self.archive = self.library.archive
+        self.archive._filename = "test_library.json"
+        self.import_filename = "test_import.jsonl"
+
+    def tearDown(self) -> None:
+        remove_archive_files(self.archive._filename)
+        if os.path.exists(self.import_filename):
+            os.remove(self.import_filename)
+
+    def write_import_file(self, lines: list[str]) -> None:
+        with open(self.import_filename, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+
+    def test_import_jsonl(self):
+        book = {"title": "Процесс", "author": "Франц Кафка", "year": "1925"}
+        self.write_import_file(
+            [
+                json.dumps(book, ensure_ascii=False),
+                json.dumps(book, ensure_ascii=False),
+                json.dumps(dict(book, year="год")),
+                "not a json",
+            ]
+        )
+        counters = self.library.import_file(self.import_filename)
+        self.assertEqual(counters, {"added": 2, "status_changed": 0, "errors": 2})
+        self.assertEqual(len(self.archive.all()), 2)
+        self.assertEqual(len(self.archive.search("кафка")), 1)
+
+    def test_import_csv_persists_once(self):
+        self.import_filename = "test_import.csv"
+        self.write_import_file(["title,author,year", "cool book,cool author,1995", "next,author,2000"])
+        self.archive.all()
+        dumps = []
+        dump = self.archive._dump
+        self.archive._dump = lambda data: dumps.append(dump(data))
+        counters = self.library.import_file(self.import_filename)
+        self.assertEqual(counters["added"], 2)
+        self.assertEqual(len(dumps), 1)
+
+
+class TestBatchMode(unittest.TestCase):
+    def setUp(self):
+        self.library = Library()
+        self.archive = self.library.archive
+        self.archive._filename = "test_library.json"
+
+    def tearDown(self) -> None:
+        remove_archive_files(self.archive._filename)
+
+    def run_batch(self, lines: list[str], flush_every: int | None = None) -> list[dict]:
+        out = io.StringIO()
+        self.library.run_batch(lines, out, flush_every)
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_batch_commands(self):
+        book_id = content_hash_id({"t": "Процесс", "a": "Франц Кафка", "y": "1925"})
+        results = self.run_batch(
+            [
+                'add "Процесс" "Франц Кафка" 1925',
+                "# комментарий",
+                f"change_status {book_id} выдана",
+                f"change_status {book_id} в наличии",
+                "search кафка",
+                f"delete {book_id}",
+                "delete t1a1y1",
+                "leave",
+                "all",
+            ]
+        )
+        self.assertEqual([r["ok"] for r in results], [True, True, True, True, True, False, False, True])
+        self.assertEqual(results[3]["result"][0]["id"], book_id)
+        self.assertEqual(results[-1]["result"], [])
+        self.assertEqual(results[1]["line"], 3)
+
+    def test_batch_uses_command_grammar(self):
+        results = self.run_batch(
+            [
+                "add Война и мир Толстой 1869",
+                'add "Война и мир" "Лев Толстой" 1869',
+                "add Процесс Кафка 1925",
+                "all 1 1",
+                "all x",
+                "migrate ids",
+                'filter "author=Лев Толстой"',
+                "import_books missing.csv",
+                "cmd",
+            ]
+        )
+        ok = [False, True, True, True, False, True, True, False, False]
+        self.assertEqual([r["ok"] for r in results], ok)
+        self.assertEqual([book["title"] for book in results[3]["result"]], ["Процесс"])
+        self.assertEqual(results[5]["result"], {"changed": 0})
+        self.assertEqual([book["title"] for book in results[6]["result"]], ["Война и мир"])
+
+    def test_batch_persists_every_n(self):
+        self.archive.all()
+        dumps = []
+        dump = self.archive._dump
+        self.archive._dump = lambda data: dumps.append(dump(data))
+        self.run_batch([f"add book{i} author 2000" for i in range(5)], flush_every=2)
+        self.assertEqual(len(dumps), 3)
+        self.assertEqual(len(self.archive.all()), 5)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_catalogue_collisions(self):
+        def count_dublicates(catalogue: dict[str]) -> int:
+            return sum(BaseArchive._split_id(id)[1] is not None for id in catalogue)
+
+        # анаграммы при схеме charsum становятся дубликатами
+        charsum = generate_catalogue(200, charsum_id, dublicate_rate=0.0, collision_rate=0.5)
+        hashed = generate_catalogue(200, content_hash_id, dublicate_rate=0.0, collision_rate=0.5)
+        self.assertEqual(len(charsum), 200)
+        self.assertGreater(count_dublicates(charsum), count_dublicates(hashed))
+
+    def test_report(self):
+        default_print = print
+        __builtins__.print = catch_print()
+        try:
+            report = run_benchmarks(lambda: Library(storage="json"), [50], ops=5, output="test_bench.json")
+        finally:
+            __builtins__.print = default_print
+        try:
+            with open("test_bench.json") as f:
+                self.assertEqual(json.load(f), report)
+        finally:
+            os.remove("test_bench.json")
+        operations = report["results"][0]["operations"]
+        self.assertEqual(operations["add"]["ops"], 5)
+        self.assertIn("peak_memory_kb", operations["cold_load"])
+        self.assertFalse(os.path.exists("library_storage.json"))
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.library = Library(storage="json")
+        self.library.archive._filename = "test_stats.json"
+        STATS.reset()
+        STATS.enable()
+
+    def tearDown(self):
+        STATS.disable()
+        STATS.reset()
+        remove_archive_files("test_stats.json")
+
+    def test_timings_and_counters(self):
+        out = io.StringIO()
+        id = self.library._gen_id({"t": "Процесс", "a": "Франц Кафка", "y": "1925"})
+        lines = ['add "Процесс" "Франц Кафка" 1925', f"change status {id} выдана", "search кафка", "stats"]
+        self.library.run_batch(lines, out)
+        report = json.loads(out.getvalue().splitlines()[-1])["result"]
+        self.assertEqual(report["timings"]["command.add"]["calls"], 1)
+        # имя из двух слов, как в интерактивном режиме
+        self.assertEqual(report["timings"]["command.change_status"]["calls"], 1)
+        self.assertEqual(report["timings"]["BaseArchive.search_similar"]["calls"], 1)
+        self.assertEqual(report["counters"]["cache.miss"], 1)
+        self.assertGreater(report["counters"]["io.bytes_written"], 0)
+        self.assertIn("command.search", STATS.render())
+
+    def test_backend_is_timed_once_loaded(self):
+        STATS.disable()
+        # хранилище еще не загружено: enable его не импортирует и не замеряет
+        with unittest.mock.patch.dict(sys.modules):
+            del sys.modules["console_app.mmap_archive"]
+            STATS.enable()
+        self.assertFalse(hasattr(MmapArchive.__dict__["search"], "__wrapped__"))
+        self.assertIs(get_archive_backend("mmap"), MmapArchive)
+        get_archive_backend("mmap")
+        wrapped = MmapArchive.__dict__["search"].__wrapped__
+        self.assertFalse(hasattr(wrapped, "__wrapped__"))
+        STATS.disable()
+        self.assertIs(MmapArchive.__dict__["search"], wrapped)
+
+    def test_disable_restores_methods(self):
+        STATS.disable()
+        self.assertFalse(hasattr(Archive.__dict__["search"], "__wrapped__"))
+        self.assertFalse(hasattr(Library.__dict__["command_execute"], "__wrapped__"))
+        self.library.archive.search("кафка")
+        self.assertEqual(STATS.report(), {"timings": {}, "counters": {}})
+
+
+class TestArchiveServer(unittest.TestCase):
+    def setUp(self):
+        library = Library()
+        library.archive._filename = "test_library.json"
+        self.server = ArchiveServer(library)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        listener = asyncio.run_coroutine_threadsafe(
+            self.server.start("127.0.0.1", 0), self.loop
+        ).result()
+        self.port = listener.sockets[0].getsockname()[1]
+        self.book = dict(BOOK)
+
+    def tearDown(self) -> None:
+        asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        remove_archive_files("test_library.json")
+
+    def test_concurrent_clients(self):
+        def add_books(client_num: int) -> None:
+            archive = RemoteArchive("127.0.0.1", self.port)
+            for i in range(20):
+                archive.add({f"t{client_num}a{i}y1": dict(self.book)})
+            archive.close()
+
+        threads = [threading.Thread(target=add_books, args=(num,)) for num in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        archive = RemoteArchive("127.0.0.1", self.port)
+        self.assertEqual(len(archive.all()), 100)
+        with open("test_library.json") as f:
+            self.assertEqual(len(json.load(f)), 100)
+        archive.close()
+
+    def test_writer_survives_persist_error(self):
+        archive = RemoteArchive("127.0.0.1", self.port)
+        server_archive = self.server.library.archive
+        with unittest.mock.patch.object(server_archive, "_dump", side_effect=OSError("disk full")):
+            with unittest.mock.patch("sys.stderr", io.StringIO()):
+                self.assertRaises(InvalidInputData, archive.add, {"t1a1y1": dict(self.book)})
+        archive.add({"t2a2y2": dict(self.book)})
+        self.assertIn("t2a2y2", archive.all())
+        self.assertRaises(InvalidInputData, archive._call, "search", "a", "b")
+        archive.close()
+
+    def test_write_args_are_checked(self):
+        archive = RemoteArchive("127.0.0.1", self.port)
+        bad_requests = [
+            ("add", {"t2a2y2": {"title": "a"}}),
+            ("add", {"t2a2y2": dict(self.book, status="потеряна")}),
+            ("add", {"../x": dict(self.book)}),
+            ("add", {"t1a1y1": dict(self.book), "t2a2y2": dict(self.book)}),
+            ("delete", 1),
+            ("change_status", "t1a1y1", "потеряна"),
+        ]
+        for method, *args in bad_requests:
+            with self.subTest(method=method, args=args):
+                self.assertRaises(InvalidInputData, archive._call, method, *args)
+        self.assertEqual(archive.all(), {})
+        archive.close()
+
+    def test_failed_request_does_not_fail_batch(self):
+        server_archive = self.server.library.archive
+        set_book = server_archive._set
+
+        def fail_second(id: str, book: dict[str]) -> None:
+            if id == "t2a2y2":
+                raise RuntimeError("broken")
+            set_book(id, book)
+
+        async def write_batch() -> list[dict[str, Any]]:
+            # оба изменения попадают в один пакет писателя
+            return await asyncio.gather(
+                self.server.dispatch({"method": "add", "args": [{"t1a1y1": dict(self.book)}]}),
+                self.server.dispatch({"method": "add", "args": [{"t2a2y2": dict(self.book)}]}),
+            )
+
+        with unittest.mock.patch.object(server_archive, "_set", side_effect=fail_second):
+            with unittest.mock.patch("sys.stderr", io.StringIO()):
+                first, second = asyncio.run_coroutine_threadsafe(write_batch(), self.loop).result()
+        self.assertTrue(first["ok"])
+        self.assertEqual(second["error"], "ServerError")
+        with open("test_library.json") as f:
+            self.assertEqual(list(json.load(f)), ["t1a1y1"])
+
+    def test_library_over_remote_archive(self):
+        archive = RemoteArchive("127.0.0.1", self.port)
+        library = Library(archive=archive)
+        library.add_book("cool book", "cool author", "1995")
+        self.assertEqual(len(archive.search("cool book")), 1)
+        self.assertRaises(DataDoesNotExists, library.delete_book, "t1a1y1")
+        archive.close()
 
 
 if __name__ == '__main__':